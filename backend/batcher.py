@@ -0,0 +1,120 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from PIL import Image
+
+from . import metrics
+
+
+class SearchBatcher:
+    """Dynamic micro-batching of concurrent search requests.
+
+    Requests that arrive while a batch is running, or within ``max_wait_ms`` of the
+    first queued request, are searched together through one ``search_batch_fn`` call
+    (one ViT forward pass and one multi-query FAISS search). The batch runs on a
+    dedicated worker thread, so the event loop is never blocked by inference.
+
+    If a batched call fails, its requests are searched again one by one, so one bad
+    query only fails its own request.
+    """
+
+    def __init__(self, search_batch_fn: Callable[..., list[list[dict]]], max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        self.search_batch_fn = search_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-batch")
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, image: Image.Image, timings: dict | None = None, **options) -> list[dict]:
+        """Queues one search and waits for its result. ``options`` are passed to the search.
+
+        A ``timings`` dict receives the stage timings (seconds) of the batch the search ran
+        in, its queue wait and the batch size.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self._queue.put((image, options, future, timings, loop.time()))
+        return await future
+
+    async def _collect(self) -> list[tuple]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Requests that queued up during the previous batch are taken without waiting.
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _search(self, batch: list[tuple]) -> list:
+        """Runs a collected batch, one ``search_batch_fn`` call per distinct set of options."""
+        groups: dict[tuple, list[int]] = {}
+        for position, (_, options, *_) in enumerate(batch):
+            groups.setdefault(tuple(sorted(options.items())), []).append(position)
+
+        outcomes = [None] * len(batch)
+        for key, positions in groups.items():
+            error = self._search_group(batch, positions, dict(key), outcomes)
+            if error is not None and len(positions) > 1:
+                for position in positions:
+                    self._search_group(batch, [position], dict(key), outcomes)
+        return outcomes
+
+    def _search_group(self, batch: list[tuple], positions: list[int], options: dict, outcomes: list) -> Exception | None:
+        """Searches the given positions in one call and records their outcomes; returns the error, if any."""
+        metrics.SEARCH_BATCH_SIZE.observe(len(positions))
+        try:
+            with metrics.collect_timings() as timings:
+                results = self.search_batch_fn([batch[p][0] for p in positions], **options)
+        except Exception as e:
+            for position in positions:
+                outcomes[position] = (None, e)
+            return e
+        for position, result in zip(positions, results):
+            outcomes[position] = (result, None)
+            if batch[position][3] is not None:
+                batch[position][3].update(timings, batch_size=len(positions))
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = loop.time()
+            for _, _, _, timings, enqueued_at in batch:
+                metrics.STAGE_SECONDS.observe(started - enqueued_at, stage="queue_wait")
+                if timings is not None:
+                    timings["queue_wait"] = started - enqueued_at
+            try:
+                outcomes = await loop.run_in_executor(self._executor, self._search, batch)
+            except Exception as e:
+                outcomes = [(None, e)] * len(batch)
+            for (_, _, future, _, _), (result, error) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,89 @@
+import math
+import os
+import statistics
+
+import cv2
+from PIL import Image
+
+
+def sample_clip_frames(video_path: str, interval_sec: float = 0.5, max_frames: int = 32) -> list[tuple[float, Image.Image]]:
+    """Samples ``(offset_sec, frame)`` pairs from a query clip, at most ``max_frames`` of them.
+
+    Frames are read sequentially; unsampled frames are only grabbed, never decoded to RGB.
+    Long clips are sampled more sparsely so they still fit into ``max_frames``.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open the clip '{os.path.basename(video_path)}'.")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(1, round(fps * interval_sec))
+    if total_frames > 0:
+        step = max(step, math.ceil(total_frames / max_frames))
+
+    frames = []
+    frame_num = 0
+    try:
+        while len(frames) < max_frames and cap.grab():
+            if frame_num % step == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    frames.append((frame_num / fps, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))))
+            frame_num += 1
+    finally:
+        cap.release()
+    return frames
+
+
+def vote_segments(frame_results: list[list[dict]], offsets: list[float] | None = None, tolerance_sec: float = 3.0,
+                  max_segments: int = 10) -> list[dict]:
+    """Aggregates per-frame search results into ranked video segments.
+
+    Every hit votes for the position the query would start at in its video, i.e. the hit
+    timestamp minus the query frame's ``offsets`` (0 for unordered images). Hits of one
+    video whose positions lie within ``tolerance_sec`` of each other form a segment, so
+    frames of a clip only reinforce each other when they match in the same order and
+    spacing. A query frame votes at most once per segment, weighted ``1 / (rank + 1)``.
+    The ``occurrences`` of a deduplicated hit vote like the hit itself.
+    """
+    hits_by_video: dict[str, list[tuple]] = {}
+    for frame_index, results in enumerate(frame_results):
+        offset = offsets[frame_index] if offsets is not None else 0.0
+        for rank, result in enumerate(results):
+            for occurrence in [result, *result.get("occurrences", [])]:
+                timestamp = float(occurrence["timestamp"])
+                hits_by_video.setdefault(occurrence["video_id"], []).append(
+                    (timestamp - offset, timestamp, frame_index, 1.0 / (rank + 1), result["score"])
+                )
+
+    segments = []
+    for video_id, hits in hits_by_video.items():
+        hits.sort()
+        cluster = [hits[0]]
+        for hit in hits[1:]:
+            if hit[0] - cluster[-1][0] > tolerance_sec:
+                segments.append(_segment(video_id, cluster, offsets is not None))
+                cluster = []
+            cluster.append(hit)
+        segments.append(_segment(video_id, cluster, offsets is not None))
+
+    segments.sort(key=lambda s: (s["votes"], s["frames_matched"], s["best_score"]), reverse=True)
+    return segments[:max_segments]
+
+
+def _segment(video_id: str, hits: list[tuple], aligned: bool) -> dict:
+    best_weight_per_frame: dict[int, float] = {}
+    for _, _, frame_index, weight, _ in hits:
+        best_weight_per_frame[frame_index] = max(weight, best_weight_per_frame.get(frame_index, 0.0))
+    segment = {
+        "video_id": video_id,
+        "start": f"{min(h[1] for h in hits):.2f}",
+        "end": f"{max(h[1] for h in hits):.2f}",
+        "frames_matched": len(best_weight_per_frame),
+        "votes": round(sum(best_weight_per_frame.values()), 3),
+        "best_score": max(h[4] for h in hits),
+    }
+    if aligned:
+        # Where the clip's first frame most likely sits in the video.
+        segment["clip_start"] = f"{max(0.0, statistics.median(h[0] for h in hits)):.2f}"
+    return segment
@@ -0,0 +1,231 @@
+from fastapi import FastAPI, File, UploadFile, HTTPException, Response, Query
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+import requests
+import os
+import time
+
+from . import metrics
+from .clip_search import vote_segments
+from .shards import merge_results
+from .previews import PreviewCache, resolve_video, KINDS as PREVIEW_KINDS
+
+app = FastAPI()
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+VIDEO_DIR = os.path.join(os.path.dirname(__file__), "videos")
+# Base URLs of the shard servers (backend.main with VIDEOARCHIVE_SHARD), comma-separated
+SHARD_URLS = [url.strip().rstrip("/") for url in os.environ.get("VIDEOARCHIVE_SHARDS", "").split(",") if url.strip()]
+# Seconds to wait for a shard; slower shards are reported as failed and left out of the results
+SHARD_TIMEOUT = float(os.environ.get("VIDEOARCHIVE_SHARD_TIMEOUT", "30"))
+# Largest top_k a request may ask for (the shards enforce the same bound)
+MAX_TOP_K = int(os.environ.get("VIDEOARCHIVE_MAX_TOP_K", "100"))
+# /preview: on-disk cache size for thumbnails and preview clips, in MB
+PREVIEW_CACHE_MB = float(os.environ.get("VIDEOARCHIVE_PREVIEW_CACHE_MB", "2048"))
+PREVIEW_DIR = os.path.join(os.path.dirname(__file__), "previews")
+if os.path.isdir(VIDEO_DIR):
+    # Shards on this host share the video folder, so the coordinator can serve the players too.
+    app.mount("/videos", StaticFiles(directory=VIDEO_DIR), name="videos")
+
+preview_cache = PreviewCache(PREVIEW_DIR, max_bytes=int(PREVIEW_CACHE_MB * 1024 ** 2))
+session = requests.Session()
+shard_executor = ThreadPoolExecutor(max_workers=max(4, 4 * len(SHARD_URLS)), thread_name_prefix="shard")
+
+
+def _call_shard(shard_url: str, method: str, path: str, **kwargs) -> tuple[int, dict | None, str | None]:
+    """Calls one shard and returns ``(status_code, json, error)``; never raises."""
+    try:
+        response = session.request(method, shard_url + path, timeout=SHARD_TIMEOUT, **kwargs)
+        body = response.json()
+        metrics.SHARD_REQUESTS.inc(shard=shard_url, outcome="ok" if response.ok else str(response.status_code))
+        return response.status_code, body, None if response.ok else str(body.get("detail", body))
+    except (requests.RequestException, ValueError) as e:
+        metrics.SHARD_REQUESTS.inc(shard=shard_url, outcome="error")
+        return 0, None, str(e)
+
+
+def _fan_out(method: str, path: str, shard_urls: list[str] | None = None, **kwargs) -> list[tuple]:
+    """Sends the same request to every shard concurrently; results are in shard order."""
+    shard_urls = SHARD_URLS if shard_urls is None else shard_urls
+    with metrics.stage("shard_fanout"):
+        futures = [shard_executor.submit(_call_shard, url, method, path, **kwargs) for url in shard_urls]
+        return [future.result() for future in futures]
+
+
+def _shard_report(responses: list[tuple]) -> dict:
+    failed = [{"shard": url, "error": error} for url, (_, _, error) in zip(SHARD_URLS, responses) if error]
+    return {"queried": len(SHARD_URLS), "failed": failed}
+
+
+def _require_shards():
+    if not SHARD_URLS:
+        raise HTTPException(status_code=503, detail="No shards are configured. Set VIDEOARCHIVE_SHARDS.")
+
+
+def _all_failed(responses: list[tuple]) -> bool:
+    # Shards without an index answer 503; they hold no results, but are no failure of the query.
+    return all(error is not None and status != 503 for status, _, error in responses)
+
+
+@app.post("/search")
+async def search_scene(file: UploadFile = File(...), top_k: int = Query(5, ge=1, le=MAX_TOP_K),
+                       nprobe: int | None = None, ef_search: int | None = None, timings: bool = False):
+    """Searches every shard and merges their re-ranked results into one top-k.
+
+    Each shard embeds the query, searches its own index and re-ranks its own candidates
+    by ORB matches; the coordinator only merges by score. Shards that fail or time out
+    are listed under ``shards.failed`` and left out of the result.
+    """
+    _require_shards()
+    request_start = time.perf_counter()
+    contents = await file.read()
+    params = {"top_k": top_k, "nprobe": nprobe, "ef_search": ef_search, "timings": timings}
+    responses = await run_in_threadpool(
+        _fan_out, "POST", "/search", files={"file": (file.filename or "query", contents, file.content_type)},
+        params={k: v for k, v in params.items() if v is not None},
+    )
+    if _all_failed(responses):
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
+        raise HTTPException(status_code=502, detail="No shard could be searched.")
+
+    with metrics.stage("shard_merge"):
+        result = merge_results([body.get("result", []) for _, body, error in responses if error is None], top_k)
+    metrics.SEARCH_REQUESTS.inc(outcome="ok" if result else "empty")
+    response = {"success": True, "result": result} if result else \
+        {"success": False, "message": "No similar scenes were found."}
+    response["shards"] = _shard_report(responses)
+    if timings:
+        response["timings_ms"] = {"total": round((time.perf_counter() - request_start) * 1000, 2)}
+        response["shard_timings_ms"] = {url: body.get("timings_ms") for url, (_, body, error) in zip(SHARD_URLS, responses)
+                                        if error is None}
+    return response
+
+
+@app.post("/search/batch")
+async def search_batch(files: list[UploadFile] | None = File(None), clip: UploadFile | None = File(None),
+                       top_k: int = Query(5, ge=1, le=MAX_TOP_K), frame_interval: float = 0.5, max_frames: int = 32,
+                       tolerance: float = 3.0,
+                       per_frame: bool = False, nprobe: int | None = None, ef_search: int | None = None):
+    """Searches images or a clip on every shard and votes segments over the merged per-frame hits.
+
+    Every shard samples the clip the same way, so frame ``i`` means the same query frame
+    on each of them.
+    """
+    _require_shards()
+    if not files and clip is None:
+        raise HTTPException(status_code=400, detail="Upload images as 'files' or a video as 'clip'.")
+    uploads = [("clip", (clip.filename or "clip", await clip.read(), clip.content_type))] if clip is not None else \
+        [("files", (f.filename or "image", await f.read(), f.content_type)) for f in files]
+    params = {"top_k": top_k, "frame_interval": frame_interval, "max_frames": max_frames, "per_frame": True,
+              "nprobe": nprobe, "ef_search": ef_search}
+    responses = await run_in_threadpool(
+        _fan_out, "POST", "/search/batch", files=uploads, params={k: v for k, v in params.items() if v is not None},
+    )
+    if all(status == 400 for status, _, _ in responses):
+        # E.g. an unreadable clip, which every shard rejects alike.
+        raise HTTPException(status_code=400, detail=responses[0][2])
+    if _all_failed(responses):
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
+        raise HTTPException(status_code=502, detail="No shard could be searched.")
+
+    with metrics.stage("shard_merge"):
+        shard_frames = [body["frame_results"] for _, body, error in responses if error is None]
+        frame_count = max((len(frames) for frames in shard_frames), default=0)
+        frame_offsets = [None] * frame_count
+        frame_results = []
+        for i in range(frame_count):
+            per_shard = [frames[i] for frames in shard_frames if i < len(frames)]
+            frame_offsets[i] = per_shard[0]["offset"]
+            frame_results.append(merge_results([frame["result"] for frame in per_shard], top_k))
+        offsets = [float(offset) for offset in frame_offsets] if clip is not None else None
+        segments = vote_segments(frame_results, offsets, tolerance_sec=tolerance)
+
+    metrics.SEARCH_REQUESTS.inc(outcome="ok" if segments else "empty")
+    response = {"success": bool(segments), "frames": frame_count, "segments": segments, "shards": _shard_report(responses)}
+    if not segments:
+        response["message"] = "No similar scenes were found."
+    if per_frame:
+        response["frame_results"] = [{"offset": offset, "result": result} for offset, result in zip(frame_offsets, frame_results)]
+    return response
+
+
+@app.post("/index")
+async def trigger_indexing(shard: int | None = None):
+    """Starts an index build on every shard, or only on shard ``shard`` (its position in VIDEOARCHIVE_SHARDS)."""
+    _require_shards()
+    if shard is not None and not 0 <= shard < len(SHARD_URLS):
+        raise HTTPException(status_code=400, detail=f"Unknown shard {shard}. There are {len(SHARD_URLS)} shards.")
+    shard_urls = SHARD_URLS if shard is None else [SHARD_URLS[shard]]
+    responses = await run_in_threadpool(_fan_out, "POST", "/index", shard_urls)
+    return {
+        "success": any(error is None for _, _, error in responses),
+        "shards": [{"shard": url, "status_code": status, "response": body if error is None else None, "error": error}
+                   for url, (status, body, error) in zip(shard_urls, responses)],
+    }
+
+
+@app.get("/index/status")
+async def indexing_status():
+    """Collects the build progress and served generation of every shard."""
+    _require_shards()
+    responses = await run_in_threadpool(_fan_out, "GET", "/index/status")
+    return {"shards": [{"shard": url, "status": body, "error": error}
+                       for url, (_, body, error) in zip(SHARD_URLS, responses)]}
+
+
+@app.get("/ready")
+async def readiness_probe(response: Response):
+    """Readiness probe: 200 once every shard reports ready, 503 with the shards' states before that."""
+    _require_shards()
+    responses = await run_in_threadpool(_fan_out, "GET", "/ready")
+    ready = all(error is None for _, _, error in responses)
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready,
+            "shards": [{"shard": url, "state": body.get("state") if body else None, "error": error}
+                       for url, (_, body, error) in zip(SHARD_URLS, responses)]}
+
+
+@app.get("/preview/{video_id}")
+def scene_preview(video_id: str, timestamp: float = 0.0, kind: str = "thumbnail"):
+    """Thumbnail (JPEG) or short low-bitrate clip (WebM) around a scene, rendered once and then served from the cache."""
+    if kind not in PREVIEW_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(PREVIEW_KINDS)}.")
+    # Like /videos, previews need the video folder on this host.
+    video_path = resolve_video(VIDEO_DIR, video_id)
+    if video_path is None:
+        raise HTTPException(status_code=404, detail=f"Video '{video_id}' not found.")
+    try:
+        with metrics.stage("preview"):
+            path, hit = preview_cache.get(video_path, max(0.0, timestamp), kind)
+    except (IOError, ValueError) as e:
+        metrics.PREVIEW_REQUESTS.inc(kind=kind, outcome="failed")
+        raise HTTPException(status_code=422, detail=str(e))
+    metrics.PREVIEW_REQUESTS.inc(kind=kind, outcome="hit" if hit else "rendered")
+    # Cache entries never change for a given video file, so clients may keep them too.
+    return FileResponse(path, media_type=PREVIEW_KINDS[kind][1], headers={"Cache-Control": "public, max-age=86400"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Fan-out latency and shard outcomes of this coordinator; each shard serves its own /metrics."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/")
+def read_root():
+    return {"message": f"Video Scene Search coordinator for {len(SHARD_URLS)} shards is running."}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,42 @@
+import faiss
+import numpy as np
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.array(vectors, dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def assign_representatives(embeddings: np.ndarray, first_row: int, index: faiss.Index | None,
+                           threshold: float) -> np.ndarray:
+    """Returns the representative row of every new scene embedding.
+
+    New scenes get the rows ``first_row, first_row + 1, ...``. A scene whose cosine similarity
+    to an already indexed vector, or to an earlier new scene, reaches ``threshold`` is
+    represented by that row; every other scene represents itself and gets its own vector.
+    """
+    vectors = _normalized(embeddings)
+    representatives = np.arange(first_row, first_row + len(vectors), dtype=np.int64)
+
+    # Nearest indexed vector of every new scene, compared by cosine on the stored vector.
+    if index is not None and index.ntotal:
+        _, nearest = index.search(np.ascontiguousarray(embeddings, dtype="float32"), 1)
+        found = np.flatnonzero(nearest[:, 0] != -1)
+        if len(found):
+            stored = _normalized(np.stack([index.reconstruct(int(row)) for row in nearest[found, 0]]))
+            similar = (stored * vectors[found]).sum(axis=1) >= threshold
+            representatives[found[similar]] = nearest[found[similar], 0]
+
+    # Greedy clustering of the remaining new scenes, in order, against the new representatives so far.
+    kept = faiss.IndexFlatIP(vectors.shape[1])
+    kept_rows = []
+    for i in np.flatnonzero(representatives == np.arange(first_row, first_row + len(vectors))):
+        if kept.ntotal:
+            similarity, position = kept.search(vectors[i:i + 1], 1)
+            if similarity[0, 0] >= threshold:
+                representatives[i] = kept_rows[position[0, 0]]
+                continue
+        kept.add(vectors[i:i + 1])
+        kept_rows.append(first_row + i)
+    return representatives
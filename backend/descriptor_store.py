@@ -0,0 +1,136 @@
+import os
+import numpy as np
+
+ORB_DESCRIPTOR_BYTES = 32
+COPY_CHUNK_BYTES = 16 * 1024 ** 2
+
+
+def _replace_with_prefix(path: str, size: int):
+    """Replaces ``path`` by a new file holding its first ``size`` bytes.
+
+    Shrinking a file in place would fault readers that have it memory-mapped; after the
+    replace they keep reading the old file until they load the store again.
+    """
+    with open(path, "rb") as src, open(path + ".tmp", "wb") as dst:
+        remaining = size
+        while remaining > 0:
+            chunk = src.read(min(remaining, COPY_CHUNK_BYTES))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+    os.replace(path + ".tmp", path)
+
+
+class DescriptorStore:
+    """Append-only on-disk store of ORB keypoints and descriptors, one entry per FAISS id.
+
+    Entry ``i`` holds the local features of the scene stored at FAISS id ``i``.
+    Descriptors and keypoints of all entries are concatenated into flat files and
+    located through an offsets array, so every file can be memory-mapped read-only.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.offsets_path = os.path.join(store_dir, "offsets.i64")
+        self.descriptors_path = os.path.join(store_dir, "descriptors.u8")
+        self.keypoints_path = os.path.join(store_dir, "keypoints.f32")
+        self._release()
+
+    def _release(self):
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._descriptors = np.empty((0, ORB_DESCRIPTOR_BYTES), dtype=np.uint8)
+        self._keypoints = np.empty((0, 2), dtype=np.float32)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.offsets_path)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    @staticmethod
+    def _memmap(path: str, dtype, shape_tail: tuple = ()) -> np.ndarray:
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape_tail, dtype=np.int64))
+        rows = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        if rows == 0:
+            return np.empty((0, *shape_tail), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(rows, *shape_tail))
+
+    def load(self) -> "DescriptorStore":
+        """Memory-maps the store files read-only."""
+        if not self.exists():
+            return self
+        offsets = self._memmap(self.offsets_path, np.int64)
+        self._offsets = offsets if len(offsets) else np.zeros(1, dtype=np.int64)
+        self._descriptors = self._memmap(self.descriptors_path, np.uint8, (ORB_DESCRIPTOR_BYTES,))
+        self._keypoints = self._memmap(self.keypoints_path, np.float32, (2,))
+        return self
+
+    def offsets(self) -> np.ndarray:
+        """Start of every entry in the flat descriptor file, followed by the end of the last one."""
+        return self._offsets
+
+    def descriptors(self) -> np.ndarray:
+        """Descriptors of every entry, concatenated in entry order (see ``offsets``)."""
+        return self._descriptors[:int(self._offsets[-1])]
+
+    def get(self, idx: int) -> tuple[np.ndarray, np.ndarray] | None:
+        """Returns ``(keypoints_xy, descriptors)`` for an entry, or None if it is empty or unknown."""
+        if idx < 0 or idx >= len(self):
+            return None
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        if end <= start:
+            return None
+        return self._keypoints[start:end], self._descriptors[start:end]
+
+    def reset(self):
+        """Removes every entry from the store."""
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._release()
+        # New files rather than truncated ones, since readers may have the old ones mapped.
+        np.zeros(1, dtype=np.int64).tofile(self.offsets_path + ".tmp")
+        os.replace(self.offsets_path + ".tmp", self.offsets_path)
+        for path in (self.descriptors_path, self.keypoints_path):
+            open(path + ".tmp", "wb").close()
+            os.replace(path + ".tmp", path)
+        self.load()
+
+    def truncate(self, count: int):
+        """Drops every entry from ``count`` onwards, e.g. after an interrupted build."""
+        self.load()
+        if count >= len(self):
+            return
+        end = int(self._offsets[count])
+        offsets = np.array(self._offsets[: count + 1])
+        self._release()
+        # Offsets first, so a reader never sees entries without their descriptors.
+        offsets.tofile(self.offsets_path + ".tmp")
+        os.replace(self.offsets_path + ".tmp", self.offsets_path)
+        _replace_with_prefix(self.descriptors_path, end * ORB_DESCRIPTOR_BYTES)
+        _replace_with_prefix(self.keypoints_path, end * 2 * np.dtype(np.float32).itemsize)
+        self.load()
+
+    def append(self, features: list[tuple[np.ndarray | None, np.ndarray | None]]):
+        """Appends one ``(keypoints_xy, descriptors)`` entry per new FAISS id."""
+        if not self.exists():
+            self.reset()
+        self.load()
+        next_offset = int(self._offsets[-1])
+        new_offsets = []
+        self._release()
+        # Drop any bytes left behind by an append that crashed before its offsets were written.
+        for path, size in ((self.descriptors_path, next_offset * ORB_DESCRIPTOR_BYTES),
+                           (self.keypoints_path, next_offset * 2 * np.dtype(np.float32).itemsize)):
+            if os.path.getsize(path) > size:
+                _replace_with_prefix(path, size)
+        with open(self.descriptors_path, "ab") as des_f, open(self.keypoints_path, "ab") as kp_f:
+            for keypoints_xy, descriptors in features:
+                if descriptors is not None and len(descriptors) > 0:
+                    np.ascontiguousarray(descriptors, dtype=np.uint8).tofile(des_f)
+                    np.ascontiguousarray(keypoints_xy, dtype=np.float32).reshape(-1, 2).tofile(kp_f)
+                    next_offset += len(descriptors)
+                new_offsets.append(next_offset)
+        # Offsets are written last so a crash never exposes half-written entries.
+        with open(self.offsets_path, "ab") as f:
+            np.array(new_offsets, dtype=np.int64).tofile(f)
+        self.load()
@@ -0,0 +1,96 @@
+import json
+import os
+import time
+
+# --- Defaults ---
+# Attempts per video before it is skipped until its file changes
+MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed video; doubles with every further attempt
+RETRY_DELAY = 60.0
+
+
+def file_state(path: str) -> list[int] | None:
+    """``[size, mtime_ns]`` of a file, which changes whenever the file is replaced or rewritten."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class FailedVideos:
+    """Ledger of videos whose indexing failed or was interrupted, with their retry schedule.
+
+    A video is marked ``"indexing"`` when its first scene reaches the embedder and is
+    dropped from the ledger once a published generation contains it. A video still marked
+    ``"indexing"`` was interrupted by a crash; it is retried right away, but the attempt
+    counts, so a file that keeps killing the indexer is eventually skipped. Failed videos
+    are retried after ``retry_delay`` seconds, doubling per attempt, up to ``max_attempts``.
+    Replacing the file starts over.
+    """
+
+    def __init__(self, path: str, max_attempts: int = MAX_ATTEMPTS, retry_delay: float = RETRY_DELAY):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def entries(self) -> dict[str, dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, entries: dict[str, dict]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+    def should_process(self, video: str, state: list[int] | None, now: float | None = None) -> bool:
+        """Whether a not yet indexed video is due for (another) attempt."""
+        entry = self.entries().get(video)
+        if entry is None or entry["file"] != state:
+            return True
+        if entry["attempts"] >= self.max_attempts:
+            return False
+        if entry["state"] == "indexing":
+            return True
+        retry_at = entry["last_attempt"] + self.retry_delay * 2 ** (entry["attempts"] - 1)
+        return (now if now is not None else time.time()) >= retry_at
+
+    def due(self, states: dict[str, list[int]], now: float | None = None) -> list[str]:
+        """Videos of ``states`` (name to file state) with a failed or interrupted attempt that are due for a retry."""
+        return [video for video in self.entries()
+                if video in states and self.should_process(video, list(states[video]), now)]
+
+    def started(self, video: str, state: list[int] | None):
+        entries = self.entries()
+        entry = entries.get(video)
+        attempts = entry["attempts"] if entry is not None and entry["file"] == state else 0
+        entries[video] = {"state": "indexing", "file": state, "attempts": attempts + 1, "last_attempt": time.time(),
+                          "error": "Interrupted while indexing."}
+        self._save(entries)
+
+    def failed(self, video: str, error: str, state: list[int] | None = None):
+        entries = self.entries()
+        entry = entries.get(video)
+        if entry is None or entry["file"] != state:
+            entry = {"file": state, "attempts": 1, "last_attempt": time.time()}
+        entries[video] = {**entry, "state": "failed", "error": error}
+        self._save(entries)
+        if entry["attempts"] >= self.max_attempts:
+            print(f"⛔ '{video}' failed {entry['attempts']} times and is skipped until the file changes.")
+
+    def succeeded(self, videos: list[str]):
+        entries = self.entries()
+        done = set(videos) & entries.keys()
+        if done:
+            self._save({video: entry for video, entry in entries.items() if video not in done})
+
+    def retain(self, videos: set[str]):
+        """Drops every entry except those of ``videos``, e.g. the videos that are still not indexed."""
+        entries = self.entries()
+        kept = {video: entry for video, entry in entries.items() if video in videos}
+        if len(kept) != len(entries):
+            self._save(kept)
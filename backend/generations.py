@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+import time
+
+import faiss
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class BuildInProgressError(RuntimeError):
+    """Raised when another process or thread is already building the index."""
+
+
+class BuildLock:
+    """Exclusive, non-blocking lock on a file, held while an index build runs.
+
+    The lock is taken through the OS (``flock`` / ``msvcrt.locking``), so it is shared by
+    every uvicorn worker and command-line build, and released if the holder dies.
+
+    The holder also keeps an exclusive lock on ``<path>.held``, which ``is_held`` probes
+    with a shared one. Probing never touches the build lock itself, so a status request
+    cannot make a starting build fail.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.probe_path = path + ".held"
+        self._file = None
+        self._probe_file = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        if fcntl is not None:
+            # Blocks at most for the moment a concurrent is_held() holds its shared lock.
+            self._probe_file = open(self.probe_path, "a+")
+            fcntl.flock(self._probe_file.fileno(), fcntl.LOCK_EX)
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if self._probe_file is not None:
+            fcntl.flock(self._probe_file.fileno(), fcntl.LOCK_UN)
+            self._probe_file.close()
+            self._probe_file = None
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def is_held(self) -> bool:
+        """Whether some build currently holds the lock."""
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            # msvcrt has no shared locks, so Windows probes the build lock itself.
+            if not self.acquire():
+                return True
+            self.release()
+            return False
+        os.makedirs(os.path.dirname(self.probe_path), exist_ok=True)
+        with open(self.probe_path, "a+") as probe_file:
+            try:
+                fcntl.flock(probe_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(probe_file.fileno(), fcntl.LOCK_UN)
+        return False
+
+    def __enter__(self) -> "BuildLock":
+        if not self.acquire():
+            raise BuildInProgressError("An index build is already running.")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class IndexGenerations:
+    """Immutable, numbered index generations in one directory.
+
+    A build writes ``gen-<n>/index.faiss`` and its ``manifest.json`` and only then points
+    ``CURRENT`` at the new generation with an atomic rename, so readers always open a
+    complete index. The scene mapping and descriptor store are append-only and shared by
+    every generation; the manifest records how many scene rows the generation covers.
+    Only the newest ``keep`` generations are kept on disk.
+    """
+
+    def __init__(self, root_dir: str, keep: int = 3):
+        self.root_dir = root_dir
+        self.keep = keep
+        self.current_path = os.path.join(root_dir, "CURRENT")
+        self.status_path = os.path.join(root_dir, "build_status.json")
+        self.lock = BuildLock(os.path.join(root_dir, "build.lock"))
+
+    def _generation_dir(self, generation: int) -> str:
+        return os.path.join(self.root_dir, f"gen-{generation:06d}")
+
+    def index_path(self, generation: int) -> str:
+        return os.path.join(self._generation_dir(generation), "index.faiss")
+
+    def attachment_path(self, generation: int, name: str) -> str:
+        """``.npy`` file of an array published with a generation (see ``publish``)."""
+        return os.path.join(self._generation_dir(generation), f"{name}.npy")
+
+    @staticmethod
+    def _write_json(path: str, data):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def current_generation(self) -> int | None:
+        """Number of the active generation, or None before the first one is published."""
+        try:
+            with open(self.current_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def manifest(self, generation: int) -> dict:
+        with open(os.path.join(self._generation_dir(generation), "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def current(self) -> dict | None:
+        """Manifest of the active generation."""
+        generation = self.current_generation()
+        return self.manifest(generation) if generation is not None else None
+
+    def publish(self, index: faiss.Index, attachments: dict[str, np.ndarray] | None = None, **manifest) -> dict:
+        """Writes ``index`` as the next generation and makes it the active one.
+
+        ``attachments`` are arrays that belong to this generation only, such as derived
+        search structures; they are saved next to the index and can be memory-mapped.
+        """
+        generation = (self.current_generation() or 0) + 1
+        generation_dir = self._generation_dir(generation)
+        # Leftovers of a build that died before switching CURRENT are simply overwritten.
+        shutil.rmtree(generation_dir, ignore_errors=True)
+        os.makedirs(generation_dir)
+        faiss.write_index(index, self.index_path(generation))
+        for name, array in (attachments or {}).items():
+            np.save(self.attachment_path(generation, name), array)
+        manifest = {"generation": generation, "created_at": time.time(), "vectors": int(index.ntotal),
+                    "attachments": sorted(attachments or {}), **manifest}
+        self._write_json(os.path.join(generation_dir, "manifest.json"), manifest)
+
+        with open(self.current_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(generation))
+        os.replace(self.current_path + ".tmp", self.current_path)
+        self._prune(generation)
+        return manifest
+
+    def _prune(self, current: int):
+        # Workers still serving an older generation keep their open (memory-mapped) file alive.
+        for name in os.listdir(self.root_dir):
+            if name.startswith("gen-") and int(name[4:]) <= current - self.keep:
+                shutil.rmtree(os.path.join(self.root_dir, name), ignore_errors=True)
+
+    def read_status(self) -> dict:
+        try:
+            with open(self.status_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"state": "idle"}
+
+    def write_status(self, **status):
+        """Records build progress where every worker process can read it."""
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._write_json(self.status_path, {**status, "updated_at": time.time()})
@@ -0,0 +1,157 @@
+import math
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# --- Defaults ---
+IVF_MAX_NLIST = 4096
+PQ_SUBVECTOR_DIM = 16  # 768-d ViT embeddings -> 48 sub-quantizers
+PQ_NBITS = 8
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+# Retrain an IVF index once its size calls for this many times the lists it was trained with
+RETRAIN_NLIST_GROWTH = 4
+
+
+def default_nlist(num_vectors: int) -> int:
+    """Number of IVF cells for a training set of the given size (~4 * sqrt(n))."""
+    return max(1, min(IVF_MAX_NLIST, int(4 * math.sqrt(max(num_vectors, 1)))))
+
+
+def min_training_size(index_type: str, nlist: int | None = None) -> int:
+    """Smallest number of vectors the given index type can be trained on."""
+    if index_type == "ivf_flat":
+        return nlist or 1
+    if index_type == "ivf_pq":
+        return max(nlist or 1, 2 ** PQ_NBITS)
+    return 0
+
+
+def needs_retraining(index: faiss.Index) -> bool:
+    """Whether an IVF index has outgrown the lists it was trained with.
+
+    ``nlist`` and the centroids come from the training set of the first build, which may be
+    tiny; appended vectors then crowd into a few badly placed lists.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    return ivf is not None and default_nlist(index.ntotal) >= RETRAIN_NLIST_GROWTH * ivf.nlist
+
+
+def create_index(index_type: str, dimension: int, training_vectors: np.ndarray | None = None,
+                 nlist: int | None = None) -> faiss.Index:
+    """Creates an empty, trained index of the given type that accepts ``add_with_ids``.
+
+    IVF indexes are trained on ``training_vectors`` and keep their own ids; flat and
+    HNSW indexes are wrapped in an ``IndexIDMap2`` so ids stay stable across appends.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Expected one of {INDEX_TYPES}.")
+
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    if index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = DEFAULT_EF_SEARCH
+        return faiss.IndexIDMap2(hnsw)
+
+    if training_vectors is None or len(training_vectors) == 0:
+        raise ValueError(f"Index type '{index_type}' needs training vectors.")
+    training_vectors = np.ascontiguousarray(training_vectors, dtype="float32")
+    nlist = nlist or default_nlist(len(training_vectors))
+    if len(training_vectors) < min_training_size(index_type, nlist):
+        raise ValueError(
+            f"Index type '{index_type}' needs at least {min_training_size(index_type, nlist)} "
+            f"training vectors, got {len(training_vectors)}."
+        )
+
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    else:
+        pq_m = max(1, dimension // PQ_SUBVECTOR_DIM)
+        while dimension % pq_m:
+            pq_m -= 1
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, PQ_NBITS)
+    index.train(training_vectors)
+    index.nprobe = min(DEFAULT_NPROBE, nlist)
+    # A hashtable direct map lets us reconstruct and remove vectors by id.
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+def index_type_of(index: faiss.Index) -> str:
+    """Returns the ``INDEX_TYPES`` name of an index, looking through id maps."""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    return "flat"
+
+
+def index_ids(index: faiss.Index) -> np.ndarray:
+    """Returns the ids of everything stored in an index of any supported type.
+
+    For id maps the order matches the storage order of the wrapped index.
+    """
+    if index.ntotal == 0:
+        return np.empty(0, dtype="int64")
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(index.id_map).astype("int64")
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        ids = np.concatenate([
+            faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+            for list_no in range(ivf.nlist)
+            if invlists.list_size(list_no) > 0
+        ]).astype("int64")
+        ids.sort()
+        return ids
+    # Legacy positional index: the position is the id.
+    return np.arange(index.ntotal, dtype="int64")
+
+
+def export_vectors(index: faiss.Index) -> tuple[np.ndarray, np.ndarray]:
+    """Returns ``(ids, vectors)`` of everything stored in an index of any supported type.
+
+    Vectors from PQ indexes are the lossy reconstructions.
+    """
+    ids = index_ids(index)
+    if len(ids) == 0:
+        return ids, np.empty((0, index.d), dtype="float32")
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return ids, faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+    if faiss.try_extract_index_ivf(index) is not None:
+        return ids, index.reconstruct_batch(ids)
+    return ids, index.reconstruct_n(0, index.ntotal)
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """Reads an index, optionally memory-mapping its vector data read-only.
+
+    Memory-mapped indexes keep their codes in the page cache, so several processes
+    serving the same file share one copy. They must not be modified.
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    # IO_FLAG_MMAP_IFC maps flat codes (flat, HNSW storage, IVF lists); older builds only map IVF lists.
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(path, flags)
+
+
+def search_params(index: faiss.Index, nprobe: int | None = None, ef_search: int | None = None):
+    """Builds per-query search parameters for the index type, or None to use its defaults."""
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq") and nprobe:
+        return faiss.SearchParametersIVF(nprobe=int(nprobe))
+    if index_type == "hnsw" and ef_search:
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search))
+    return None
@@ -1,14 +1,28 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
 import uvicorn
 from PIL import Image
 import io
 import traceback
 import os
+import time
+import tempfile
+import asyncio
 
-from .search_engine import SearchEngine
-from .video_processor import build_index
+# The search engine (torch, transformers) is imported by the background loader after
+# startup, so the server answers /ready and /index/status within moments of starting.
+from .batcher import SearchBatcher
+from .query_cache import QueryCache
+from .video_processor import build_index, data_paths
+from .generations import IndexGenerations, BuildInProgressError
+from .failed_videos import FailedVideos
+from . import metrics
+from .clip_search import sample_clip_frames
+from .shards import parse_shard
+from .previews import PreviewCache, resolve_video, KINDS as PREVIEW_KINDS
 
 app = FastAPI()
 
@@ -22,68 +36,352 @@ app.add_middleware(
 )
 
 VIDEO_DIR = os.path.join(os.path.dirname(__file__), "videos")
+# Serving options; serve.py sets them for multi-worker deployments
+MMAP_INDEX = os.environ.get("VIDEOARCHIVE_MMAP_INDEX", "0") == "1"
+TORCH_THREADS = int(os.environ.get("VIDEOARCHIVE_TORCH_THREADS", "0"))
+# Embedding model: fine-tuned ViT weights and inference backend ("eager", "int8" or "torchscript")
+MODEL_PATH = os.environ.get("VIDEOARCHIVE_MODEL_PATH") or None
+INFERENCE_BACKEND = os.environ.get("VIDEOARCHIVE_INFERENCE_BACKEND", "eager")
+# Concurrent /search requests arriving within the window are searched as one batch
+MAX_BATCH_SIZE = int(os.environ.get("VIDEOARCHIVE_MAX_BATCH_SIZE", "16"))
+BATCH_WAIT_MS = float(os.environ.get("VIDEOARCHIVE_BATCH_WAIT_MS", "5"))
+# Query cache: entries, time-to-live in seconds, and opt-in perceptual (re-encoded copy) matching
+CACHE_SIZE = int(os.environ.get("VIDEOARCHIVE_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.environ.get("VIDEOARCHIVE_CACHE_TTL", "3600"))
+CACHE_PERCEPTUAL = os.environ.get("VIDEOARCHIVE_CACHE_PERCEPTUAL", "0") == "1"
+# Seconds between checks for a new index generation published by any process
+RELOAD_INTERVAL = float(os.environ.get("VIDEOARCHIVE_RELOAD_INTERVAL", "2"))
+# Index builds: cosine similarity at which near-identical scenes share one vector (unset: off)
+DEDUP_THRESHOLD = float(os.environ["VIDEOARCHIVE_DEDUP_THRESHOLD"]) if os.environ.get("VIDEOARCHIVE_DEDUP_THRESHOLD") else None
+# Re-ranking: scenes taken from the visual-word inverted file, and scenes that get exact ORB matching
+VISUAL_WORD_CANDIDATES = int(os.environ.get("VIDEOARCHIVE_VISUAL_WORD_CANDIDATES", "200"))
+RERANK_SHORTLIST = int(os.environ.get("VIDEOARCHIVE_RERANK_SHORTLIST", "20"))
+# /search/batch: most images or sampled clip frames per call
+MAX_QUERY_FRAMES = int(os.environ.get("VIDEOARCHIVE_MAX_QUERY_FRAMES", "64"))
+# Largest top_k a request may ask for; every result is re-ranked inside the shared batch
+MAX_TOP_K = int(os.environ.get("VIDEOARCHIVE_MAX_TOP_K", "100"))
+# Shard servers: index directory (unset: backend/) and "<index>/<count>" of the videos it indexes
+DATA_DIR = os.path.abspath(os.environ["VIDEOARCHIVE_DATA_DIR"]) if os.environ.get("VIDEOARCHIVE_DATA_DIR") else None
+SHARD = parse_shard(os.environ["VIDEOARCHIVE_SHARD"]) if os.environ.get("VIDEOARCHIVE_SHARD") else None
+# /preview: on-disk cache size for thumbnails and preview clips, in MB
+PREVIEW_CACHE_MB = float(os.environ.get("VIDEOARCHIVE_PREVIEW_CACHE_MB", "2048"))
+# /metrics: directory shared by the workers of one server (serve.py sets it); unset: this process only
+METRICS_DIR = os.environ.get("VIDEOARCHIVE_METRICS_DIR") or None
 app.mount("/videos", StaticFiles(directory=VIDEO_DIR), name="videos")
 
-search_engine: SearchEngine | None = None
+search_engine: "SearchEngine | None" = None
+generation_watcher: asyncio.Task | None = None
+# "starting", "loading", "ready" or "failed", reported by /ready
+readiness = {"state": "starting", "started_at": time.time(), "ready_at": None, "error": None}
+index_generations = IndexGenerations(data_paths(DATA_DIR)["generations_dir"])
+failed_videos = FailedVideos(data_paths(DATA_DIR)["failures_path"])
+preview_cache = PreviewCache(data_paths(DATA_DIR)["preview_dir"], max_bytes=int(PREVIEW_CACHE_MB * 1024 ** 2))
+query_cache = QueryCache(max_entries=CACHE_SIZE, ttl_seconds=CACHE_TTL, perceptual=CACHE_PERCEPTUAL)
 
-@app.on_event("startup")
-async def startup_event():
-    """Initializes the SearchEngine when the application starts."""
+
+def _update_gauges():
+    engine = search_engine
+    if engine is not None:
+        metrics.INDEX_GENERATION.set(engine.generation or 0)
+        metrics.INDEX_VECTORS.set(engine.faiss_index.ntotal if engine.faiss_index is not None else 0)
+    for stat, value in query_cache.stats().items():
+        metrics.QUERY_CACHE.set(value, stat=stat)
+
+
+shared_metrics = metrics.SharedMetrics(METRICS_DIR, metrics.REGISTRY, before_flush=_update_gauges) if METRICS_DIR else None
+
+
+def _search_batch(images, **options):
+    """Runs a batch against whichever search engine is current, so reloads apply to the next batch."""
+    engine = search_engine
+    if engine is None:
+        raise RuntimeError("Faiss index is not loaded.")
+    return engine.search_batch(images, **options)
+
+
+search_batcher = SearchBatcher(_search_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS)
+
+
+def _create_search_engine() -> "SearchEngine":
+    from .models import VIT_ALLOW_DOWNLOAD
+    from .search_engine import SearchEngine
+
+    paths = data_paths(DATA_DIR)
+    return SearchEngine(scene_mapping_dir=paths["mapping_dir"], descriptor_store_dir=paths["descriptor_store_dir"],
+                        generations_dir=paths["generations_dir"], legacy_mapping_path=paths["legacy_mapping_path"],
+                        legacy_index_path=paths["legacy_index_path"], mmap=MMAP_INDEX, query_cache=query_cache,
+                        model_path=MODEL_PATH, inference_backend=INFERENCE_BACKEND,
+                        visual_word_candidates=VISUAL_WORD_CANDIDATES, rerank_shortlist=RERANK_SHORTLIST,
+                        # Servers start from the pinned snapshot only, so a missing one fails /ready.
+                        require_snapshot=not VIT_ALLOW_DOWNLOAD)
+
+
+def _load_image(contents: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(contents))
+    image.load()
+    return image
+
+
+async def _watch_generations():
+    """Switches to index generations published by other workers or command-line builds."""
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        if search_engine is None:
+            continue
+        try:
+            await run_in_threadpool(search_engine.reload)
+        except Exception as e:
+            print(f"Failed to load the new index generation: {e}")
+
+def _load_search_engine():
+    """Imports and loads the models and the index off the event loop, recording the progress for /ready."""
     global search_engine
+    readiness["state"] = "loading"
     try:
-        search_engine = SearchEngine()
-        print("SearchEngine initialized successfully.")
+        if TORCH_THREADS:
+            import torch
+            torch.set_num_threads(TORCH_THREADS)
+        engine = _create_search_engine()
     except Exception as e:
+        traceback.print_exc()
         print(f"Failed to initialize SearchEngine: {e}")
-        search_engine = None
+        readiness.update(state="failed", error=str(e))
+        return
+    if search_engine is None:
+        search_engine = engine
+    readiness.update(state="ready", ready_at=time.time())
+    print(f"SearchEngine initialized in {readiness['ready_at'] - readiness['started_at']:.1f}s." if SHARD is None else
+          f"SearchEngine initialized in {readiness['ready_at'] - readiness['started_at']:.1f}s for shard {SHARD[0]}/{SHARD[1]}.")
+
+@app.on_event("startup")
+async def startup_event():
+    """Starts loading the SearchEngine in the background; /ready reports when it can serve."""
+    global generation_watcher
+    search_batcher.start()
+    if shared_metrics is not None:
+        shared_metrics.start()
+    # Not awaited: _load_search_engine records its outcome, including failures, for /ready.
+    asyncio.get_running_loop().run_in_executor(None, _load_search_engine)
+    generation_watcher = asyncio.get_running_loop().create_task(_watch_generations())
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Placeholder for any cleanup on shutdown."""
+    """Stops the search batcher on shutdown."""
+    if generation_watcher is not None:
+        generation_watcher.cancel()
+    await search_batcher.stop()
     print("Application shutting down.")
 
 @app.post("/search")
-async def search_scene(file: UploadFile = File(...)):
-    """Handles the image search request."""
+async def search_scene(file: UploadFile = File(...), top_k: int = Query(5, ge=1, le=MAX_TOP_K),
+                       nprobe: int | None = None, ef_search: int | None = None, timings: bool = False):
+    """Handles the image search request.
+
+    ``top_k`` caps the re-ranked results. ``nprobe`` (IVF indexes) and ``ef_search`` (HNSW indexes) optionally override the
+    speed/recall tradeoff for this query. ``timings=true`` adds a per-stage breakdown
+    (``timings_ms``) to the response.
+    """
     if search_engine is None:
+        metrics.SEARCH_REQUESTS.inc(outcome="unavailable")
         raise HTTPException(status_code=503, detail="The server is not yet ready. Please check the index.")
 
+    request_start = time.perf_counter()
+    stage_timings = {}
     try:
         contents = await file.read()
-        query_image = Image.open(io.BytesIO(contents))
+        decode_start = time.perf_counter()
+        query_image = await run_in_threadpool(_load_image, contents)
+        stage_timings["decode"] = time.perf_counter() - decode_start
+        metrics.STAGE_SECONDS.observe(stage_timings["decode"], stage="decode")
 
-        result = search_engine.search(query_image)
+        # Inference runs off the event loop, batched with concurrent requests.
+        result = await search_batcher.submit(query_image, timings=stage_timings, top_k=top_k, nprobe=nprobe,
+                                             ef_search=ef_search)
 
-        if result:
-            return {"success": True, "result": result}
-        else:
-            return {"success": False, "message": "No similar scenes were found."}
+        stage_timings["total"] = time.perf_counter() - request_start
+        metrics.STAGE_SECONDS.observe(stage_timings["total"], stage="request_total")
+        metrics.SEARCH_REQUESTS.inc(outcome="ok" if result else "empty")
+        response = {"success": True, "result": result} if result else \
+            {"success": False, "message": "No similar scenes were found."}
+        if timings:
+            batch_size = stage_timings.pop("batch_size", None)
+            response["timings_ms"] = {name: round(seconds * 1000, 2) for name, seconds in stage_timings.items()}
+            response["batch_size"] = batch_size
+        return response
 
     except RuntimeError as e:
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"An error occurred during the search: {e}")
+
+def _sample_clip(contents: bytes, filename: str, interval_sec: float, max_frames: int):
+    suffix = os.path.splitext(filename or "")[1] or ".mp4"
+    # OpenCV only decodes from a file path.
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        f.write(contents)
+    try:
+        return sample_clip_frames(f.name, interval_sec=interval_sec, max_frames=max_frames)
+    finally:
+        os.remove(f.name)
+
+
+@app.post("/search/batch")
+async def search_batch(files: list[UploadFile] | None = File(None), clip: UploadFile | None = File(None),
+                       top_k: int = Query(5, ge=1, le=MAX_TOP_K), frame_interval: float = 0.5, max_frames: int = 32,
+                       tolerance: float = 3.0,
+                       per_frame: bool = False, nprobe: int | None = None, ef_search: int | None = None):
+    """Searches many images, or frames sampled from a short clip, in one call.
+
+    All frames are embedded in one batch and searched with one multi-row FAISS query. Their
+    hits are voted into ranked video segments; for a clip only hits whose timestamps agree
+    with the frames' spacing in the clip (within ``tolerance`` seconds) reinforce each other.
+    ``per_frame=true`` also returns the result list of every frame.
+    """
+    if search_engine is None:
+        raise HTTPException(status_code=503, detail="The server is not yet ready. Please check the index.")
+    if not files and clip is None:
+        raise HTTPException(status_code=400, detail="Upload images as 'files' or a video as 'clip'.")
+    max_frames = max(1, min(max_frames, MAX_QUERY_FRAMES))
+
+    try:
+        if clip is not None:
+            sampled = await run_in_threadpool(_sample_clip, await clip.read(), clip.filename, frame_interval, max_frames)
+            if not sampled:
+                raise HTTPException(status_code=400, detail="No frames could be read from the clip.")
+            offsets = [offset for offset, _ in sampled]
+            images = [image for _, image in sampled]
+        else:
+            if len(files) > MAX_QUERY_FRAMES:
+                raise HTTPException(status_code=400, detail=f"At most {MAX_QUERY_FRAMES} images per call.")
+            offsets = None
+            images = [await run_in_threadpool(_load_image, await f.read()) for f in files]
+
+        segments, frame_results = await run_in_threadpool(
+            search_engine.search_segments, images, offsets, top_k, nprobe, ef_search, tolerance
+        )
+        metrics.SEARCH_REQUESTS.inc(outcome="ok" if segments else "empty")
+        response = {"success": bool(segments), "frames": len(images), "segments": segments}
+        if not segments:
+            response["message"] = "No similar scenes were found."
+        if per_frame:
+            response["frame_results"] = [
+                {"offset": f"{offsets[i]:.2f}" if offsets is not None else None, "result": result}
+                for i, result in enumerate(frame_results)
+            ]
+        return response
+
+    except HTTPException:
+        raise
+    except (RuntimeError, IOError) as e:
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        metrics.SEARCH_REQUESTS.inc(outcome="error")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"An error occurred during the search: {e}")
 
 @app.post("/index")
 async def trigger_indexing(background_tasks: BackgroundTasks):
     """Triggers the video indexing process in the background."""
+    if index_generations.lock.is_held():
+        raise HTTPException(status_code=409, detail="An index build is already running. See /index/status.")
     background_tasks.add_task(build_index_and_reload)
     return {"success": True, "message": "Video indexing has started in the background."}
 
 def build_index_and_reload():
-    """Function to run indexing and reload the search engine."""
+    """Function to run indexing and switch the search engine to the new generation."""
     global search_engine
     try:
-        build_index()
-        # Re-initialize the search engine to load the new index
-        search_engine = SearchEngine()
-        print("Search engine reloaded with the new index.")
+        if search_engine is not None:
+            # The loaded embedder is reused, so scenes and queries share weights and backend.
+            manifest = build_index(feature_extractor=search_engine.feature_extractor, dedup_threshold=DEDUP_THRESHOLD,
+                                   data_dir=DATA_DIR, shard=SHARD)
+        else:
+            manifest = build_index(model_path=MODEL_PATH, inference_backend=INFERENCE_BACKEND, dedup_threshold=DEDUP_THRESHOLD,
+                                   data_dir=DATA_DIR, shard=SHARD)
+        if search_engine is None:
+            if readiness["state"] == "failed":
+                _load_search_engine()
+        elif manifest is not None:
+            # Only the index files are swapped; the loaded models are reused.
+            search_engine.reload()
+    except BuildInProgressError as e:
+        print(f"Indexing skipped: {e}")
     except Exception as e:
         traceback.print_exc()
         print(f"An error occurred during indexing: {e}")
 
 
+@app.get("/index/status")
+def indexing_status():
+    """Reports build progress and the index generation this worker is serving."""
+    return {
+        "build": index_generations.read_status(),
+        "build_running": index_generations.lock.is_held(),
+        "current_generation": index_generations.current_generation(),
+        "serving_generation": search_engine.generation if search_engine is not None else None,
+        "shard": f"{SHARD[0]}/{SHARD[1]}" if SHARD is not None else None,
+        "manifest": index_generations.current(),
+        "failed_videos": failed_videos.entries(),
+    }
+
+
+@app.get("/ready")
+def readiness_probe(response: Response):
+    """Readiness probe: 200 once the models are warm and an index is served, 503 with the state before that."""
+    engine = search_engine
+    state = readiness["state"]
+    if state == "ready" and (engine is None or engine.faiss_index is None):
+        state = "no_index"
+    if state != "ready":
+        response.status_code = 503
+    return {
+        "ready": state == "ready",
+        "state": state,
+        "error": readiness["error"],
+        "seconds_to_ready": readiness["ready_at"] - readiness["started_at"] if readiness["ready_at"] else None,
+        "load_seconds": engine.load_seconds if engine is not None else None,
+        "serving_generation": engine.generation if engine is not None else None,
+    }
+
+
+@app.get("/preview/{video_id}")
+def scene_preview(video_id: str, timestamp: float = 0.0, kind: str = "thumbnail"):
+    """Thumbnail (JPEG) or short low-bitrate clip (WebM) around a scene, rendered once and then served from the cache."""
+    if kind not in PREVIEW_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(PREVIEW_KINDS)}.")
+    video_path = resolve_video(VIDEO_DIR, video_id)
+    if video_path is None:
+        raise HTTPException(status_code=404, detail=f"Video '{video_id}' not found.")
+    try:
+        with metrics.stage("preview"):
+            path, hit = preview_cache.get(video_path, max(0.0, timestamp), kind)
+    except (IOError, ValueError) as e:
+        metrics.PREVIEW_REQUESTS.inc(kind=kind, outcome="failed")
+        raise HTTPException(status_code=422, detail=str(e))
+    metrics.PREVIEW_REQUESTS.inc(kind=kind, outcome="hit" if hit else "rendered")
+    # Cache entries never change for a given video file, so clients may keep them too.
+    return FileResponse(path, media_type=PREVIEW_KINDS[kind][1], headers={"Cache-Control": "public, max-age=86400"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Stage latency histograms and counters in the Prometheus text format, summed over all workers of a serve.py server."""
+    if shared_metrics is not None:
+        return PlainTextResponse(shared_metrics.render(), media_type="text/plain; version=0.0.4")
+    _update_gauges()
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Reports query cache hit/miss counters and sizes."""
+    return query_cache.stats()
+
+
 @app.get("/")
 def read_root():
     return {"message": "Video Scene Search API is running."}
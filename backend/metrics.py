@@ -0,0 +1,238 @@
+import copy
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers sub-millisecond FAISS searches up to minute-long video decodes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock):
+        self.name = name
+        self.help_text = help_text
+        self._lock = lock
+        self._values: dict[tuple, object] = {}
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return self._header() + [f"{self.name}{_label_text(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, lock)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for key, series in self._values.items():
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{_label_text(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_label_text(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    """Process-wide metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: list[_Metric] = []
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(name, help_text, self._lock))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._add(Gauge(name, help_text, self._lock))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, self._lock, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [line for metric in self._metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """JSON-serializable copy of every metric's series."""
+        with self._lock:
+            return {metric.name: [[[list(pair) for pair in key], copy.deepcopy(value)] for key, value in metric._values.items()]
+                    for metric in self._metrics}
+
+    def render_merged(self, snapshots: dict[str, dict], live_workers: set[str]) -> str:
+        """Renders the sum of several processes' snapshots.
+
+        Counters and histograms are added up. Gauges are per process, so they get a
+        ``worker`` label and are only kept for ``live_workers``.
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            merged = copy.copy(metric)
+            merged._values = {}
+            for worker, snapshot in snapshots.items():
+                if metric.kind == "gauge" and worker not in live_workers:
+                    continue
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(tuple(pair) for pair in key)
+                    if metric.kind == "gauge":
+                        merged._values[key + (("worker", worker),)] = value
+                    elif metric.kind == "counter":
+                        merged._values[key] = merged._values.get(key, 0) + value
+                    else:
+                        series = merged._values.setdefault(key, {"buckets": [0] * len(metric.buckets), "sum": 0.0, "count": 0})
+                        series["buckets"] = [a + b for a, b in zip(series["buckets"], value["buckets"])]
+                        series["sum"] += value["sum"]
+                        series["count"] += value["count"]
+            lines.extend(merged.render())
+        return "\n".join(lines) + "\n"
+
+
+class SharedMetrics:
+    """Aggregates a registry over the worker processes of one server through a shared directory.
+
+    Every worker writes a snapshot of its registry to ``<directory>/<pid>.json`` every
+    ``interval`` seconds and before it renders; ``render`` sums all snapshots, so any
+    worker can answer a scrape and counters never go backwards. Snapshots of exited
+    workers are kept for their counters and histograms; their gauges are dropped once the
+    snapshot is older than three intervals. The directory must be new for every server
+    start (``serve.py`` creates one).
+    """
+
+    def __init__(self, directory: str, registry: Registry, interval: float = 2.0, before_flush=None):
+        self.directory = directory
+        self.registry = registry
+        self.interval = interval
+        self.before_flush = before_flush
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+        self._thread = None
+
+    def flush(self):
+        if self.before_flush is not None:
+            self.before_flush()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def start(self):
+        def run():
+            while True:
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Failed to write the metrics snapshot: {e}")
+                time.sleep(self.interval)
+
+        self._thread = threading.Thread(target=run, name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    def render(self) -> str:
+        self.flush()
+        snapshots, live_workers = {}, set()
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            worker = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots[worker] = json.load(f)
+                if now - os.path.getmtime(path) <= 3 * self.interval:
+                    live_workers.add(worker)
+            except (OSError, ValueError):
+                continue
+        return self.registry.render_merged(snapshots, live_workers)
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("videoarchive_stage_seconds", "Time spent per search and indexing stage.")
+SEARCH_REQUESTS = REGISTRY.counter("videoarchive_search_requests_total", "Search requests by outcome.")
+SEARCH_BATCH_SIZE = REGISTRY.histogram("videoarchive_search_batch_size", "Queries searched per batch.", COUNT_BUCKETS)
+SEARCH_CANDIDATES = REGISTRY.histogram("videoarchive_search_candidates", "Candidates re-ranked by exact ORB matching per query.", COUNT_BUCKETS)
+VISUAL_WORD_CANDIDATES = REGISTRY.histogram("videoarchive_visual_word_candidates",
+                                            "Scenes scored through the visual-word inverted file per query.", COUNT_BUCKETS)
+INDEXED_VIDEOS = REGISTRY.counter("videoarchive_indexed_videos_total", "Videos processed by index builds, by outcome.")
+SCENES_PER_VIDEO = REGISTRY.histogram("videoarchive_scenes_per_video", "Scenes detected per indexed video.", COUNT_BUCKETS)
+INDEX_BUILDS = REGISTRY.counter("videoarchive_index_builds_total", "Index builds by outcome.")
+INDEX_GENERATION = REGISTRY.gauge("videoarchive_index_generation", "Index generation this worker serves.")
+INDEX_VECTORS = REGISTRY.gauge("videoarchive_index_vectors", "Vectors in the served index.")
+QUERY_CACHE = REGISTRY.gauge("videoarchive_query_cache", "Query cache counters and sizes, by stat.")
+PREVIEW_REQUESTS = REGISTRY.counter("videoarchive_preview_requests_total", "Preview requests by kind and outcome.")
+SHARD_REQUESTS = REGISTRY.counter("videoarchive_shard_requests_total", "Coordinator requests to shards, by shard and outcome.")
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name: str):
+    """Times a block into ``videoarchive_stage_seconds`` and into active ``collect_timings`` on this thread."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def collect_timings():
+    """Collects the ``stage`` timings of this thread into a ``{stage: seconds}`` dict."""
+    previous = getattr(_local, "timings", None)
+    _local.timings = {}
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
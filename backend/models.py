@@ -1,3 +1,6 @@
+import os
+import re
+import warnings
 import torch
 from PIL import Image
 from transformers import ViTImageProcessor, ViTModel
@@ -5,30 +8,157 @@ import cv2
 import numpy as np
 from typing import Tuple, List
 
+from . import metrics
+
+# "eager": fp32 PyTorch; "int8": dynamically quantized Linear layers (CPU);
+# "torchscript": traced and frozen graph
+INFERENCE_BACKENDS = ("eager", "int8", "torchscript")
+VIT_INPUT_SIZE = 224
+# Pretrained ViT. Servers load it from a local snapshot (filled once by `python -m backend.models`,
+# e.g. while building the image) so startup never resolves anything over the network.
+VIT_MODEL_ID = "google/vit-base-patch16-224"
+# Pinned hub commit (the one transformers' image-classification pipeline pins for this model).
+# The snapshot records the full commit it was downloaded from; a snapshot of another commit is refused.
+VIT_REVISION = os.environ.get("VIDEOARCHIVE_VIT_REVISION", "3f49326")
+VIT_SNAPSHOT_DIR = os.environ.get("VIDEOARCHIVE_VIT_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "model_snapshot", "vit-base-patch16-224")
+VIT_REVISION_FILE = "revision.txt"
+# Servers without a valid snapshot load the ViT through the hub instead of failing /ready
+VIT_ALLOW_DOWNLOAD = os.environ.get("VIDEOARCHIVE_VIT_ALLOW_DOWNLOAD", "0") == "1"
+
+
+def _is_commit(revision: str) -> bool:
+    return re.fullmatch(r"[0-9a-f]{7,40}", revision) is not None
+
+
+def snapshot_revision(snapshot_dir: str = VIT_SNAPSHOT_DIR) -> str | None:
+    """Hub commit the snapshot in ``snapshot_dir`` was downloaded from, or None if it recorded none."""
+    try:
+        with open(os.path.join(snapshot_dir, VIT_REVISION_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_problem(snapshot_dir: str = VIT_SNAPSHOT_DIR, revision: str = VIT_REVISION) -> str | None:
+    """Why the snapshot in ``snapshot_dir`` is not the pinned ``revision``, or None if it is."""
+    if not os.path.isfile(os.path.join(snapshot_dir, "config.json")):
+        return f"No ViT snapshot in '{snapshot_dir}'."
+    recorded = snapshot_revision(snapshot_dir)
+    matches = recorded is not None and recorded.startswith(revision) if _is_commit(revision) else recorded is not None
+    if not matches:
+        return f"The ViT snapshot in '{snapshot_dir}' is of commit {recorded or 'unknown'}, not {revision}."
+    return None
+
+
+def load_pretrained(cls, require_snapshot: bool = False):
+    """``cls.from_pretrained`` (ViTModel, ViTImageProcessor) from the local snapshot of ``VIT_REVISION``.
+
+    Without a valid snapshot, ``require_snapshot`` (servers) raises; otherwise the ViT is
+    loaded through the hub (or its cache) at the pinned revision.
+    """
+    problem = snapshot_problem()
+    if problem is None:
+        return cls.from_pretrained(VIT_SNAPSHOT_DIR, local_files_only=True)
+    if require_snapshot:
+        raise FileNotFoundError(f"{problem} Run `python -m backend.models` to cache it, or set "
+                                "VIDEOARCHIVE_VIT_ALLOW_DOWNLOAD=1 to load it through the hub.")
+    print(f"Warning: {problem} Loading '{VIT_MODEL_ID}' at {VIT_REVISION} through the Hugging Face hub. "
+          "Run `python -m backend.models` once to cache it.")
+    return cls.from_pretrained(VIT_MODEL_ID, revision=VIT_REVISION)
+
+
+def snapshot_vit(snapshot_dir: str = VIT_SNAPSHOT_DIR, revision: str = VIT_REVISION) -> str:
+    """Downloads the config, preprocessor config and safetensors weights of the ViT into ``snapshot_dir``.
+
+    ``revision`` is resolved to its commit first, so every file comes from that one commit,
+    which the snapshot records (see ``snapshot_revision``). Commits without safetensors
+    weights get the PyTorch ones.
+    """
+    from huggingface_hub import HfApi, snapshot_download
+    info = HfApi().model_info(VIT_MODEL_ID, revision=revision)
+    commit = info.sha
+    has_safetensors = any(s.rfilename.endswith(".safetensors") for s in info.siblings or [])
+    path = snapshot_download(VIT_MODEL_ID, revision=commit, local_dir=snapshot_dir,
+                             allow_patterns=["*.json", "*.safetensors" if has_safetensors else "pytorch_model.bin"])
+    with open(os.path.join(snapshot_dir, VIT_REVISION_FILE), "w", encoding="utf-8") as f:
+        f.write(commit + "\n")
+    return path
+
+
+class _PooledViT(torch.nn.Module):
+    """ViT that returns the mean-pooled last hidden state, i.e. the scene embedding."""
+
+    def __init__(self, model: ViTModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).last_hidden_state.mean(dim=1)
+
 
 class FeatureExtractor:
-    def __init__(self, model_path: str = None):
+    def __init__(self, model_path: str = None, backend: str = "eager", require_snapshot: bool = False):
+        """Loads the ViT (optionally with fine-tuned ``model_path`` weights) for one of ``INFERENCE_BACKENDS``.
+
+        ``require_snapshot`` fails instead of falling back to the hub (see ``load_pretrained``).
+
+        Every backend produces embeddings in the same space as ``eager``, but not bit-identical
+        ones; ``inference_check.py`` measures the drift on real scenes before switching.
+        """
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend '{backend}'. Choose one of {INFERENCE_BACKENDS}.")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.processor = ViTImageProcessor.from_pretrained(
-            "google/vit-base-patch16-224"
-        )
-        self.model = ViTModel.from_pretrained("google/vit-base-patch16-224").to(
-            self.device
-        )
+        self.model_path = model_path
+        self.processor = load_pretrained(ViTImageProcessor, require_snapshot)
+        self.model = load_pretrained(ViTModel, require_snapshot).to(self.device)
 
         if model_path:
             self.model.load_state_dict(torch.load(model_path, map_location=self.device))
+        self.model.eval()
+
+        if backend == "int8" and self.device != "cpu":
+            print("Warning: int8 dynamic quantization only runs on CPU. Using the 'eager' backend.")
+            backend = "eager"
+        self.backend = backend
+        self._pooled = self._build_backend(backend)
+
+    def _build_backend(self, backend: str) -> torch.nn.Module:
+        pooled = _PooledViT(self.model).eval()
+        if backend == "int8":
+            # Weights of every Linear layer (almost all of ViT's compute) are stored as int8;
+            # activations are quantized on the fly per batch.
+            return torch.ao.quantization.quantize_dynamic(pooled, {torch.nn.Linear}, dtype=torch.qint8)
+        if backend == "torchscript":
+            example = torch.zeros(1, 3, VIT_INPUT_SIZE, VIT_INPUT_SIZE, device=self.device)
+            with torch.no_grad(), warnings.catch_warnings():
+                # The traced shape checks only depend on the fixed 224x224 processor output.
+                warnings.simplefilter("ignore")
+                return torch.jit.freeze(torch.jit.trace(pooled, example))
+        return pooled
+
+    def warm_up(self, runs: int = 2):
+        """Runs the first forward passes (TorchScript profiling runs, kernel and allocator setup) on a blank frame."""
+        blank = Image.new("RGB", (VIT_INPUT_SIZE, VIT_INPUT_SIZE))
+        pixel_values = self.processor(images=[blank], return_tensors="pt")["pixel_values"].to(self.device)
+        with torch.inference_mode():
+            for _ in range(runs):
+                self._pooled(pixel_values)
 
     def get_embedding(self, img: Image.Image) -> List[float]:
         """Extracts a feature embedding from an image."""
+        return self.get_embeddings([img])[0].tolist()
+
+    def get_embeddings(self, images: List[Image.Image]) -> np.ndarray:
+        """Extracts feature embeddings for a batch of images in a single forward pass."""
         # FIX: Convert image to RGB to handle different channel formats (e.g., RGBA, Grayscale)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            
-        inputs = self.processor(images=img, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1).squeeze().tolist()
+        images = [img if img.mode == 'RGB' else img.convert('RGB') for img in images]
+
+        with metrics.stage("vit_preprocess"):
+            pixel_values = self.processor(images=images, return_tensors="pt")["pixel_values"].to(self.device)
+        with metrics.stage("vit_forward"), torch.inference_mode():
+            embeddings = self._pooled(pixel_values)
+        return embeddings.cpu().numpy().astype(np.float32)
 
 
 class LocalFeatureExtractor:
@@ -43,4 +173,14 @@ class LocalFeatureExtractor:
             
         frame_gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
         keypoints, descriptors = self.orb.detectAndCompute(frame_gray, None)
-        return keypoints, descriptors
\ No newline at end of file
+        return keypoints, descriptors
+
+    @staticmethod
+    def keypoints_to_array(keypoints: Tuple[cv2.KeyPoint, ...]) -> np.ndarray:
+        """Converts keypoints to a compact (N, 2) float32 array of their coordinates."""
+        return np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+
+
+if __name__ == "__main__":
+    snapshot_path = snapshot_vit()
+    print(f"ViT snapshot of commit {snapshot_revision()} saved to '{snapshot_path}'.")
@@ -0,0 +1,217 @@
+import hashlib
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# --- Defaults ---
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+THUMBNAIL_WIDTH = 320
+JPEG_QUALITY = 80
+# Between full sweeps of the cache directory, a cache only counts the bytes it wrote itself;
+# the periodic sweep also picks up entries other processes wrote.
+SWEEP_SECONDS = 300.0
+# Preview clips: seconds around the scene timestamp, frame width and frame rate. VP8 WebM is
+# the one browser-playable codec OpenCV's bundled FFmpeg can encode.
+CLIP_SECONDS = 4.0
+CLIP_WIDTH = 480
+CLIP_FPS = 12
+KINDS = {"thumbnail": (".jpg", "image/jpeg"), "clip": (".webm", "video/webm")}
+
+
+def resolve_video(video_dir: str, video_id: str) -> str | None:
+    """Path of a video in ``video_dir``, or None if there is none (or ``video_id`` is not a plain file name)."""
+    if not video_id or os.path.basename(video_id) != video_id or video_id.startswith("."):
+        return None
+    path = os.path.join(video_dir, video_id)
+    return path if os.path.isfile(path) else None
+
+
+def _resize(frame: np.ndarray, width: int) -> np.ndarray:
+    height, original_width = frame.shape[:2]
+    if original_width <= width:
+        return frame
+    # Even dimensions keep video encoders happy.
+    size = (width, max(2, round(height * width / original_width / 2) * 2))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def encode_thumbnail(frame_bgr: np.ndarray, width: int = THUMBNAIL_WIDTH) -> bytes:
+    ok, data = cv2.imencode(".jpg", _resize(frame_bgr, width), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise IOError("Could not encode the thumbnail.")
+    return data.tobytes()
+
+
+def render_thumbnail(video_path: str, timestamp: float, width: int = THUMBNAIL_WIDTH) -> bytes:
+    """JPEG of the frame at ``timestamp``."""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise IOError(f"Could not open '{os.path.basename(video_path)}'.")
+        cap.set(cv2.CAP_PROP_POS_MSEC, timestamp * 1000)
+        ret, frame = cap.read()
+    finally:
+        cap.release()
+    if not ret:
+        raise ValueError(f"No frame at {timestamp:.2f}s in '{os.path.basename(video_path)}'.")
+    return encode_thumbnail(frame, width)
+
+
+def render_clip(video_path: str, timestamp: float, output_path: str, seconds: float = CLIP_SECONDS,
+                width: int = CLIP_WIDTH, fps: int = CLIP_FPS):
+    """Writes a small, silent WebM of the ``seconds`` around ``timestamp``.
+
+    Frames are read sequentially after one seek; frames between the sampled ones are only
+    grabbed, never decoded to pixels.
+    """
+    cap = cv2.VideoCapture(video_path)
+    writer = None
+    try:
+        if not cap.isOpened():
+            raise IOError(f"Could not open '{os.path.basename(video_path)}'.")
+        source_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, round(source_fps / fps))
+        start = max(0.0, timestamp - seconds / 2)
+        cap.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+        for frame_num in range(int(seconds * source_fps)):
+            if not cap.grab():
+                break
+            if frame_num % step:
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            frame = _resize(frame, width)
+            if writer is None:
+                writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"VP80"), source_fps / step,
+                                         (frame.shape[1], frame.shape[0]))
+                if not writer.isOpened():
+                    raise IOError("This OpenCV build cannot encode WebM (VP8) preview clips.")
+            writer.write(frame)
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+    if writer is None:
+        raise ValueError(f"No frames around {timestamp:.2f}s in '{os.path.basename(video_path)}'.")
+
+
+class PreviewCache:
+    """Size-bounded on-disk cache of scene thumbnails (JPEG) and preview clips (WebM).
+
+    Entries are keyed by the video file's size and modification time, so a replaced video
+    never serves stale previews. Every hit refreshes an entry's modification time and the
+    least recently used entries are evicted once the cache exceeds ``max_bytes``. Entries
+    are written atomically, so several processes can share one directory.
+
+    Rendered entries are added to a running byte total; the directory is only swept, in a
+    background thread, once that total exceeds ``max_bytes`` or every ``sweep_seconds``.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = MAX_CACHE_BYTES, sweep_seconds: float = SWEEP_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.sweep_seconds = sweep_seconds
+        self._evict_lock = threading.Lock()
+        self._size_lock = threading.Lock()
+        # Unknown until the first sweep.
+        self._bytes = None
+        self._last_sweep = 0.0
+        self._sweeping = False
+
+    def path(self, video_path: str, timestamp: float, kind: str) -> str:
+        stat = os.stat(video_path)
+        key = f"{os.path.basename(video_path)}|{stat.st_size}|{stat.st_mtime_ns}|{kind}|{timestamp:.2f}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + KINDS[kind][0])
+
+    def get(self, video_path: str, timestamp: float, kind: str) -> tuple[str, bool]:
+        """Returns the cached preview file, rendering it first on a miss, and whether it was a hit."""
+        path = self.path(video_path, timestamp, kind)
+        try:
+            os.utime(path)
+            return path, True
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The extension tells OpenCV which container to write.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp{KINDS[kind][0]}"
+        try:
+            if kind == "clip":
+                render_clip(video_path, timestamp, tmp_path)
+            else:
+                with open(tmp_path, "wb") as f:
+                    f.write(render_thumbnail(video_path, timestamp))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._added(os.path.getsize(path))
+        return path, False
+
+    def put_thumbnail(self, video_path: str, timestamp: float, frame_rgb: np.ndarray):
+        """Caches the thumbnail of a frame that is already decoded, e.g. while indexing.
+
+        Does not evict; the writer calls ``evict`` once after a batch of thumbnails.
+        """
+        path = self.path(video_path, timestamp, "thumbnail")
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_thumbnail(cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)))
+        os.replace(tmp_path, path)
+
+    def _added(self, size: int):
+        """Counts a new entry and starts a background sweep if the cache may be too large."""
+        with self._size_lock:
+            if self._bytes is not None:
+                self._bytes += size
+            if self._sweeping or (self._bytes is not None and self._bytes <= self.max_bytes
+                                  and time.monotonic() - self._last_sweep < self.sweep_seconds):
+                return
+            self._sweeping = True
+
+        def sweep():
+            try:
+                self.evict()
+            except OSError as e:
+                print(f"⚠️ Preview cache sweep failed: {e}")
+            finally:
+                self._sweeping = False
+
+        threading.Thread(target=sweep, name="preview-cache-sweep", daemon=True).start()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits into ``max_bytes``.
+
+        Walks the whole cache directory and resets the running byte total.
+        """
+        with self._evict_lock:
+            started = time.monotonic()
+            entries = []
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if ".tmp" in name:
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            with self._size_lock:
+                self._bytes = total
+                self._last_sweep = started
@@ -0,0 +1,196 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class _LRU:
+    """Ordered dict with size- and TTL-based eviction. Not thread-safe on its own.
+
+    ``on_evict(key, value)`` is called for every entry that expires or is evicted.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self.entries: OrderedDict = OrderedDict()
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        if self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds:
+            del self.entries[key]
+            self._evicted(key, value)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        previous = self.entries.get(key)
+        if previous is not None:
+            self._evicted(key, previous[0])
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, (evicted, _) = self.entries.popitem(last=False)
+            self._evicted(evicted_key, evicted)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class QueryCache:
+    """Bounded cache of query embeddings and ranked results, keyed by image content.
+
+    Results are looked up by an exact content hash. With ``perceptual``, a query that
+    misses can also reuse the result of a cached query whose 64-bit perceptual hash
+    (dHash) is within ``max_hash_distance`` bits, so re-encoded copies of a screenshot hit
+    as well. Dark or low-contrast frames share near-identical hashes, so such a hit is only
+    served once the two embeddings have a cosine similarity of at least
+    ``min_cosine_similarity``. Hashes are split into ``max_hash_distance + 1`` bands; two
+    hashes that close agree on at least one band, so only the entries bucketed under one
+    of the query's bands are compared. Embeddings only depend on the model, so
+    ``invalidate_results`` keeps them when a new index is swapped in.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, perceptual: bool = False,
+                 max_hash_distance: int = 3, min_cosine_similarity: float = 0.98):
+        self.perceptual = perceptual
+        self.max_hash_distance = max_hash_distance
+        self.min_cosine_similarity = min_cosine_similarity
+        bands = max_hash_distance + 1
+        bounds = [64 * band // bands for band in range(bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        # (band, band bits) -> result keys whose hash has those bits in that band
+        self._buckets: dict[tuple[int, int], set] = {}
+        self._results = _LRU(max_entries, ttl_seconds, on_evict=self._unbucket)
+        self._embeddings = _LRU(max_entries, ttl_seconds)
+        self._lock = threading.Lock()
+        self.counters = {
+            "result_hits": 0,
+            "perceptual_hits": 0,
+            "result_misses": 0,
+            "embedding_hits": 0,
+            "embedding_misses": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def content_key(image: Image.Image) -> str:
+        """Exact hash of the decoded pixels (independent of the upload's container metadata)."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def perceptual_hash(image: Image.Image) -> int:
+        """64-bit difference hash: robust to re-encoding, resizing and small color shifts."""
+        small = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return int("".join("1" if b else "0" for b in bits), 2)
+
+    def keys_for(self, image: Image.Image) -> tuple[str, int | None]:
+        return self.content_key(image), self.perceptual_hash(image) if self.perceptual else None
+
+    def _band_keys(self, phash: int, options: tuple) -> list[tuple]:
+        return [(band, (phash >> start) & mask, options) for band, (start, mask) in enumerate(self._bands)]
+
+    def _unbucket(self, key, value):
+        phash = value[0]
+        if phash is None:
+            return
+        for band_key in self._band_keys(phash, key[1]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def get_result(self, keys: tuple[str, int | None], options: tuple) -> list[dict] | None:
+        """Result cached for exactly this image, or None (see ``get_similar_result``)."""
+        content_key, _ = keys
+        with self._lock:
+            cached = self._results.get((content_key, options))
+            if cached is not None:
+                self.counters["result_hits"] += 1
+                return [dict(item) for item in cached[1]]
+            if not self.perceptual:
+                self.counters["result_misses"] += 1
+            return None
+
+    def get_similar_result(self, keys: tuple[str, int | None], options: tuple, embedding: np.ndarray) -> list[dict] | None:
+        """Result of a perceptually near-identical cached query whose embedding confirms the match."""
+        _, phash = keys
+        if phash is None:
+            return None
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(phash, options):
+                candidates |= self._buckets.get(band_key, set())
+            norm = float(np.linalg.norm(embedding)) or 1.0
+            for key in candidates:
+                cached = self._results.get(key)
+                if cached is None:
+                    continue
+                cached_phash, cached_result, cached_embedding = cached
+                if (phash ^ cached_phash).bit_count() > self.max_hash_distance or cached_embedding is None:
+                    continue
+                cosine = float(np.dot(embedding, cached_embedding)) / (norm * (float(np.linalg.norm(cached_embedding)) or 1.0))
+                if cosine >= self.min_cosine_similarity:
+                    self.counters["perceptual_hits"] += 1
+                    return [dict(item) for item in cached_result]
+            self.counters["result_misses"] += 1
+            return None
+
+    def put_result(self, keys: tuple[str, int | None], options: tuple, result: list[dict],
+                   embedding: np.ndarray | None = None):
+        """Caches a result; with ``embedding`` it can also serve perceptually near-identical queries."""
+        content_key, phash = keys
+        key = (content_key, options)
+        with self._lock:
+            self._results.put(key, (phash, [dict(item) for item in result], embedding))
+            if phash is not None and embedding is not None:
+                for band_key in self._band_keys(phash, options):
+                    self._buckets.setdefault(band_key, set()).add(key)
+
+    def get_embedding(self, keys: tuple[str, int | None]) -> np.ndarray | None:
+        with self._lock:
+            embedding = self._embeddings.get(keys[0])
+            self.counters["embedding_hits" if embedding is not None else "embedding_misses"] += 1
+            return embedding
+
+    def put_embedding(self, keys: tuple[str, int | None], embedding: np.ndarray):
+        with self._lock:
+            self._embeddings.put(keys[0], embedding)
+
+    def invalidate_results(self):
+        """Drops every cached result, e.g. after a new index was loaded."""
+        with self._lock:
+            self._results.clear()
+            self._buckets.clear()
+            self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._buckets.clear()
+            self._embeddings.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.counters,
+                "results_cached": len(self._results.entries),
+                "embeddings_cached": len(self._embeddings.entries),
+            }
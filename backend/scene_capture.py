@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+from scenedetect.detectors import ContentDetector
+from scenedetect.scene_manager import compute_downscale_factor, DEFAULT_MIN_WIDTH
+
+
+class _CandidateBuffer:
+    """Full-resolution frames sampled from the still-open scene(s), bounded in size.
+
+    When the buffer is full every other frame is dropped and the sampling stride doubles,
+    so a scene of any length keeps at most ``max_candidates`` frames while still covering
+    it evenly enough to pick a frame close to its middle.
+    """
+
+    def __init__(self, base_stride: int, max_candidates: int):
+        self.base_stride = base_stride
+        self.max_candidates = max_candidates
+        self.stride = base_stride
+        self.frames: list[tuple[int, np.ndarray]] = []
+
+    def offer(self, frame_num: int, frame: np.ndarray):
+        if self.frames and frame_num - self.frames[-1][0] < self.stride:
+            return
+        self.frames.append((frame_num, frame))
+        if len(self.frames) > self.max_candidates:
+            self.frames = self.frames[::2]
+            self.stride *= 2
+
+    def take_middle(self, start: int, end: int) -> tuple[int, np.ndarray] | None:
+        """Returns the candidate closest to the middle of ``[start, end)`` and forgets the scene."""
+        middle = start + (end - start) / 2
+        in_scene = [c for c in self.frames if start <= c[0] < end]
+        self.frames = [c for c in self.frames if c[0] >= end]
+        self.stride = self.base_stride
+        if not in_scene:
+            return None
+        return min(in_scene, key=lambda c: abs(c[0] - middle))
+
+
+def capture_scene_frames(video_path: str, threshold: float = 27.0, frame_skip: int = 0,
+                         detect_width: int = DEFAULT_MIN_WIDTH, max_candidates: int = 8):
+    """Detects scenes and captures one representative frame per scene in a single decode pass.
+
+    Frames are read sequentially, so the video is never seeked. ``ContentDetector`` runs
+    on a copy downscaled to about ``detect_width`` pixels wide and, with ``frame_skip``, only
+    on every ``frame_skip + 1``-th frame. Skipped frames are grabbed but never converted.
+
+    Like ``SceneManager.get_scene_list()``, a video without any cut yields no scenes.
+
+    Yields:
+        ``(timestamp_sec, frame_rgb)`` per scene, as soon as the scene is closed.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open '{video_path}'.")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    detector = ContentDetector(threshold=threshold)
+    candidates = _CandidateBuffer(frame_skip + 1, max_candidates)
+    downscale = None
+    scene_start = 0
+    frame_num = -1
+    cuts_seen = False
+
+    def close_scene(end: int):
+        captured = candidates.take_middle(scene_start, end)
+        if captured is None:
+            return None
+        captured_num, frame = captured
+        return captured_num / fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    try:
+        while True:
+            frame_num += 1
+            if frame_skip and frame_num % (frame_skip + 1):
+                if not cap.grab():
+                    break
+                continue
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            if downscale is None:
+                downscale = compute_downscale_factor(frame.shape[1], detect_width)
+            small = frame if downscale <= 1 else cv2.resize(
+                frame, (int(frame.shape[1] / downscale), int(frame.shape[0] / downscale)), interpolation=cv2.INTER_LINEAR
+            )
+            candidates.offer(frame_num, frame)
+
+            for cut in detector.process_frame(frame_num, small):
+                cuts_seen = True
+                scene = close_scene(cut)
+                scene_start = cut
+                if scene is not None:
+                    yield scene
+
+        for cut in detector.post_process(frame_num):
+            cuts_seen = True
+            scene = close_scene(cut)
+            scene_start = cut
+            if scene is not None:
+                yield scene
+        if cuts_seen:
+            scene = close_scene(frame_num)
+            if scene is not None:
+                yield scene
+    finally:
+        cap.release()
@@ -0,0 +1,310 @@
+import json
+import os
+import shutil
+import sys
+import time
+import numpy as np
+
+REMOVED_VIDEO_ID = -1
+# How often a reader waiting for a build to migrate a legacy mapping checks again
+MIGRATION_POLL_SECONDS = 0.5
+
+
+class SceneMapping:
+    """Columnar, append-only mapping from FAISS id (row) to ``(video, timestamp)``.
+
+    Video names are stored once in a small name table; every scene row only holds an
+    int32 video id and a float32 timestamp, so both columns can be memory-mapped.
+    Removed scenes keep their row with video id ``REMOVED_VIDEO_ID`` so ids stay stable.
+    A third column names each row's representative row: near-duplicate scenes share the
+    FAISS vector of their representative, and rows without an entry represent themselves.
+    Only the first ``meta.json["rows"]`` rows are visible; rows appended past that count
+    belong to a build that has not committed yet.
+    """
+
+    def __init__(self, mapping_dir: str):
+        self.mapping_dir = mapping_dir
+        self.videos_path = os.path.join(mapping_dir, "videos.json")
+        self.video_ids_path = os.path.join(mapping_dir, "video_ids.i32")
+        self.timestamps_path = os.path.join(mapping_dir, "timestamps.f32")
+        self.representatives_path = os.path.join(mapping_dir, "representatives.i64")
+        self.meta_path = os.path.join(mapping_dir, "meta.json")
+        self._release()
+
+    def _release(self):
+        self.video_names: list[str] = []
+        self._name_to_id: dict[str, int] = {}
+        self._video_ids = np.empty(0, dtype=np.int32)
+        self._timestamps = np.empty(0, dtype=np.float32)
+        self._representatives = np.empty(0, dtype=np.int64)
+        self._duplicates: dict[int, list[int]] | None = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.meta_path)
+
+    def __len__(self) -> int:
+        return len(self._video_ids)
+
+    @staticmethod
+    def _column_rows(path: str, itemsize: int) -> int:
+        return os.path.getsize(path) // itemsize if os.path.exists(path) else 0
+
+    def file_rows(self) -> int:
+        """Rows on disk, including rows appended by a build that has not committed yet."""
+        if not os.path.exists(self.video_ids_path):
+            return 0
+        return os.path.getsize(self.video_ids_path) // np.dtype(np.int32).itemsize
+
+    def committed_rows(self) -> int:
+        if not self.exists():
+            return 0
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            return int(json.load(f)["rows"])
+
+    @staticmethod
+    def _write_json(path: str, data):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def load(self, writable: bool = False, rows: int | None = None) -> "SceneMapping":
+        """Memory-maps the committed rows (read-only unless ``writable``).
+
+        ``rows`` maps exactly the rows an index generation references instead, which
+        may run ahead of the commit while that generation is being published.
+        """
+        self._release()
+        if not self.exists():
+            return self
+        with open(self.videos_path, "r", encoding="utf-8") as f:
+            self.video_names = json.load(f)
+        self._name_to_id = {name: i for i, name in enumerate(self.video_names)}
+        rows = min(self.committed_rows() if rows is None else rows, self.file_rows())
+        if rows:
+            mode = "r+" if writable else "r"
+            self._video_ids = np.memmap(self.video_ids_path, dtype=np.int32, mode=mode, shape=(rows,))
+            self._timestamps = np.memmap(self.timestamps_path, dtype=np.float32, mode=mode, shape=(rows,))
+            # Mappings written before deduplication have a shorter (or no) representatives column.
+            represented = min(rows, self._column_rows(self.representatives_path, 8))
+            if represented:
+                self._representatives = np.memmap(self.representatives_path, dtype=np.int64, mode=mode,
+                                                  shape=(represented,))
+        return self
+
+    def get(self, row: int) -> dict:
+        """Returns the scene at a row in the legacy ``{"id", "timestamp"}`` form."""
+        video_id = int(self._video_ids[row])
+        return {
+            "id": self.video_names[video_id] if video_id != REMOVED_VIDEO_ID else None,
+            "timestamp": f"{float(self._timestamps[row]):.2f}",
+        }
+
+    def scenes(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorized ``get``: the video ids (see ``video_names``) and timestamps of the given rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        return np.asarray(self._video_ids[rows]), np.asarray(self._timestamps[rows])
+
+    def is_removed(self, row: int) -> bool:
+        return row < 0 or row >= len(self) or int(self._video_ids[row]) == REMOVED_VIDEO_ID
+
+    def removed_mask(self, rows: np.ndarray) -> np.ndarray:
+        """Vectorized ``is_removed`` for an array of rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        in_range = (rows >= 0) & (rows < len(self))
+        mask = ~in_range
+        mask[in_range] = self._video_ids[rows[in_range]] == REMOVED_VIDEO_ID
+        return mask
+
+    def representative(self, row: int) -> int:
+        """Row whose FAISS vector stands for this scene (the row itself unless it is a near-duplicate)."""
+        return int(self._representatives[row]) if row < len(self._representatives) else row
+
+    def occurrences(self, row: int) -> list[int]:
+        """Live rows other than ``row`` that are represented by ``row``'s vector."""
+        if self._duplicates is None:
+            duplicates: dict[int, list[int]] = {}
+            rows = np.flatnonzero(self._representatives != np.arange(len(self._representatives)))
+            for duplicate in rows[~self.removed_mask(rows)]:
+                duplicates.setdefault(int(self._representatives[duplicate]), []).append(int(duplicate))
+            self._duplicates = duplicates
+        return self._duplicates.get(row, [])
+
+    def orphaned_duplicates(self, removed_rows: np.ndarray) -> list[tuple[int, np.ndarray]]:
+        """Groups whose representative is about to be removed while some duplicates stay.
+
+        Returns ``(old_representative, surviving_rows)`` pairs; the first surviving row should
+        take over the representative's vector.
+        """
+        removed = set(int(r) for r in removed_rows)
+        groups = []
+        for representative in sorted(removed):
+            surviving = [row for row in self.occurrences(representative) if row not in removed]
+            if surviving:
+                groups.append((representative, np.array(surviving, dtype=np.int64)))
+        return groups
+
+    def indexed_videos(self) -> set[str]:
+        """Names of all videos with at least one live scene."""
+        live_ids = np.unique(self._video_ids[self._video_ids != REMOVED_VIDEO_ID])
+        return {self.video_names[i] for i in live_ids}
+
+    def reset(self):
+        """Removes every row and video name."""
+        os.makedirs(self.mapping_dir, exist_ok=True)
+        self._release()
+        open(self.video_ids_path, "wb").close()
+        open(self.timestamps_path, "wb").close()
+        open(self.representatives_path, "wb").close()
+        self._write_json(self.videos_path, [])
+        self._write_json(self.meta_path, {"rows": 0})
+
+    def append(self, items: list[dict]) -> np.ndarray:
+        """Appends uncommitted rows for ``{"id", "timestamp"}`` items and returns their row ids.
+
+        Items may name a ``"representative"`` row (see ``next_row``); by default a row
+        represents itself. The rows only become visible after ``commit``.
+        """
+        if not self.exists():
+            self.reset()
+        self.load()
+        start = self.committed_rows()
+        for item in items:
+            if item["id"] not in self._name_to_id:
+                self._name_to_id[item["id"]] = len(self.video_names)
+                self.video_names.append(item["id"])
+        # The name table only grows, so writing it early is harmless if the build never commits.
+        self._write_json(self.videos_path, self.video_names)
+
+        video_ids = np.array([self._name_to_id[item["id"]] for item in items], dtype=np.int32)
+        timestamps = np.array([float(item["timestamp"]) for item in items], dtype=np.float32)
+        representatives = np.array([item.get("representative", start + i) for i, item in enumerate(items)], dtype=np.int64)
+        # Older rows without a representative entry represent themselves.
+        represented = self._column_rows(self.representatives_path, 8)
+        if represented < start:
+            representatives = np.concatenate([np.arange(represented, start, dtype=np.int64), representatives])
+        self._release()
+        open(self.representatives_path, "ab").close()
+        for path, column, itemsize, keep in ((self.video_ids_path, video_ids, 4, start),
+                                             (self.timestamps_path, timestamps, 4, start),
+                                             (self.representatives_path, representatives, 8, min(start, represented))):
+            with open(path, "r+b") as f:
+                # Drop rows left behind by a build that crashed before committing.
+                f.truncate(keep * itemsize)
+                f.seek(0, os.SEEK_END)
+                column.tofile(f)
+        return np.arange(start, start + len(items), dtype=np.int64)
+
+    def next_row(self) -> int:
+        """Row id the next ``append`` starts at."""
+        return self.committed_rows()
+
+    def commit(self, rows: int | None = None):
+        """Makes the first ``rows`` rows (default: all appended rows) visible to readers."""
+        self._write_json(self.meta_path, {"rows": self.file_rows() if rows is None else rows})
+        self.load()
+
+    def roll_forward(self, rows: int):
+        """Commits rows that an index already references after a build crashed before ``commit``."""
+        if self.committed_rows() < rows <= self.file_rows():
+            print(f"🔁 Recovering {rows - self.committed_rows()} scene rows of an interrupted build.")
+            self.commit(rows)
+
+    def remove_rows(self, rows: np.ndarray):
+        """Tombstones the given rows in place."""
+        if len(rows) == 0:
+            return
+        self.load(writable=True)
+        self._video_ids[np.asarray(rows, dtype=np.int64)] = REMOVED_VIDEO_ID
+        self._video_ids.flush()
+        self.load()
+
+    def set_representative(self, rows: np.ndarray, representative: int):
+        """Points committed rows at a new representative, e.g. when theirs is removed."""
+        if len(rows) == 0:
+            return
+        if len(self._representatives) < len(self):
+            # Materialize the column for mappings written before deduplication.
+            with open(self.representatives_path, "r+b" if os.path.exists(self.representatives_path) else "wb") as f:
+                f.truncate(len(self._representatives) * 8)
+                f.seek(0, os.SEEK_END)
+                np.arange(len(self._representatives), len(self), dtype=np.int64).tofile(f)
+        self.load(writable=True)
+        self._representatives[np.asarray(rows, dtype=np.int64)] = representative
+        self._representatives.flush()
+        self.load()
+
+    def rows_of_videos(self, names: set[str]) -> np.ndarray:
+        """Rows of every live scene of the given videos."""
+        video_ids = [self._name_to_id[name] for name in names if name in self._name_to_id]
+        return np.flatnonzero(np.isin(self._video_ids, video_ids)).astype(np.int64)
+
+
+def migrate_json_mapping(json_path: str, mapping_dir: str) -> SceneMapping:
+    """One-shot conversion of a legacy ``index_mapping.json`` list into a ``SceneMapping``.
+
+    The mapping is written into a temporary directory that replaces ``mapping_dir`` only
+    once it is complete, so readers never see a partial mapping.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    tmp_dir = f"{mapping_dir}.migrating-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    mapping = SceneMapping(tmp_dir)
+    mapping.reset()
+    mapping.append(items)
+    mapping.commit()
+    mapping.remove_rows(np.array([row for row, item in enumerate(items) if item.get("removed")], dtype=np.int64))
+    mapping._release()
+    if os.path.exists(mapping_dir):
+        old_dir = f"{mapping_dir}.old-{os.getpid()}"
+        os.replace(mapping_dir, old_dir)
+        os.replace(tmp_dir, mapping_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(tmp_dir, mapping_dir)
+    return SceneMapping(mapping_dir).load()
+
+
+def _migrate_under_lock(legacy_json_path: str, mapping_dir: str, lock) -> SceneMapping:
+    """Migrates a legacy JSON mapping under ``lock``, unless a build holding it does so first."""
+    while not lock.acquire():
+        # Builds migrate right after taking the lock.
+        if SceneMapping(mapping_dir).exists():
+            return SceneMapping(mapping_dir).load()
+        time.sleep(MIGRATION_POLL_SECONDS)
+    try:
+        if SceneMapping(mapping_dir).exists():
+            return SceneMapping(mapping_dir).load()
+        print(f"🔁 Migrating '{legacy_json_path}' to the columnar scene mapping (one-time)...")
+        return migrate_json_mapping(legacy_json_path, mapping_dir)
+    finally:
+        lock.release()
+
+
+def open_scene_mapping(mapping_dir: str, legacy_json_path: str | None = None, migrate: bool = False,
+                       lock=None) -> SceneMapping:
+    """Loads a scene mapping.
+
+    With ``migrate``, a legacy JSON mapping is migrated first if that is all there is; the
+    caller must hold the build lock. Servers pass the build ``lock`` instead and migrate
+    under it, or wait for the build that holds it to migrate. Other readers just open an
+    existing mapping.
+    """
+    mapping = SceneMapping(mapping_dir)
+    if not mapping.exists() and legacy_json_path and os.path.exists(legacy_json_path):
+        if migrate:
+            print(f"🔁 Migrating '{legacy_json_path}' to the columnar scene mapping (one-time)...")
+            return migrate_json_mapping(legacy_json_path, mapping_dir)
+        if lock is not None:
+            return _migrate_under_lock(legacy_json_path, mapping_dir, lock)
+        print(f"Warning: '{legacy_json_path}' is not migrated yet. Run an index build or `python -m backend.scene_mapping`.")
+    return mapping.load()
+
+
+if __name__ == "__main__":
+    # python -m backend.scene_mapping [index_mapping.json] [scene_mapping_dir]
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    json_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, "index_mapping.json")
+    mapping_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base_dir, "scene_mapping")
+    migrated = migrate_json_mapping(json_path, mapping_dir)
+    print(f"Migrated {len(migrated)} scenes of {len(migrated.video_names)} videos to {mapping_dir}")
@@ -1,91 +1,293 @@
-import json
 import cv2
-import faiss
 import numpy as np
 from PIL import Image
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor
 
 from .models import FeatureExtractor, LocalFeatureExtractor
+from .descriptor_store import DescriptorStore
+from .index_factory import read_index, search_params
+from .scene_mapping import SceneMapping, open_scene_mapping
+from .query_cache import QueryCache
+from .generations import IndexGenerations
+from .visual_words import VisualWordIndex
+from . import metrics
+from .clip_search import vote_segments
+
+class _LoadedIndex:
+    """One consistent view of an index generation: FAISS index, scene mapping, descriptors and visual words."""
+
+    def __init__(self, faiss_index, index_mapping: SceneMapping | None, descriptor_store: DescriptorStore,
+                 generation: int | None = None, visual_words: VisualWordIndex | None = None):
+        self.faiss_index = faiss_index
+        self.index_mapping = index_mapping
+        self.descriptor_store = descriptor_store
+        self.generation = generation
+        self.visual_words = visual_words
+
 
 class SearchEngine:
-    def __init__(self, faiss_index_path='index.faiss', index_mapping_path='index_mapping.json'):
+    def __init__(self, faiss_index_path=None, scene_mapping_dir='scene_mapping', descriptor_store_dir='orb_store',
+                 nprobe=None, ef_search=None, legacy_mapping_path='index_mapping.json', mmap=False,
+                 query_cache: QueryCache | None = None, generations_dir='index_generations', model_path=None,
+                 inference_backend='eager', legacy_index_path='index.faiss',
+                 visual_word_candidates=200, rerank_shortlist=20, warm_up=True, require_snapshot=False):
+        """Loads the models and the active index generation.
+
+        Without ``faiss_index_path`` the engine serves the active generation in
+        ``generations_dir`` (or a pre-generation ``index.faiss``) and can switch to newer
+        generations with ``reload`` without reloading the models.
+
+        With ``mmap=True`` the FAISS index is memory-mapped read-only like the mapping and
+        descriptor store, so every worker process serving the same files shares them
+        through the page cache instead of holding a private copy.
+
+        ``model_path`` (fine-tuned ViT weights) must match the weights the index was built
+        with; ``inference_backend`` is one of ``models.INFERENCE_BACKENDS``. ``require_snapshot``
+        only loads the pinned local ViT snapshot, never the hub (see ``models.load_pretrained``).
+
+        ``legacy_mapping_path`` / ``legacy_index_path`` of None ignore pre-generation files,
+        e.g. for an index kept in its own data directory.
+
+        Generations published with a visual-word inverted file add up to
+        ``visual_word_candidates`` scenes ranked by shared visual words to the FAISS
+        candidates; the best of them fill the ``rerank_shortlist`` that gets exact ORB
+        matching. Generations without one re-rank the FAISS candidates only.
+
+        The index is opened in the background while the models load and, with ``warm_up``,
+        run their first forward passes, so the first query is as fast as any other.
+        ``load_seconds`` records how long each part took.
+        """
         base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.faiss_index_path = os.path.join(base_dir, faiss_index_path)
-        self.index_mapping_path = os.path.join(base_dir, index_mapping_path)
-        self.video_dir = os.path.join(base_dir, "videos")
-
-        if os.path.exists(self.faiss_index_path) and os.path.exists(self.index_mapping_path):
-            self.faiss_index = faiss.read_index(self.faiss_index_path)
-            with open(self.index_mapping_path, "r", encoding="utf-8") as f:
-                self.index_mapping = json.load(f)
-        else:
-            self.faiss_index = None
-            self.index_mapping = None
-            print("Warning: Index or mapping file not found. Please run indexing.")
+        self.faiss_index_path = os.path.join(base_dir, faiss_index_path) if faiss_index_path else None
+        self.generations = IndexGenerations(os.path.join(base_dir, generations_dir))
+        self.scene_mapping_dir = os.path.join(base_dir, scene_mapping_dir)
+        self.legacy_mapping_path = os.path.join(base_dir, legacy_mapping_path) if legacy_mapping_path else None
+        self.legacy_index_path = os.path.join(base_dir, legacy_index_path) if legacy_index_path else None
+        self.descriptor_store_dir = os.path.join(base_dir, descriptor_store_dir)
+        self.mmap = mmap
+        # Default IVF nprobe / HNSW efSearch; None keeps the values stored in the index.
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.query_cache = query_cache or QueryCache()
+        self.visual_word_candidates = visual_word_candidates
+        self.rerank_shortlist = rerank_shortlist
+        self.model_path = model_path
+        self.load_seconds = {}
 
-        self.feature_extractor = FeatureExtractor()
+        self.rerank_executor = ThreadPoolExecutor(thread_name_prefix="rerank")
+        loading = self.rerank_executor.submit(self._timed_load, self.generations.current_generation())
+        start_time = time.perf_counter()
+        self.feature_extractor = FeatureExtractor(model_path, backend=inference_backend, require_snapshot=require_snapshot)
         self.local_feature_extractor = LocalFeatureExtractor()
         self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self.load_seconds["models"] = time.perf_counter() - start_time
+        if warm_up:
+            start_time = time.perf_counter()
+            self.feature_extractor.warm_up()
+            self.load_seconds["warm_up"] = time.perf_counter() - start_time
+        self._loaded = loading.result()
+
+    @property
+    def faiss_index(self):
+        return self._loaded.faiss_index
+
+    @property
+    def index_mapping(self) -> SceneMapping | None:
+        return self._loaded.index_mapping
+
+    @property
+    def descriptor_store(self) -> DescriptorStore:
+        return self._loaded.descriptor_store
+
+    @property
+    def generation(self) -> int | None:
+        return self._loaded.generation
 
-    def _get_rerank_score(self, candidate, query_des):
-        """Helper function to calculate the re-ranking score for a single candidate."""
-        video_filename = candidate["id"]
-        video_path = os.path.join(self.video_dir, video_filename)
-        timestamp = float(candidate["timestamp"])
+    def _timed_load(self, generation: int | None) -> _LoadedIndex:
+        start_time = time.perf_counter()
+        loaded = self._load_index(generation)
+        self.load_seconds["index"] = time.perf_counter() - start_time
+        return loaded
 
-        if not os.path.exists(video_path):
-            print(f"Warning: Video file not found at {video_path}")
-            return -1  # Indicate that the file is missing
+    def _load_index(self, generation: int | None) -> _LoadedIndex:
+        """Opens the index files of a generation (None: explicit or pre-generation index)."""
+        descriptor_store = DescriptorStore(self.descriptor_store_dir)
+        mapping_rows = None
+        if self.faiss_index_path is not None:
+            index_path, generation = self.faiss_index_path, None
+        elif generation is not None:
+            index_path = self.generations.index_path(generation)
+            manifest = self.generations.manifest(generation)
+            mapping_rows = manifest["scene_rows"]
+            model_path = os.path.abspath(self.model_path) if self.model_path else None
+            if manifest.get("model_path") != model_path:
+                print(f"Warning: Index generation {generation} was built with ViT weights '{manifest.get('model_path')}', "
+                      f"but queries use '{model_path}'. Results will be poor.")
+        else:
+            index_path = self.legacy_index_path
+
+        index_mapping = open_scene_mapping(self.scene_mapping_dir, self.legacy_mapping_path, lock=self.generations.lock) \
+            if index_path is not None and os.path.exists(index_path) else None
+        if index_mapping is None or not index_mapping.exists():
+            print("Warning: Index or mapping file not found. Please run indexing.")
+            return _LoadedIndex(None, None, descriptor_store, generation)
+
+        if mapping_rows is not None:
+            index_mapping.load(rows=mapping_rows)
+        descriptor_store.load()
+        if len(descriptor_store) < len(index_mapping):
+            print("Warning: Re-ranking descriptors are missing for some scenes. Please run indexing to backfill them.")
+        visual_words = VisualWordIndex.load(self.generations, generation) if generation is not None else None
+        return _LoadedIndex(read_index(index_path, mmap=self.mmap), index_mapping, descriptor_store, generation,
+                            visual_words)
 
-        cap = cv2.VideoCapture(video_path)
-        cap.set(cv2.CAP_PROP_POS_MSEC, timestamp * 1000)
-        ret, frame = cap.read()
-        cap.release()
+    def reload(self, force: bool = False) -> bool:
+        """Switches to the active index generation if it changed, keeping the loaded models.
 
-        if ret:
-            candidate_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            _, cand_des = self.local_feature_extractor.get_features(candidate_image)
+        The new generation is opened completely before one reference assignment swaps it
+        in; searches already running finish on the generation they started with.
+        Cached results are dropped, cached query embeddings are kept. Without a published
+        generation (None) nothing is reloaded until one appears, unless ``force`` is set.
+        """
+        generation = self.generations.current_generation()
+        if not force and generation == self._loaded.generation:
+            return False
+        self._loaded = self._load_index(generation)
+        self.query_cache.invalidate_results()
+        print(f"🔁 Search engine switched to index generation {generation}.")
+        return True
 
-            if cand_des is not None and len(cand_des) > 0:
-                matches = self.bf.match(query_des, cand_des)
-                return len(matches)
+    def _get_rerank_score(self, loaded: _LoadedIndex, faiss_id, query_des):
+        """Helper function to calculate the re-ranking score for a single candidate.
+
+        Only the descriptors stored at index time are read; video files are never touched,
+        so shard hosts without the videos re-rank too. Deleted videos are tombstoned rows,
+        which never reach this point.
+        """
+        local_features = loaded.descriptor_store.get(faiss_id)
+        if local_features is not None:
+            _, cand_des = local_features
+            with metrics.stage("orb_match"):
+                matches = self.bf.match(query_des, np.ascontiguousarray(cand_des))
+            return len(matches)
         return 0
 
 
-    def search(self, image: Image.Image, top_k=5):
-        if self.faiss_index is None:
+    def search(self, image: Image.Image, top_k=5, nprobe=None, ef_search=None):
+        return self.search_batch([image], top_k=top_k, nprobe=nprobe, ef_search=ef_search)[0]
+
+    def search_batch(self, images: list[Image.Image], top_k=5, nprobe=None, ef_search=None) -> list[list[dict]]:
+        """Searches several query images with one ViT forward pass and one FAISS search.
+
+        Images whose results or embeddings are cached skip the corresponding stages.
+        Stage timings go to ``metrics`` (and to ``metrics.collect_timings`` of the caller).
+        """
+        # Everything below uses this generation even if another one is swapped in meanwhile.
+        loaded = self._loaded
+        if loaded.faiss_index is None:
             raise RuntimeError("Faiss index is not loaded.")
 
-        query_embedding = self.feature_extractor.get_embedding(image)
-        query_embedding = np.array([query_embedding], dtype="float32")
-        _, indices = self.faiss_index.search(query_embedding, top_k)
+        nprobe, ef_search = nprobe or self.nprobe, ef_search or self.ef_search
+        # Results of an older generation can never be served from the cache once a new one is live.
+        options = (top_k, nprobe, ef_search, loaded.generation)
+        with metrics.stage("cache_lookup"):
+            keys = [self.query_cache.keys_for(image) for image in images]
+            results = [self.query_cache.get_result(key, options) for key in keys]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
 
-        candidate_info = [self.index_mapping[i] for i in indices[0]]
-        query_kps, query_des = self.local_feature_extractor.get_features(image)
+        with metrics.stage("embed"):
+            query_embeddings = self._embed([images[i] for i in pending], [keys[i] for i in pending])
+        if self.query_cache.perceptual:
+            # Perceptual hits are confirmed against the embedding, so they skip FAISS and re-ranking only.
+            with metrics.stage("cache_lookup"):
+                for i, embedding in zip(pending, query_embeddings):
+                    results[i] = self.query_cache.get_similar_result(keys[i], options, embedding)
+            missing = [j for j, i in enumerate(pending) if results[i] is None]
+            pending, query_embeddings = [pending[j] for j in missing], query_embeddings[missing]
+            if not pending:
+                return results
+        with metrics.stage("faiss_search"):
+            params = search_params(loaded.faiss_index, nprobe, ef_search)
+            _, indices = loaded.faiss_index.search(query_embeddings, top_k, params=params)
+        for i, row, embedding in zip(pending, indices, query_embeddings):
+            with metrics.stage("rerank"):
+                results[i] = self._rerank(loaded, images[i], row, top_k)
+            self.query_cache.put_result(keys[i], options, results[i], embedding)
+        return results
 
-        if query_des is None:
-            return []
+    def search_segments(self, images: list[Image.Image], offsets: list[float] | None = None, top_k=5, nprobe=None,
+                        ef_search=None, tolerance_sec=3.0, max_segments=10) -> tuple[list[dict], list[list[dict]]]:
+        """Searches many frames at once and votes their hits into ranked video segments.
+
+        ``offsets`` are the frames' positions (seconds) in a query clip; without them the
+        images are treated as an unordered set. Returns the segments and the per-frame results.
+        """
+        frame_results = self.search_batch(images, top_k=top_k, nprobe=nprobe, ef_search=ef_search)
+        with metrics.stage("temporal_voting"):
+            segments = vote_segments(frame_results, offsets, tolerance_sec=tolerance_sec, max_segments=max_segments)
+        return segments, frame_results
+
+    def _embed(self, images: list[Image.Image], keys: list[tuple]) -> np.ndarray:
+        """Embeds images in one forward pass, reusing cached embeddings."""
+        embeddings = [self.query_cache.get_embedding(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self.feature_extractor.get_embeddings([images[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                self.query_cache.put_embedding(keys[i], embedding)
+        return np.ascontiguousarray(np.stack(embeddings), dtype="float32")
+
+    def _visual_word_candidates(self, loaded: _LoadedIndex, query_des: np.ndarray, candidate_ids: list[int]) -> list[int]:
+        """Extends the FAISS candidates with the scenes sharing the most visual words with the query.
 
-        scores = []
-        with ThreadPoolExecutor() as executor:
-            future_to_candidate = {executor.submit(self._get_rerank_score, c, query_des): c for c in candidate_info}
-            scores = [future.result() for future in future_to_candidate]
+        The FAISS candidates always stay; the rest of the shortlist is filled in visual-word
+        score order from the best ``visual_word_candidates`` scenes.
+        """
+        rows, scores = loaded.visual_words.score(query_des)
+        keep = ~loaded.index_mapping.removed_mask(rows)
+        rows, scores = rows[keep], scores[keep]
+        best = rows[np.argsort(-scores, kind="stable")[:self.visual_word_candidates]]
+        metrics.VISUAL_WORD_CANDIDATES.observe(len(rows))
+        shortlist = dict.fromkeys(candidate_ids)
+        for row in best:
+            if len(shortlist) >= self.rerank_shortlist:
+                break
+            shortlist.setdefault(int(row))
+        return list(shortlist)
 
+    def _rerank(self, loaded: _LoadedIndex, image: Image.Image, faiss_ids, top_k: int) -> list[dict]:
+        """Re-ranks the candidates of one query by ORB matches against the stored descriptors."""
+        # FAISS ids are stable mapping rows; -1 pads results when the index holds fewer than top_k vectors
+        # and tombstoned rows belong to deleted videos.
+        candidate_ids = [int(i) for i in faiss_ids if not loaded.index_mapping.is_removed(int(i))]
+        with metrics.stage("orb_query_features"):
+            query_kps, query_des = self.local_feature_extractor.get_features(image)
+
+        if query_des is None:
+            metrics.SEARCH_CANDIDATES.observe(len(candidate_ids))
+            return []
+        if loaded.visual_words is not None:
+            with metrics.stage("visual_word_scoring"):
+                candidate_ids = self._visual_word_candidates(loaded, query_des, candidate_ids)
+        candidate_info = [loaded.index_mapping.get(i) for i in candidate_ids]
+        metrics.SEARCH_CANDIDATES.observe(len(candidate_ids))
 
-        valid_results = [
-            (candidate_info[i], scores[i])
-            for i in range(len(scores))
-            if scores[i] != -1
-        ]
+        futures = [self.rerank_executor.submit(self._get_rerank_score, loaded, i, query_des) for i in candidate_ids]
+        scores = [future.result() for future in futures]
 
-        sorted_results = sorted(valid_results, key=lambda item: item[1], reverse=True)
+        sorted_results = sorted(zip(candidate_info, scores, candidate_ids), key=lambda item: item[1], reverse=True)
 
-        return [
-            {
-                "video_id": result[0]["id"],
-                "timestamp": result[0]["timestamp"],
-                "score": result[1],
-            }
-            for result in sorted_results
-        ]
\ No newline at end of file
+        results = []
+        for info, score, faiss_id in sorted_results:
+            result = {"video_id": info["id"], "timestamp": info["timestamp"], "score": score}
+            # Near-duplicate scenes deduplicated at index time share this vector.
+            occurrences = [loaded.index_mapping.get(row) for row in loaded.index_mapping.occurrences(faiss_id)]
+            if occurrences:
+                result["occurrences"] = [{"video_id": o["id"], "timestamp": o["timestamp"]} for o in occurrences]
+            results.append(result)
+        return results[:top_k]
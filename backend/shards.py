@@ -0,0 +1,27 @@
+import zlib
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parses ``"<index>/<count>"`` (e.g. ``"0/4"``) into ``(index, count)``."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}'. Expected '<index>/<count>', e.g. '0/4'.")
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{spec}'. The index must be between 0 and {count - 1}.")
+    return index, count
+
+
+def shard_of(video_name: str, num_shards: int) -> int:
+    """Shard a video belongs to; stable across processes, hosts and Python versions."""
+    return zlib.crc32(video_name.encode("utf-8")) % num_shards
+
+
+def merge_results(shard_results: list[list[dict]], top_k: int) -> list[dict]:
+    """Merges the re-ranked results of several shards into one global top-k.
+
+    Scores are ORB match counts against the same query, so they compare across shards.
+    """
+    merged = [result for results in shard_results for result in results]
+    merged.sort(key=lambda result: result["score"], reverse=True)
+    return merged[:top_k]
@@ -1,23 +1,78 @@
 import cv2
 from PIL import Image
 import os
+import queue
+import time
+import multiprocessing
 from tqdm import tqdm
 import faiss
 import numpy as np
-import json
-from scenedetect import open_video, SceneManager
-from scenedetect.detectors import ContentDetector
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 
-from .models import FeatureExtractor
+# torch, transformers (.models) and scenedetect (.scene_capture) are imported where they are
+# used, so the API server can import this module without paying for them at startup.
+from .descriptor_store import DescriptorStore
+from .index_factory import (
+    create_index, export_vectors, index_ids, index_type_of, min_training_size, default_nlist, needs_retraining,
+)
+from .scene_mapping import SceneMapping, open_scene_mapping
+from .generations import IndexGenerations
+from .failed_videos import FailedVideos, file_state
+from .previews import PreviewCache
+from .dedup import assign_representatives
+from .visual_words import ATTACHMENTS as VISUAL_WORD_ATTACHMENTS, VisualWordStore
+from .shards import shard_of
+from . import metrics
 
 # --- Settings ---
 VIDEO_DIR = os.path.join(os.path.dirname(__file__), "videos")
+# Versioned index generations; each build publishes a new one
+GENERATIONS_DIR = os.path.join(os.path.dirname(__file__), "index_generations")
+KEEP_GENERATIONS = 3
+# Pre-generation index; read by the first build and superseded by its generation
 INDEX_PATH = os.path.join(os.path.dirname(__file__), "index.faiss")
-MAPPING_PATH = os.path.join(os.path.dirname(__file__), "index_mapping.json")
+MAPPING_DIR = os.path.join(os.path.dirname(__file__), "scene_mapping")
+# Pre-columnar mapping; migrated into MAPPING_DIR on first use
+LEGACY_MAPPING_PATH = os.path.join(os.path.dirname(__file__), "index_mapping.json")
+DESCRIPTOR_STORE_DIR = os.path.join(os.path.dirname(__file__), "orb_store")
+# Visual vocabulary and per-descriptor visual words behind the re-ranking inverted file
+VISUAL_WORDS_DIR = os.path.join(os.path.dirname(__file__), "visual_words")
+# Cached result thumbnails and preview clips (see previews.PreviewCache)
+PREVIEW_DIR = os.path.join(os.path.dirname(__file__), "previews")
 RESIZE_DIM = (224, 224)
-# Adjust the number of workers based on your CPU cores
-MAX_WORKERS = os.cpu_count() or 1
+# Adjust the number of decoder processes based on your CPU cores
+MAX_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# Scene frames embedded per ViT forward pass
+EMBED_BATCH_SIZE = 32
+# Intra-op threads for the embedder; 0 keeps torch's default
+TORCH_THREADS = max(1, (os.cpu_count() or 1) - MAX_WORKERS)
+# Decoded frames buffered between stages, in batches
+QUEUE_BATCHES = 4
+# Embedding model: fine-tuned ViT weights (None: pretrained) and one of models.INFERENCE_BACKENDS
+MODEL_PATH = None
+INFERENCE_BACKEND = "eager"
+# FAISS index type: "flat", "ivf_flat", "ivf_pq" or "hnsw"
+INDEX_TYPE = "flat"
+# Scene detection: "two_pass" (detect, then seek to every mid-frame) or "single_pass"
+# (capture mid-frames while detection streams through the video, no seeking)
+SCENE_DETECTION = "two_pass"
+# Single pass only: frames skipped between detector samples, and detector input width
+DETECT_FRAME_SKIP = 0
+DETECT_WIDTH = 256
+# Cosine similarity at which a new scene is stored as an occurrence of an already indexed
+# near-identical scene instead of getting its own vector (e.g. 0.97); None disables dedup
+DEDUP_THRESHOLD = None
+# Publish a visual-word inverted file over the ORB descriptors with every generation, so
+# search can score hundreds of candidates before exact matching; False skips it
+VISUAL_WORDS = True
+# Publish a generation with the videos finished so far at most this often (seconds) during a
+# build, so a crash loses little work and new videos become searchable early; None: once at the end
+CHECKPOINT_SECONDS = 60.0
+# Publishing rewrites the whole index and visual-word file, so checkpoints are also spaced at
+# least this many times the last publish took; the build then spends at most ~1/ratio publishing
+CHECKPOINT_COST_RATIO = 10.0
+# Cache the result thumbnail of every new scene while its frame is decoded anyway
+THUMBNAILS = True
 
 
 def _parse_timestamp(timestamp_str: str) -> float:
@@ -28,9 +83,9 @@ def _parse_timestamp(timestamp_str: str) -> float:
         return seconds
     return float(timestamp_str)
 
-def get_frame_from_video(video_file: str, timestamp: str | float) -> Image.Image | None:
+def get_frame_from_video(video_file: str, timestamp: str | float, video_dir: str = VIDEO_DIR) -> Image.Image | None:
     """Extracts a frame from a video at a specific timestamp."""
-    video_path = os.path.join(VIDEO_DIR, video_file)
+    video_path = os.path.join(video_dir, video_file)
     if not os.path.exists(video_path):
         return None
     cap = cv2.VideoCapture(video_path)
@@ -45,104 +100,642 @@ def get_frame_from_video(video_file: str, timestamp: str | float) -> Image.Image
         return Image.fromarray(frame_rgb)
     return None
 
-def process_video(video_file: str, feature_extractor: FeatureExtractor) -> list[tuple[np.ndarray, dict]]:
-    """Processes a single video file to extract scene-based features."""
-    video_path = os.path.join(VIDEO_DIR, video_file)
-    results = []
-    try:
-        video = open_video(video_path)
-        scene_manager = SceneManager()
-        scene_manager.add_detector(ContentDetector(threshold=27.0))
-        scene_manager.detect_scenes(video, show_progress=False)
-        scene_list = scene_manager.get_scene_list()
+def _local_features(local_feature_extractor: "LocalFeatureExtractor", image: Image.Image) -> tuple[np.ndarray, np.ndarray | None]:
+    """Extracts ORB features of a full-resolution frame in the layout of the descriptor store."""
+    keypoints, descriptors = local_feature_extractor.get_features(image)
+    return local_feature_extractor.keypoints_to_array(keypoints), descriptors
+
+
+def _scene_result(video_file: str, timestamp_sec: float, frame_rgb: np.ndarray,
+                  local_feature_extractor: "LocalFeatureExtractor", video_path: str | None = None,
+                  previews: PreviewCache | None = None) -> tuple[dict, np.ndarray, tuple]:
+    """Builds ``(mapping_info, frame_224, local_features)`` for a representative frame."""
+    if previews is not None:
+        previews.put_thumbnail(video_path, timestamp_sec, frame_rgb)
+    full_image = Image.fromarray(frame_rgb)
+    local_features = _local_features(local_feature_extractor, full_image)
+    frame_small = np.asarray(full_image.resize(RESIZE_DIM))
+    return {"id": video_file, "timestamp": f"{timestamp_sec:.2f}"}, frame_small, local_features
+
+
+def _iter_scene_frames(video_file: str, detection: str = SCENE_DETECTION, frame_skip: int = DETECT_FRAME_SKIP,
+                       detect_width: int = DETECT_WIDTH, video_dir: str = VIDEO_DIR, preview_dir: str | None = None):
+    """Yields ``(mapping_info, frame_224, local_features)`` for the middle frame of every scene.
 
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            print(f"Warning: Could not open '{video_file}'. Skipping.")
-            return []
+    With ``preview_dir``, the scenes' result thumbnails are cached there as well (without
+    evicting; ``build_index`` sweeps the cache once per build).
+    """
+    from .models import LocalFeatureExtractor
 
+    video_path = os.path.join(video_dir, video_file)
+    local_feature_extractor = LocalFeatureExtractor()
+    previews = PreviewCache(preview_dir) if preview_dir else None
+
+    if detection == "single_pass":
+        from .scene_capture import capture_scene_frames
+        for timestamp_sec, frame_rgb in capture_scene_frames(video_path, threshold=27.0, frame_skip=frame_skip,
+                                                             detect_width=detect_width):
+            yield _scene_result(video_file, timestamp_sec, frame_rgb, local_feature_extractor, video_path, previews)
+        return
+
+    from scenedetect import open_video, SceneManager
+    from scenedetect.detectors import ContentDetector
+
+    video = open_video(video_path)
+    scene_manager = SceneManager()
+    scene_manager.add_detector(ContentDetector(threshold=27.0))
+    scene_manager.detect_scenes(video, show_progress=False)
+    scene_list = scene_manager.get_scene_list()
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Warning: Could not open '{video_file}'. Skipping.")
+        return
+
+    try:
         for scene_start, scene_end in scene_list:
             middle_timestamp_sec = scene_start.get_seconds() + (scene_end.get_seconds() - scene_start.get_seconds()) / 2
             cap.set(cv2.CAP_PROP_POS_MSEC, middle_timestamp_sec * 1000)
             ret, frame = cap.read()
             if ret:
                 frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb).resize(RESIZE_DIM)
-                embedding = feature_extractor.get_embedding(pil_image)
-                mapping_info = {"id": video_file, "timestamp": f"{middle_timestamp_sec:.2f}"}
-                results.append((embedding, mapping_info))
+                yield _scene_result(video_file, middle_timestamp_sec, frame_rgb, local_feature_extractor,
+                                    video_path, previews)
+    finally:
         cap.release()
+
+
+def _record_video(stage: str, seconds: float, scenes: int, failed: bool):
+    metrics.STAGE_SECONDS.observe(seconds, stage=stage)
+    metrics.SCENES_PER_VIDEO.observe(scenes)
+    metrics.INDEXED_VIDEOS.inc(outcome="failed" if failed else "ok")
+
+
+def process_video(video_file: str, feature_extractor: "FeatureExtractor", batch_size: int = EMBED_BATCH_SIZE,
+                  **scene_options) -> list[tuple[np.ndarray, dict, tuple]]:
+    """Processes a single video file to extract scene-based features.
+
+    Each result holds the scene embedding, its mapping info and the ORB
+    ``(keypoints_xy, descriptors)`` of the full-resolution frame used for re-ranking.
+    """
+    results = []
+    start_time = time.perf_counter()
+    failed = False
+    try:
+        scenes = list(_iter_scene_frames(video_file, **scene_options))
+        for start in range(0, len(scenes), batch_size):
+            batch = scenes[start:start + batch_size]
+            embeddings = feature_extractor.get_embeddings([Image.fromarray(frame) for _, frame, _ in batch])
+            for embedding, (mapping_info, _, local_features) in zip(embeddings, batch):
+                results.append((embedding, mapping_info, local_features))
     except Exception as e:
         print(f"Error processing '{video_file}': {e}")
+        failed = True
+    _record_video("index_process_video", time.perf_counter() - start_time, len(results), failed)
     return results
 
 
-def build_index():
-    """Builds or updates the FAISS index for the videos."""
-    if not os.path.exists(VIDEO_DIR):
-        os.makedirs(VIDEO_DIR)
-        print("Video directory created. Please add videos to the 'videos' folder.")
+def _decode_worker(video_file: str, frame_queue, scene_options: dict) -> dict:
+    """Decoder stage: pushes the scene frames of one video into the shared queue.
+
+    Runs in a separate process. A ``(video_file, None, error)`` marker is always pushed
+    last so the embedder stage knows the video is finished, even on errors.
+    Returns the video's decode stats, since metrics of this process are not visible.
+    """
+    scene_count = 0
+    start_time = time.perf_counter()
+    error = None
+    try:
+        for mapping_info, frame_small, local_features in _iter_scene_frames(video_file, **scene_options):
+            frame_queue.put((video_file, (mapping_info, frame_small, local_features), None))
+            scene_count += 1
+    except Exception as e:
+        print(f"Error processing '{video_file}': {e}")
+        error = str(e).strip() or type(e).__name__
+    finally:
+        frame_queue.put((video_file, None, error))
+    return {"seconds": time.perf_counter() - start_time, "scenes": scene_count, "failed": error is not None}
+
+
+def _run_indexing_pipeline(videos_to_process: list[str], feature_extractor: "FeatureExtractor",
+                           batch_size: int, decode_workers: int, scene_options: dict, on_video_start=None):
+    """Decodes videos in worker processes and embeds their scene frames in batches.
+
+    Decoder processes feed a bounded queue so decoding never runs far ahead of
+    the embedder, which keeps memory flat while both stages stay busy.
+
+    Yields ``(video_file, results, error)`` as soon as every scene of a video is embedded,
+    so callers can checkpoint video by video. ``error`` is None on success; a failed
+    video's scenes are dropped. ``on_video_start(video_file)`` is called when the first
+    scene of a video arrives.
+    """
+    results = {video_file: [] for video_file in videos_to_process}
+    batch = []
+
+    def flush():
+        if not batch:
+            return
+        with metrics.stage("index_embed_batch"):
+            embeddings = feature_extractor.get_embeddings([Image.fromarray(frame) for _, (_, frame, _) in batch])
+        for embedding, (video_file, (mapping_info, _, local_features)) in zip(embeddings, batch):
+            results[video_file].append((embedding, mapping_info, local_features))
+        batch.clear()
+
+    # Decoders are not forked from this process: they would inherit the build lock and keep
+    # holding it if a killed build left them behind, blocking every later build.
+    context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    with context.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=decode_workers, mp_context=context) as executor, \
+            tqdm(total=len(videos_to_process), desc="Processing Videos") as progress:
+        frame_queue = manager.Queue(maxsize=batch_size * QUEUE_BATCHES)
+        futures = {vf: executor.submit(_decode_worker, vf, frame_queue, scene_options) for vf in videos_to_process}
+        pending = set(videos_to_process)
+        started = set()
+        while pending:
+            try:
+                video_file, item, error = frame_queue.get(timeout=1.0)
+            except queue.Empty:
+                # A decoder process that died without its end marker must not hang the build.
+                if all(f.done() for f in futures.values()) and frame_queue.empty():
+                    break
+                continue
+            if video_file not in started:
+                started.add(video_file)
+                if on_video_start is not None:
+                    on_video_start(video_file)
+            if item is not None:
+                batch.append((video_file, item))
+                if len(batch) >= batch_size:
+                    flush()
+                continue
+            # The video's last scenes may still wait in a partial batch.
+            if any(queued_video == video_file for queued_video, _ in batch):
+                flush()
+            pending.discard(video_file)
+            progress.update(1)
+            video_results = results.pop(video_file)
+            yield video_file, (video_results if error is None else []), error
+
+        for video_file in sorted(pending):
+            exception = futures[video_file].exception() if futures[video_file].done() else None
+            print(f"A decoder worker failed on '{video_file}': {exception}")
+            results.pop(video_file)
+            yield video_file, [], f"Decoder worker failed: {exception}"
+
+    for future in futures.values():
+        if future.exception() is None:
+            _record_video("index_decode_video", **future.result())
+        else:
+            metrics.INDEXED_VIDEOS.inc(outcome="failed")
+
+
+def _backfill_descriptor_store(descriptor_store: DescriptorStore, scene_mapping: SceneMapping, video_dir: str = VIDEO_DIR):
+    """Computes ORB features for indexed scenes that predate the descriptor store."""
+    if len(descriptor_store) > len(scene_mapping):
+        descriptor_store.truncate(len(scene_mapping))
+    missing_rows = range(len(descriptor_store), len(scene_mapping))
+    if not missing_rows:
         return
 
-    all_video_files = {f for f in os.listdir(VIDEO_DIR) if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv'))}
+    print(f"🧩 Computing re-ranking descriptors for {len(missing_rows)} already indexed scenes...")
+    from .models import LocalFeatureExtractor
+
+    start_time = time.perf_counter()
+    local_feature_extractor = LocalFeatureExtractor()
+    features = []
+    for row in tqdm(missing_rows, desc="Backfilling Descriptors"):
+        item = scene_mapping.get(row)
+        frame = get_frame_from_video(item["id"], item["timestamp"], video_dir) if item["id"] is not None else None
+        features.append(_local_features(local_feature_extractor, frame) if frame is not None else (None, None))
+    descriptor_store.append(features)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - start_time, stage="index_backfill")
+
+
+def _trainable_index_type(index_type: str, num_vectors: int) -> str:
+    """Falls back to a flat index until there are enough vectors to train the requested type."""
+    if num_vectors < min_training_size(index_type, default_nlist(num_vectors)):
+        print(f"Warning: {num_vectors} vectors are too few to train a '{index_type}' index. Using 'flat' for now.")
+        return "flat"
+    return index_type
+
+
+def _rebuild_index(index: faiss.Index, index_type: str, scene_mapping: SceneMapping,
+                   removed_rows: np.ndarray | None = None) -> faiss.Index:
+    """Rebuilds an index as ``index_type`` from its stored vectors, dropping removed scenes."""
+    ids, vectors = export_vectors(index)
+    keep = ~scene_mapping.removed_mask(ids)
+    if removed_rows is not None:
+        keep &= ~np.isin(ids, removed_rows)
+    ids, vectors = ids[keep], np.ascontiguousarray(vectors[keep])
+    rebuilt = create_index(_trainable_index_type(index_type, len(ids)), index.d, training_vectors=vectors)
+    if len(ids):
+        rebuilt.add_with_ids(vectors, ids)
+    return rebuilt
+
+
+def _convert_index(index: faiss.Index, index_type: str, scene_mapping: SceneMapping) -> faiss.Index:
+    """Converts an index to ``index_type`` with stable ids, keeping every live vector and id.
+
+    Also converts legacy positional indexes, whose ids are the mapping rows.
+    """
+    is_id_mapped = isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)) or faiss.try_extract_index_ivf(index) is not None
+    target_type = _trainable_index_type(index_type, index.ntotal)
+    if is_id_mapped and index_type_of(index) in (index_type, target_type):
+        return index
+    print(f"🔁 Converting the existing index to a '{target_type}' index with stable ids (one-time)...")
+    return _rebuild_index(index, index_type, scene_mapping)
+
+
+def _remove_videos(index: faiss.Index, scene_mapping: SceneMapping,
+                   removed_videos: set[str]) -> tuple[faiss.Index, np.ndarray, list[tuple[np.ndarray, int]]]:
+    """Drops the vectors of removed videos from the index.
+
+    Returns the updated index, the mapping rows to tombstone once it is saved and the
+    ``(rows, representative)`` updates for deduplicated scenes that lost their representative.
+    Rows are kept as tombstones so the ids of all other scenes stay stable.
+    """
+    removed_rows = scene_mapping.rows_of_videos(removed_videos)
+    promotions = []
+    for old_representative, surviving in scene_mapping.orphaned_duplicates(removed_rows):
+        # A surviving occurrence takes over the shared vector under its own id.
+        index.add_with_ids(index.reconstruct(old_representative).reshape(1, -1), surviving[:1])
+        promotions.append((surviving, int(surviving[0])))
+    if len(removed_rows):
+        try:
+            index.remove_ids(removed_rows)
+        except RuntimeError:
+            # HNSW graphs cannot drop vectors in place, so the graph is rebuilt from the live vectors.
+            print(f"🔁 The '{index_type_of(index)}' index cannot remove vectors in place. Rebuilding it...")
+            index = _rebuild_index(index, index_type_of(index), scene_mapping, removed_rows)
+    return index, removed_rows, promotions
+
+
+def data_paths(data_dir: str | None = None) -> dict:
+    """Locations of the index generations, scene mapping, descriptor store, visual words, failed videos and previews.
+
+    ``None`` is the default layout next to this module, which also picks up a legacy
+    ``index.faiss`` / ``index_mapping.json``; any other directory holds a separate index.
+    """
+    if data_dir is None:
+        return {"generations_dir": GENERATIONS_DIR, "mapping_dir": MAPPING_DIR, "descriptor_store_dir": DESCRIPTOR_STORE_DIR,
+                "visual_words_dir": VISUAL_WORDS_DIR, "failures_path": os.path.join(GENERATIONS_DIR, "failed_videos.json"),
+                "preview_dir": PREVIEW_DIR, "legacy_index_path": INDEX_PATH, "legacy_mapping_path": LEGACY_MAPPING_PATH}
+    return {
+        "generations_dir": os.path.join(data_dir, "index_generations"),
+        "mapping_dir": os.path.join(data_dir, "scene_mapping"),
+        "descriptor_store_dir": os.path.join(data_dir, "orb_store"),
+        "visual_words_dir": os.path.join(data_dir, "visual_words"),
+        "failures_path": os.path.join(data_dir, "index_generations", "failed_videos.json"),
+        "preview_dir": os.path.join(data_dir, "previews"),
+        "legacy_index_path": None,
+        "legacy_mapping_path": None,
+    }
+
+
+def current_index_path(data_dir: str | None = None) -> str | None:
+    """Index file of the active generation, falling back to a pre-generation ``index.faiss``."""
+    paths = data_paths(data_dir)
+    generations = IndexGenerations(paths["generations_dir"])
+    generation = generations.current_generation()
+    if generation is not None:
+        return generations.index_path(generation)
+    legacy_index_path = paths["legacy_index_path"]
+    return legacy_index_path if legacy_index_path and os.path.exists(legacy_index_path) else None
+
+
+def _add_scenes(index: faiss.Index | None, index_type: str, scene_mapping: SceneMapping, descriptor_store: DescriptorStore,
+                embeddings: list[np.ndarray], mapping_items: list[dict], local_features: list[tuple],
+                dedup_threshold: float | None, report) -> tuple[faiss.Index, int]:
+    """Appends new scenes to the mapping, descriptor store and index (created on first use).
+
+    Returns the index and the number of scenes stored as occurrences of a near-duplicate.
+    """
+    # Mapping rows and descriptors are appended before the index is written; a crash in
+    # between is repaired by truncating both back to the committed rows on the next build.
+    # New scenes get the next unused ids, so existing ids never move.
+    embeddings_np = np.array(embeddings, dtype='float32')
+    first_row = scene_mapping.next_row()
+    representatives = np.arange(first_row, first_row + len(embeddings_np), dtype=np.int64)
+    if dedup_threshold is not None:
+        report(stage="deduplicating")
+        with metrics.stage("index_dedup"):
+            representatives = assign_representatives(embeddings_np, first_row, index, dedup_threshold)
+        for item, representative in zip(mapping_items, representatives):
+            item["representative"] = int(representative)
+    new_ids = scene_mapping.append(mapping_items)
+    descriptor_store.append(local_features)
+
+    # Only scenes that represent themselves get a vector; duplicates are found through it.
+    own_vector = representatives == new_ids
+    if index is None:
+        index = create_index(_trainable_index_type(index_type, int(own_vector.sum())), embeddings_np.shape[1],
+                             training_vectors=embeddings_np[own_vector])
+    index.add_with_ids(np.ascontiguousarray(embeddings_np[own_vector]), new_ids[own_vector])
+    return index, int((~own_vector).sum())
+
+
+def _visual_word_attachments(index: faiss.Index, scene_mapping: SceneMapping, descriptor_store: DescriptorStore,
+                             visual_words: VisualWordStore) -> dict[str, np.ndarray] | None:
+    """Inverted file over the descriptors of the scenes that have a vector in ``index``.
+
+    Duplicates are left out like in the index; search expands a hit to its occurrences.
+    """
+    with metrics.stage("visual_word_index"):
+        if not visual_words.update(descriptor_store, scene_mapping.committed_rows()):
+            print("📚 Too few ORB descriptors for a visual vocabulary yet. Publishing without visual words.")
+            return None
+        return visual_words.inverted_index(descriptor_store, index_ids(index))
+
+
+def _save_index(index: faiss.Index, scene_mapping: SceneMapping, generations: IndexGenerations,
+                model_path: str | None, removed_rows: np.ndarray | None = None,
+                promotions: list[tuple[np.ndarray, int]] = (), descriptor_store: DescriptorStore | None = None,
+                visual_words: VisualWordStore | None = None) -> tuple[faiss.Index, dict]:
+    """Publishes the index as a new generation, then commits appended mapping rows and tombstones removed ones.
+
+    Readers switch to the generation only once it is complete. If the process dies before
+    the commit, the next build rolls the mapping forward to the rows the index references.
+    With ``visual_words``, the generation also gets the inverted file of ``descriptor_store``.
+    An IVF index that outgrew its lists is retrained on its stored vectors first (the lossy
+    reconstructions for ``ivf_pq``); the published index is returned with the manifest.
+    """
+    if needs_retraining(index):
+        print(f"🔁 The index outgrew its {faiss.try_extract_index_ivf(index).nlist} IVF lists. "
+              f"Retraining it on {index.ntotal} vectors...")
+        with metrics.stage("index_retrain"):
+            # Every stored vector is live, including those of rows that are not committed yet.
+            ids, vectors = export_vectors(index)
+            retrained = create_index(index_type_of(index), index.d, training_vectors=vectors)
+            retrained.add_with_ids(np.ascontiguousarray(vectors), ids)
+            index = retrained
+    attachments = None
+    if visual_words is not None:
+        attachments = _visual_word_attachments(index, scene_mapping, descriptor_store, visual_words)
+    with metrics.stage("index_publish"):
+        manifest = generations.publish(
+            index,
+            attachments=attachments,
+            index_type=index_type_of(index),
+            scene_rows=scene_mapping.file_rows(),
+            # Queries must be embedded with the same weights as the indexed scenes.
+            model_path=os.path.abspath(model_path) if model_path else None,
+            # Whether visual words were built, even if there were too few descriptors for them yet.
+            visual_words=visual_words is not None,
+        )
+        scene_mapping.commit()
+        for rows, representative in promotions:
+            scene_mapping.set_representative(rows, representative)
+        if removed_rows is not None:
+            scene_mapping.remove_rows(removed_rows)
+    return index, manifest
+
+
+def _load_feature_extractor(model_path: str | None, inference_backend: str) -> "FeatureExtractor":
+    from .models import FeatureExtractor
+    return FeatureExtractor(model_path, inference_backend)
+
+
+def build_index(batch_size: int = EMBED_BATCH_SIZE, torch_threads: int = TORCH_THREADS, decode_workers: int = MAX_WORKERS,
+                index_type: str = INDEX_TYPE, detection: str = SCENE_DETECTION, frame_skip: int = DETECT_FRAME_SKIP,
+                model_path: str | None = MODEL_PATH, inference_backend: str = INFERENCE_BACKEND,
+                feature_extractor: "FeatureExtractor | None" = None, video_dir: str = VIDEO_DIR,
+                data_dir: str | None = None, dedup_threshold: float | None = DEDUP_THRESHOLD,
+                shard: tuple[int, int] | None = None, visual_words: bool = VISUAL_WORDS,
+                checkpoint_seconds: float | None = CHECKPOINT_SECONDS, skip_videos: set[str] | None = None,
+                thumbnails: bool = THUMBNAILS, checkpoint_cost_ratio: float = CHECKPOINT_COST_RATIO) -> dict | None:
+    """Builds or updates the FAISS index for the videos.
+
+    Only one build runs at a time across all processes; a concurrent call raises
+    ``generations.BuildInProgressError``. Progress is recorded in the generations
+    directory (``IndexGenerations.read_status``).
+
+    Args:
+        batch_size: Number of scene frames per ViT forward pass.
+        torch_threads: Intra-op threads for the embedder (0 keeps torch's default).
+        decode_workers: Number of decoder processes running scene detection.
+        index_type: One of ``index_factory.INDEX_TYPES``. An existing index of another
+            type is retrained on its stored vectors and converted once.
+        detection: ``"two_pass"`` or ``"single_pass"`` scene detection.
+        frame_skip: Single pass only; frames skipped between scene detector samples.
+        model_path: Fine-tuned ViT weights; the search engine must load the same ones.
+        inference_backend: One of ``models.INFERENCE_BACKENDS`` for the embedder.
+        feature_extractor: An already loaded extractor to reuse instead of loading the model
+            (its own weights and backend apply).
+        video_dir: Folder with the videos to index.
+        data_dir: Where the index is kept (see ``data_paths``); None is the default layout.
+        dedup_threshold: Cosine similarity above which a new scene only becomes another
+            occurrence of a near-identical indexed scene; None indexes every scene.
+        shard: ``(index, count)`` to only index the videos of one shard (see ``shards.shard_of``)
+            into ``data_dir``. Videos that moved to another shard are dropped like deleted ones.
+        visual_words: Publish the visual-word inverted file the search engine uses to pick
+            re-ranking candidates (see ``visual_words.VisualWordStore``).
+        checkpoint_seconds: Publish the videos finished so far at most this often; a restarted
+            build resumes after the last checkpoint. None publishes once at the end.
+        skip_videos: New videos to leave for a later build, e.g. files still being copied.
+        thumbnails: Cache the result thumbnails of new scenes in ``data_paths()["preview_dir"]``.
+        checkpoint_cost_ratio: Also space checkpoints at least this many times as long as the
+            last one took to publish, which grows with the index; 0 keeps ``checkpoint_seconds``.
+
+    Videos that fail are recorded with their error in ``data_paths()["failures_path"]``
+    and retried by later builds with a growing delay (see ``failed_videos.FailedVideos``).
+
+    Returns:
+        The manifest of the published generation, or None if the index did not change.
+    """
+    paths = data_paths(data_dir)
+    generations = IndexGenerations(paths["generations_dir"], keep=KEEP_GENERATIONS)
+    with generations.lock:
+        status = {"state": "running", "stage": "scanning", "started_at": time.time(), "videos_total": 0, "videos_done": 0,
+                  "generation": generations.current_generation()}
+
+        def report(**changes):
+            status.update(changes)
+            generations.write_status(**status)
+
+        report()
+        start_time = time.perf_counter()
+        try:
+            if feature_extractor is not None:
+                model_path = feature_extractor.model_path
+            manifest = _build_index(generations, report, batch_size, torch_threads, decode_workers, index_type,
+                                    {"detection": detection, "frame_skip": frame_skip, "detect_width": DETECT_WIDTH,
+                                     "video_dir": video_dir, "preview_dir": paths["preview_dir"] if thumbnails else None},
+                                    paths, data_dir, model_path, lambda: feature_extractor or _load_feature_extractor(model_path, inference_backend),
+                                    dedup_threshold, shard, visual_words, checkpoint_seconds, checkpoint_cost_ratio,
+                                    skip_videos)
+        except Exception as e:
+            report(state="failed", stage=None, error=str(e), finished_at=time.time())
+            metrics.INDEX_BUILDS.inc(outcome="failed")
+            raise
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start_time, stage="index_build")
+        metrics.INDEX_BUILDS.inc(outcome="published" if manifest is not None else "unchanged")
+        report(state="idle", stage=None, finished_at=time.time(), generation=generations.current_generation())
+        return manifest
+
+
+def _build_index(generations: IndexGenerations, report, batch_size: int, torch_threads: int, decode_workers: int,
+                 index_type: str, scene_options: dict, paths: dict, data_dir: str | None, model_path: str | None,
+                 load_feature_extractor, dedup_threshold: float | None, shard: tuple[int, int] | None,
+                 visual_words: bool, checkpoint_seconds: float | None, checkpoint_cost_ratio: float,
+                 skip_videos: set[str] | None) -> dict | None:
+    video_dir = scene_options["video_dir"]
+    if not os.path.exists(video_dir):
+        os.makedirs(video_dir)
+        print("Video directory created. Please add videos to the 'videos' folder.")
+        return None
+
+    all_video_files = {f for f in os.listdir(video_dir) if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv'))}
+    if shard is not None:
+        shard_index, num_shards = shard
+        total_videos = len(all_video_files)
+        all_video_files = {f for f in all_video_files if shard_of(f, num_shards) == shard_index}
+        print(f"🧩 Shard {shard_index}/{num_shards}: {len(all_video_files)} of {total_videos} videos.")
 
     indexed_videos = set()
-    all_embeddings = []
-    index_mapping = []
+    index = None
+    scene_mapping = open_scene_mapping(paths["mapping_dir"], paths["legacy_mapping_path"], migrate=True)
+    index_changed = False
+    removed_rows = None
+    promotions = []
+    index_path = current_index_path(data_dir)
 
-    if os.path.exists(MAPPING_PATH) and os.path.exists(INDEX_PATH):
+    if scene_mapping.exists() and index_path is not None:
         print("📖 Reading existing index files...")
-        with open(MAPPING_PATH, 'r', encoding='utf-8') as f:
-            index_mapping = json.load(f)
-        for item in index_mapping:
-            indexed_videos.add(item['id'])
-        index = faiss.read_index(INDEX_PATH)
-        all_embeddings = [index.reconstruct(i) for i in range(index.ntotal)]
+        stored_index = faiss.read_index(index_path)
+        ids = index_ids(stored_index)
+        previous = generations.current()
+        # An index written by a build that died before committing still references its rows.
+        # Its manifest knows them all, including trailing duplicates that have no vector.
+        if previous is not None and "scene_rows" in previous:
+            scene_mapping.roll_forward(previous["scene_rows"])
+        else:
+            scene_mapping.roll_forward(int(ids.max()) + 1 if len(ids) else 0)
+        indexed_videos = scene_mapping.indexed_videos()
+        index = _convert_index(stored_index, index_type, scene_mapping)
+        # The first build after the upgrade publishes the pre-generation index as generation 1.
+        index_changed = index is not stored_index or generations.current_generation() is None
+        # Generations published without visual words (before they existed, or with them turned
+        # off) get their inverted file once.
+        if visual_words and previous is not None and not previous.get("visual_words") \
+                and not set(VISUAL_WORD_ATTACHMENTS) <= set(previous.get("attachments", ())):
+            index_changed = True
+        if previous is not None and previous.get("model_path") != (os.path.abspath(model_path) if model_path else None):
+            print("Warning: The existing index was embedded with other ViT weights. New scenes will not be comparable; "
+                  "delete the index generations to re-index everything.")
         print(f"A total of {len(indexed_videos)} videos are already indexed.")
+    else:
+        scene_mapping.reset()
+
+    descriptor_store = DescriptorStore(paths["descriptor_store_dir"]).load()
+    report(stage="backfilling descriptors")
+    _backfill_descriptor_store(descriptor_store, scene_mapping, video_dir)
+    visual_words = VisualWordStore(paths["visual_words_dir"]) if visual_words else None
 
-    videos_to_process = sorted(list(all_video_files - indexed_videos))
+    removed_videos = indexed_videos - all_video_files
+    if removed_videos:
+        index, removed_rows, promotions = _remove_videos(index, scene_mapping, removed_videos)
+        print(f"🗑️ Removed {len(removed_rows)} scenes of {len(removed_videos)} videos deleted from the videos folder.")
+        index_changed = True
+
+    failures = FailedVideos(paths["failures_path"])
+    # Entries of videos that were indexed or deleted meanwhile are obsolete.
+    failures.retain(all_video_files - indexed_videos)
+    new_videos = sorted(all_video_files - indexed_videos - set(skip_videos or ()))
+    file_states = {f: file_state(os.path.join(video_dir, f)) for f in new_videos}
+    videos_to_process = [f for f in new_videos if failures.should_process(f, file_states[f])]
+    if len(videos_to_process) < len(new_videos):
+        print(f"⏳ Skipping {len(new_videos) - len(videos_to_process)} failed videos until their retry is due.")
 
     if not videos_to_process:
+        manifest = None
+        if index_changed:
+            report(stage="publishing")
+            index, manifest = _save_index(index, scene_mapping, generations, model_path, removed_rows, promotions,
+                                          descriptor_store, visual_words)
+            print(f"   - Total frames in index: {index.ntotal} (generation {manifest['generation']})")
         print("✅ No new videos to process. All videos are up-to-date.")
-        return
+        return manifest
 
     print(f"🎥 Found {len(videos_to_process)} new videos. Starting scene-based indexing...")
+    report(stage="processing videos", videos_total=len(videos_to_process))
 
-    feature_extractor = FeatureExtractor()
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+    feature_extractor = load_feature_extractor()
     new_embeddings = []
     new_mapping_items = []
+    new_local_features = []
+    finished_videos = []
+    manifest = None
+    scenes_added = 0
+    duplicates = 0
+    videos_done = 0
+    last_publish = time.monotonic()
+    publish_interval = checkpoint_seconds
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_video, vf, feature_extractor): vf for vf in videos_to_process}
-        for future in tqdm(as_completed(futures), total=len(videos_to_process), desc="Processing Videos"):
-            try:
-                video_results = future.result()
-                for embedding, mapping_info in video_results:
-                    new_embeddings.append(embedding)
-                    new_mapping_items.append(mapping_info)
-            except Exception as e:
-                video_file = futures[future]
-                print(f"An error occurred while processing {video_file}: {e}")
-
-    if not new_embeddings:
-        print("No feature vectors were extracted from the new videos. Ending indexing.")
-        return
-
-    print("\n✅ Scene processing for all videos is complete. Starting index creation...")
+    def publish_finished() -> dict:
+        """Adds the scenes of the videos finished so far to the index and publishes it."""
+        nonlocal index, removed_rows, promotions, scenes_added, duplicates, last_publish, publish_interval
+        publish_start = time.monotonic()
+        if new_embeddings:
+            index, new_duplicates = _add_scenes(index, index_type, scene_mapping, descriptor_store, new_embeddings,
+                                                new_mapping_items, new_local_features, dedup_threshold, report)
+            scenes_added += len(new_embeddings)
+            duplicates += new_duplicates
+        index, published = _save_index(index, scene_mapping, generations, model_path, removed_rows, promotions,
+                                       descriptor_store, visual_words)
+        failures.succeeded(finished_videos)
+        # Removed videos are committed with the first generation of the build.
+        removed_rows, promotions = None, []
+        new_embeddings.clear()
+        new_mapping_items.clear()
+        new_local_features.clear()
+        finished_videos.clear()
+        last_publish = time.monotonic()
+        if checkpoint_seconds is not None:
+            publish_interval = max(checkpoint_seconds, checkpoint_cost_ratio * (last_publish - publish_start))
+        return published
 
-    all_embeddings.extend(new_embeddings)
-    index_mapping.extend(new_mapping_items)
+    for video_file, video_results, error in _run_indexing_pipeline(
+        videos_to_process, feature_extractor, batch_size, decode_workers, scene_options,
+        on_video_start=lambda video_file: failures.started(video_file, file_states[video_file]),
+    ):
+        videos_done += 1
+        report(videos_done=videos_done)
+        if error is None and not video_results:
+            error = "No scenes were extracted."
+        if error is not None:
+            print(f"⚠️ '{video_file}' was not indexed: {error}")
+            failures.failed(video_file, error, file_states[video_file])
+            continue
+        for embedding, mapping_info, local_features in video_results:
+            new_embeddings.append(embedding)
+            new_mapping_items.append(mapping_info)
+            new_local_features.append(local_features)
+        finished_videos.append(video_file)
+        if publish_interval is not None and time.monotonic() - last_publish >= publish_interval:
+            report(stage="publishing checkpoint")
+            manifest = publish_finished()
+            print(f"💾 Checkpoint: published generation {manifest['generation']} after {videos_done} of "
+                  f"{len(videos_to_process)} new videos.")
+            report(stage="processing videos")
+    # The decoders only add thumbnails; one sweep per build keeps the cache within its bound.
+    if scene_options["preview_dir"] and videos_to_process:
+        PreviewCache(scene_options["preview_dir"]).evict()
 
-    embeddings_np = np.array(all_embeddings, dtype='float32')
-    dimension = embeddings_np.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings_np)
-    faiss.write_index(index, INDEX_PATH)
-
-    with open(MAPPING_PATH, 'w', encoding='utf-8') as f:
-        json.dump(index_mapping, f, ensure_ascii=False, indent=4)
+    if new_embeddings or (manifest is None and index_changed):
+        report(stage="publishing")
+        manifest = publish_finished()
+    if not scenes_added:
+        print("No feature vectors were extracted from the new videos. Ending indexing.")
+        return manifest
 
-    print(f"🎉 Indexing complete! {len(new_embeddings)} new representative frames have been processed.")
-    print(f"   - Total frames in index: {index.ntotal}")
-    print(f"   - Index file saved to: {INDEX_PATH}")
-    print(f"   - Mapping file saved to: {MAPPING_PATH}")
\ No newline at end of file
+    print(f"🎉 Indexing complete! {scenes_added} new representative frames have been processed.")
+    if dedup_threshold is not None:
+        print(f"   - Near-duplicate scenes stored as occurrences: {duplicates}")
+    print(f"   - Total frames in index: {index.ntotal} ({index_type_of(index)})")
+    print(f"   - Index generation {manifest['generation']} saved to: {generations.index_path(manifest['generation'])}")
+    print(f"   - Scene mapping saved to: {paths['mapping_dir']}")
+    print(f"   - Re-ranking descriptors saved to: {paths['descriptor_store_dir']}")
+    return manifest
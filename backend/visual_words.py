@@ -0,0 +1,195 @@
+import json
+import os
+
+import faiss
+import numpy as np
+
+from .descriptor_store import ORB_DESCRIPTOR_BYTES, DescriptorStore
+
+# --- Defaults ---
+VOCABULARY_SIZE = 4096
+# Descriptors sampled to train the vocabulary, and the fewest per visual word k-means needs
+TRAINING_SAMPLE = 200_000
+MIN_DESCRIPTORS_PER_WORD = 40
+# Retrain a vocabulary that is smaller than VOCABULARY_SIZE once the store has grown this many times
+RETRAIN_GROWTH = 10
+# Query words found in more than ~1/4 of all scenes (idf below log 4) carry no signal and are skipped
+STOP_WORD_IDF = float(np.log(4))
+ATTACHMENTS = ("bovw_vocabulary", "bovw_idf", "bovw_word_offsets", "bovw_rows", "bovw_weights")
+
+
+def _quantizer(vocabulary: np.ndarray) -> faiss.IndexBinaryFlat:
+    quantizer = faiss.IndexBinaryFlat(ORB_DESCRIPTOR_BYTES * 8)
+    quantizer.add(np.ascontiguousarray(vocabulary, dtype=np.uint8))
+    return quantizer
+
+
+def _assign(quantizer: faiss.IndexBinaryFlat, descriptors: np.ndarray) -> np.ndarray:
+    """Visual word (nearest centroid by Hamming distance) of every ORB descriptor."""
+    if len(descriptors) == 0:
+        return np.empty(0, dtype=np.int32)
+    _, words = quantizer.search(np.ascontiguousarray(descriptors, dtype=np.uint8), 1)
+    return words[:, 0].astype(np.int32)
+
+
+def train_vocabulary(descriptors: np.ndarray, size: int, seed: int = 0) -> np.ndarray:
+    """Clusters binary ORB descriptors into ``size`` binary visual words.
+
+    k-means runs on the unpacked bits, where squared L2 equals the Hamming distance; the
+    centroids are rounded back to bits.
+    """
+    bits = np.unpackbits(np.ascontiguousarray(descriptors, dtype=np.uint8), axis=1).astype(np.float32)
+    kmeans = faiss.Kmeans(bits.shape[1], size, niter=20, seed=seed)
+    kmeans.train(bits)
+    return np.packbits(kmeans.centroids > 0.5, axis=1)
+
+
+class VisualWordStore:
+    """Visual vocabulary and the visual word of every descriptor in a ``DescriptorStore``.
+
+    ``words.i32`` is aligned with the store's flat descriptor file and only grows, so each
+    build quantizes just the new descriptors. ``meta.json`` records how many store entries
+    the words cover. ``inverted_index`` turns the words into the per-generation tf-idf
+    inverted file that ``VisualWordIndex`` searches.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.vocabulary_path = os.path.join(store_dir, "vocabulary.u8")
+        self.words_path = os.path.join(store_dir, "words.i32")
+        self.meta_path = os.path.join(store_dir, "meta.json")
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"rows": 0, "trained_on": 0}
+
+    def _write_meta(self, meta: dict):
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def vocabulary(self) -> np.ndarray | None:
+        if not os.path.exists(self.vocabulary_path):
+            return None
+        return np.fromfile(self.vocabulary_path, dtype=np.uint8).reshape(-1, ORB_DESCRIPTOR_BYTES)
+
+    def _train(self, descriptors: np.ndarray, seed: int = 0) -> bool:
+        size = min(VOCABULARY_SIZE, len(descriptors) // MIN_DESCRIPTORS_PER_WORD)
+        if size < 2:
+            return False
+        sample = descriptors
+        if len(descriptors) > TRAINING_SAMPLE:
+            rng = np.random.default_rng(seed)
+            sample = descriptors[np.sort(rng.choice(len(descriptors), TRAINING_SAMPLE, replace=False))]
+        print(f"📚 Training a visual vocabulary of {size} words on {len(sample)} ORB descriptors...")
+        os.makedirs(self.store_dir, exist_ok=True)
+        train_vocabulary(sample, size, seed).tofile(self.vocabulary_path)
+        # Every descriptor is quantized again with the new vocabulary.
+        open(self.words_path, "wb").close()
+        self._write_meta({"rows": 0, "trained_on": len(descriptors)})
+        return True
+
+    def update(self, descriptor_store: DescriptorStore, valid_rows: int) -> bool:
+        """Trains the vocabulary if needed and assigns words to descriptors that have none yet.
+
+        ``valid_rows`` is the number of committed scene rows: words of rows past it may
+        belong to an interrupted build and are recomputed. Returns False while there are
+        too few descriptors for a vocabulary.
+        """
+        offsets = descriptor_store.offsets()
+        descriptors = descriptor_store.descriptors()
+        vocabulary = self.vocabulary()
+        meta = self._read_meta()
+        if vocabulary is None or (len(vocabulary) < VOCABULARY_SIZE
+                                  and len(descriptors) >= RETRAIN_GROWTH * max(meta["trained_on"], 1)):
+            if not self._train(descriptors):
+                return False
+            vocabulary, meta = self.vocabulary(), self._read_meta()
+
+        rows = min(meta["rows"], valid_rows, len(offsets) - 1)
+        start = int(offsets[rows])
+        words = _assign(_quantizer(vocabulary), descriptors[start:])
+        with open(self.words_path, "ab") as f:
+            f.truncate(start * 4)
+            f.seek(0, os.SEEK_END)
+            words.tofile(f)
+        self._write_meta({**meta, "rows": len(offsets) - 1})
+        return True
+
+    def inverted_index(self, descriptor_store: DescriptorStore, indexed_rows: np.ndarray) -> dict[str, np.ndarray]:
+        """Builds the tf-idf inverted file over the scenes in ``indexed_rows``.
+
+        Postings are sorted by word; ``bovw_word_offsets[w]`` is where word ``w``'s postings
+        start. Weights are tf-idf, L2-normalized per scene, so a query's score is a cosine.
+        """
+        vocabulary = self.vocabulary()
+        offsets = np.asarray(descriptor_store.offsets())
+        words = np.fromfile(self.words_path, dtype=np.int32)[:int(offsets[-1])]
+        entry_rows = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        keep = np.zeros(len(offsets) - 1, dtype=bool)
+        indexed_rows = np.asarray(indexed_rows, dtype=np.int64)
+        keep[indexed_rows[indexed_rows < len(keep)]] = True
+        keep = keep[entry_rows]
+        entry_rows, words = entry_rows[keep], words[keep]
+
+        vocabulary_size = len(vocabulary)
+        keys, tf = np.unique(entry_rows * vocabulary_size + words, return_counts=True)
+        rows, words = keys // vocabulary_size, (keys % vocabulary_size).astype(np.int32)
+        df = np.bincount(words, minlength=vocabulary_size)
+        scenes = len(np.unique(rows))
+        idf = np.log((scenes + 1) / (df + 1)).astype(np.float32)
+        weights = tf * idf[words]
+        norms = np.sqrt(np.bincount(rows, weights ** 2, minlength=int(rows.max()) + 1 if len(rows) else 0))
+        weights = (weights / np.maximum(norms[rows], 1e-12)).astype(np.float32)
+
+        order = np.argsort(words, kind="stable")
+        return {
+            "bovw_vocabulary": vocabulary,
+            "bovw_idf": idf,
+            "bovw_word_offsets": np.concatenate([[0], np.cumsum(df)]).astype(np.int64),
+            "bovw_rows": rows[order],
+            "bovw_weights": weights[order],
+        }
+
+
+class VisualWordIndex:
+    """Read-only tf-idf inverted file of one index generation.
+
+    ``score`` ranks every indexed scene sharing visual words with a query in one sparse
+    pass, which is cheap enough to consider hundreds of candidates before the exact ORB
+    matching of a short list.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self._quantizer = _quantizer(arrays["bovw_vocabulary"])
+        self.idf = arrays["bovw_idf"]
+        self.word_offsets = arrays["bovw_word_offsets"]
+        self.rows = arrays["bovw_rows"]
+        self.weights = arrays["bovw_weights"]
+
+    @classmethod
+    def load(cls, generations, generation: int) -> "VisualWordIndex | None":
+        """Memory-maps a generation's inverted file, or returns None if it was published without one."""
+        paths = {name: generations.attachment_path(generation, name) for name in ATTACHMENTS}
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        return cls({name: np.load(path, mmap_mode="r") for name, path in paths.items()})
+
+    def score(self, descriptors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted rows that share visual words with the query and their cosine scores."""
+        words, counts = np.unique(_assign(self._quantizer, descriptors), return_counts=True)
+        idf = np.asarray(self.idf[words])
+        useful = idf >= STOP_WORD_IDF
+        words, query_weights = words[useful], counts[useful] * idf[useful]
+        if len(words) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_weights = query_weights / np.linalg.norm(query_weights)
+
+        starts, ends = self.word_offsets[words], self.word_offsets[words + 1]
+        rows = np.concatenate([self.rows[s:e] for s, e in zip(starts, ends)])
+        weights = np.concatenate([self.weights[s:e] * w for s, e, w in zip(starts, ends, query_weights)])
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return unique_rows, np.bincount(inverse, weights).astype(np.float32)
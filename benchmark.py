@@ -0,0 +1,190 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import cv2
+import faiss
+import numpy as np
+import torch
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from backend.index_factory import INDEX_TYPES
+from backend.models import INFERENCE_BACKENDS
+from backend.search_engine import SearchEngine
+from backend.video_processor import EMBED_BATCH_SIZE, MAX_WORKERS, build_index
+
+
+def make_corpus(video_dir: str, videos: int, scenes: int, scene_sec: float, fps: int, size: tuple[int, int], seed: int) -> list[dict]:
+    """Writes a deterministic synthetic corpus and returns its ground-truth scenes.
+
+    Every scene is a distinct, slowly panning block pattern with a frame counter, so
+    ``ContentDetector`` finds a hard cut between scenes but frames inside a scene differ.
+    """
+    os.makedirs(video_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    frames_per_scene = int(round(scene_sec * fps))
+    truth = []
+    for v in range(videos):
+        name = f"bench_{v:04d}.mp4"
+        writer = cv2.VideoWriter(os.path.join(video_dir, name), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+        for s in range(scenes):
+            pattern = rng.integers(0, 256, (height // 8 + 2, width // 8 + 2, 3), dtype=np.uint8)
+            pattern = cv2.resize(pattern, (width + 16, height + 16), interpolation=cv2.INTER_NEAREST)
+            start_frame = s * frames_per_scene
+            for f in range(frames_per_scene):
+                shift = f * 16 // frames_per_scene
+                frame = np.ascontiguousarray(pattern[shift:shift + height, shift:shift + width])
+                cv2.putText(frame, f"{v}-{s}-{f}", (10, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+                writer.write(frame)
+            truth.append({"video": name, "scene": s, "start_frame": start_frame, "end_frame": start_frame + frames_per_scene})
+        writer.release()
+    return truth
+
+
+def _read_frame(video_path: str, frame_num: int) -> Image.Image:
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+    ret, frame = cap.read()
+    cap.release()
+    if not ret:
+        raise IOError(f"Could not read frame {frame_num} of '{video_path}'.")
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+
+def _as_screenshot(image: Image.Image, quality: int = 80) -> Image.Image:
+    """Round-trips a frame through JPEG, like an uploaded screenshot."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    buffer.seek(0)
+    return Image.open(buffer).convert("RGB")
+
+
+def _peak_rss_mb() -> dict:
+    """Peak resident set size of this process and of its (decoder) children."""
+    if resource is None:
+        return {"self": None, "children": None}
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    unit = 1 if platform.system() == "Darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20, 1),
+    }
+
+
+def _percentiles(latencies_ms: list[float]) -> dict:
+    values = np.array(latencies_ms)
+    return {f"p{p}_ms": round(float(np.percentile(values, p)), 2) for p in (50, 95, 99)} | {
+        "mean_ms": round(float(values.mean()), 2)}
+
+
+def run(args) -> dict:
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="videoarchive_bench_")
+    video_dir = os.path.join(work_dir, "videos")
+    data_dir = os.path.join(work_dir, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    size = tuple(int(x) for x in args.size.lower().split("x"))
+
+    print(f"🎬 Writing {args.videos} synthetic videos with {args.scenes} scenes each to {video_dir} ...")
+    start = time.perf_counter()
+    shutil.rmtree(video_dir, ignore_errors=True)
+    truth = make_corpus(video_dir, args.videos, args.scenes, args.scene_sec, args.fps, size, args.seed)
+    corpus_sec = time.perf_counter() - start
+    total_frames = sum(t["end_frame"] - t["start_frame"] for t in truth)
+
+    print("🏗️ Indexing ...")
+    start = time.perf_counter()
+    build_index(batch_size=args.batch_size, decode_workers=args.decode_workers, index_type=args.index_type,
+                detection=args.detection, frame_skip=args.frame_skip, inference_backend=args.inference_backend,
+                video_dir=video_dir, data_dir=data_dir, dedup_threshold=args.dedup_threshold)
+    index_sec = time.perf_counter() - start
+
+    engine = SearchEngine(scene_mapping_dir=os.path.join(data_dir, "scene_mapping"),
+                          descriptor_store_dir=os.path.join(data_dir, "orb_store"),
+                          generations_dir=os.path.join(data_dir, "index_generations"),
+                          legacy_mapping_path=None, legacy_index_path=None, inference_backend=args.inference_backend)
+    indexed_scenes = int(engine.faiss_index.ntotal) if engine.faiss_index is not None else 0
+
+    # Queries are off-center frames of known scenes, so the indexed middle frame is never the query itself.
+    rng = np.random.default_rng(args.seed + 1)
+    queries = []
+    for t in rng.choice(truth, size=min(args.queries, len(truth)), replace=False):
+        length = t["end_frame"] - t["start_frame"]
+        frame_num = t["start_frame"] + int(rng.integers(length // 5, length - length // 5))
+        queries.append((t, _as_screenshot(_read_frame(os.path.join(video_dir, t["video"]), frame_num))))
+
+    print(f"🔍 Running {len(queries)} queries ...")
+    engine.search(queries[0][1], top_k=args.k)  # warm-up
+    engine.query_cache.clear()
+    latencies, top1, topk = [], 0, 0
+    for t, image in queries:
+        start = time.perf_counter()
+        results = engine.search(image, top_k=args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        def is_hit(result):
+            return any(o["video_id"] == t["video"] and t["start_frame"] <= round(float(o["timestamp"]) * args.fps) < t["end_frame"]
+                       for o in [result, *result.get("occurrences", [])])
+
+        top1 += bool(results) and is_hit(results[0])
+        topk += any(is_hit(r) for r in results[:args.k])
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "work_dir")},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "faiss": faiss.__version__,
+        },
+        "corpus": {"videos": args.videos, "frames": total_frames, "scenes_expected": len(truth),
+                   "scenes_indexed": indexed_scenes, "generate_sec": round(corpus_sec, 2)},
+        "indexing": {"seconds": round(index_sec, 2), "frames_per_sec": round(total_frames / index_sec, 1),
+                     "scenes_per_sec": round(indexed_scenes / index_sec, 2)},
+        "search": {"queries": len(queries), **_percentiles(latencies), "top1_accuracy": round(top1 / len(queries), 4),
+                   f"top{args.k}_accuracy": round(topk / len(queries), 4)},
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBenchmark saved to {args.output}")
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a synthetic video corpus and measure indexing throughput, search latency and accuracy.")
+    parser.add_argument("--videos", type=int, default=8, help="Number of synthetic videos")
+    parser.add_argument("--scenes", type=int, default=6, help="Scenes per video")
+    parser.add_argument("--scene_sec", type=float, default=2.0, help="Scene length in seconds")
+    parser.add_argument("--fps", type=int, default=25, help="Frame rate of the synthetic videos")
+    parser.add_argument("--size", default="320x240", help="Frame size WIDTHxHEIGHT")
+    parser.add_argument("--queries", type=int, default=50, help="Number of query frames")
+    parser.add_argument("--k", type=int, default=5, help="Results per query for top-k accuracy")
+    parser.add_argument("--batch_size", type=int, default=EMBED_BATCH_SIZE, help="Scene frames per ViT forward pass")
+    parser.add_argument("--decode_workers", type=int, default=MAX_WORKERS, help="Decoder processes")
+    parser.add_argument("--index_type", default="flat", choices=INDEX_TYPES, help="FAISS index type")
+    parser.add_argument("--detection", default="two_pass", choices=["two_pass", "single_pass"], help="Scene detection mode")
+    parser.add_argument("--frame_skip", type=int, default=0, help="Single pass only: frames skipped by the detector")
+    parser.add_argument("--inference_backend", default="eager", choices=INFERENCE_BACKENDS, help="ViT inference backend")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Cosine similarity at which near-identical scenes share one vector")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and the query choice")
+    parser.add_argument("--work_dir", default=None, help="Keep the corpus and index here (default: a deleted temp dir)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    run(parser.parse_args())
@@ -13,6 +13,11 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const API_URL = 'http://127.0.0.1:8000';
 
+    // 결과 재생에는 원본 대신 서버가 캐시하는 썸네일과 짧은 저용량 미리보기 클립을 사용
+    function previewUrl(res, kind) {
+        return `${API_URL}/preview/${encodeURIComponent(res.video_id)}?timestamp=${res.timestamp}&kind=${kind}`;
+    }
+
     searchButton.addEventListener('click', async () => {
         const file = imageUpload.files[0];
         if (!file) {
@@ -72,13 +77,11 @@ document.addEventListener('DOMContentLoaded', () => {
         if (results.length > 1) {
             const otherResults = results.slice(1);
             otherResults.forEach((res, index) => {
-                const videoUrl = `${API_URL}/videos/${res.video_id}#t=${res.timestamp}`;
-
                 const card = document.createElement('div');
                 card.className = 'col-md-4';
                 card.innerHTML = `
                     <div class="card result-card">
-                        <video class="card-img-top" controls muted loop src="${videoUrl}"></video>
+                        <img class="card-img-top" loading="lazy" src="${previewUrl(res, 'thumbnail')}" title="클릭하면 미리보기를 재생합니다">
                         <div class="card-body">
                             <h6 class="card-title">유사 장면 #${index + 2}</h6>
                             <p class="card-text mb-1"><strong>파일:</strong> ${res.video_id}</p>
@@ -86,6 +89,16 @@ document.addEventListener('DOMContentLoaded', () => {
                         </div>
                     </div>
                 `;
+                // 썸네일을 클릭하면 그 자리에서 미리보기 클립을 재생
+                const thumbnail = card.querySelector('img');
+                thumbnail.addEventListener('click', () => {
+                    const video = document.createElement('video');
+                    video.className = 'card-img-top';
+                    video.controls = video.muted = video.loop = video.autoplay = true;
+                    video.poster = thumbnail.src;
+                    video.src = previewUrl(res, 'clip');
+                    thumbnail.replaceWith(video);
+                }, { once: true });
                 resultList.appendChild(card);
             });
         }
@@ -103,12 +116,11 @@ document.addEventListener('DOMContentLoaded', () => {
         // Display result video
         const { video_id, timestamp, score } = result;
         mainResultTitle.textContent = '검색된 장면 (Top 1)';
-        resultInfo.innerHTML = `<strong>파일:</strong> ${video_id}<br><strong>시간:</strong> ${parseFloat(timestamp).toFixed(2)}초 (유사도 점수: ${score})`;
-        
-        resultVideo.src = `${API_URL}/videos/${video_id}`;
-        resultVideo.onloadedmetadata = () => {
-            resultVideo.currentTime = parseFloat(timestamp);
-        };
+        resultInfo.innerHTML = `<strong>파일:</strong> ${video_id}<br><strong>시간:</strong> ${parseFloat(timestamp).toFixed(2)}초 (유사도 점수: ${score})` +
+            `<br><a href="${API_URL}/videos/${encodeURIComponent(video_id)}#t=${timestamp}" target="_blank">원본 영상 보기</a>`;
+
+        resultVideo.poster = previewUrl(result, 'thumbnail');
+        resultVideo.src = previewUrl(result, 'clip');
     }
 
     function showError(message) {
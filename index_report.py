@@ -0,0 +1,104 @@
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from backend.index_factory import INDEX_TYPES, create_index, export_vectors, search_params
+from backend.video_processor import current_index_path
+
+
+def _recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Mean fraction of the exact top-k neighbours that the approximate search returned."""
+    k = truth.shape[1]
+    hits = sum(len(set(f[f != -1]) & set(t)) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def _measure(index, queries, k, params):
+    """Runs one query at a time (as the API does) and returns ids and per-query latencies in ms."""
+    found = np.empty((len(queries), k), dtype="int64")
+    latencies = []
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k, params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found[i] = ids[0]
+    return found, np.array(latencies)
+
+
+def report(args):
+    index = faiss.read_index(args.index)
+    ids, vectors = export_vectors(index)
+    print(f"Loaded {len(ids)} vectors ({vectors.shape[1]}-d) from {args.index}")
+
+    # Held-out queries are not in the indexed set, like real screenshots.
+    rng = np.random.default_rng(args.seed)
+    query_rows = rng.choice(len(ids), size=min(args.queries, len(ids) // 2), replace=False)
+    base_mask = np.ones(len(ids), dtype=bool)
+    base_mask[query_rows] = False
+    queries = np.ascontiguousarray(vectors[query_rows])
+    base_ids, base_vectors = ids[base_mask], np.ascontiguousarray(vectors[base_mask])
+
+    flat = create_index("flat", base_vectors.shape[1])
+    flat.add_with_ids(base_vectors, base_ids)
+    _, truth = flat.search(queries, args.k)
+
+    rows = []
+    for index_type in args.types:
+        start = time.perf_counter()
+        try:
+            candidate = create_index(index_type, base_vectors.shape[1], training_vectors=base_vectors, nlist=args.nlist)
+        except ValueError as e:
+            print(f"Skipping {index_type}: {e}")
+            continue
+        candidate.add_with_ids(base_vectors, base_ids)
+        build_sec = time.perf_counter() - start
+        size_mb = faiss.serialize_index(candidate).nbytes / 2 ** 20
+
+        if index_type in ("ivf_flat", "ivf_pq"):
+            settings = [{"nprobe": n} for n in args.nprobe]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": ef} for ef in args.ef_search]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            params = search_params(candidate, **setting)
+            found, latencies = _measure(candidate, queries, args.k, params)
+            rows.append({
+                "index_type": index_type,
+                **setting,
+                f"recall@{args.k}": round(_recall_at_k(found, truth), 4),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+                "size_mb": round(size_mb, 2),
+                "build_sec": round(build_sec, 2),
+            })
+
+    print(f"\n{'index':<10}{'setting':<16}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'size MB':>10}")
+    for row in rows:
+        setting = ", ".join(f"{key}={row[key]}" for key in ("nprobe", "ef_search") if key in row)
+        print(f"{row['index_type']:<10}{setting:<16}{row[f'recall@{args.k}']:>10}{row['p50_ms']:>10}"
+              f"{row['p95_ms']:>10}{row['p99_ms']:>10}{row['size_mb']:>10}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"vectors": int(len(base_ids)), "queries": int(len(queries)), "k": args.k, "results": rows}, f, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ANN index types against the exact flat index on the indexed scenes.")
+    parser.add_argument("--index", default=current_index_path(), help="FAISS index to take the vectors from (default: active generation)")
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES, help="Index types to evaluate")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbours for recall@k")
+    parser.add_argument("--queries", type=int, default=500, help="Number of held-out query vectors")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF cells (default: ~4 * sqrt(n))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64], help="IVF nprobe values to sweep")
+    parser.add_argument("--ef_search", type=int, nargs="+", default=[16, 64, 256], help="HNSW efSearch values to sweep")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for picking queries")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the report")
+    report(parser.parse_args())
@@ -0,0 +1,115 @@
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from backend.generations import IndexGenerations
+from backend.models import INFERENCE_BACKENDS, FeatureExtractor
+from backend.scene_mapping import open_scene_mapping
+from backend.video_processor import (
+    EMBED_BATCH_SIZE, MODEL_PATH, VIDEO_DIR, current_index_path, data_paths, get_frame_from_video,
+)
+
+
+def _query_frames(scene_mapping, count, offset, seed, video_dir):
+    """Frames ``offset`` seconds after randomly chosen indexed scenes, standing in for screenshots."""
+    live_rows = np.flatnonzero(~scene_mapping.removed_mask(np.arange(len(scene_mapping))))
+    rng = np.random.default_rng(seed)
+    frames = []
+    for row in rng.permutation(live_rows):
+        item = scene_mapping.get(int(row))
+        frame = get_frame_from_video(item["id"], float(item["timestamp"]) + offset, video_dir) \
+            or get_frame_from_video(item["id"], item["timestamp"], video_dir)
+        if frame is not None:
+            frames.append(frame)
+        if len(frames) >= count:
+            break
+    return frames
+
+
+def _embed(feature_extractor, frames, batch_size):
+    """Embeds frames in batches and returns the embeddings and the mean latency per frame in ms."""
+    feature_extractor.get_embeddings(frames[:1])  # warm-up
+    start = time.perf_counter()
+    embeddings = np.concatenate([
+        feature_extractor.get_embeddings(frames[i:i + batch_size]) for i in range(0, len(frames), batch_size)
+    ])
+    return embeddings, (time.perf_counter() - start) * 1000 / len(frames)
+
+
+def _open_index(args):
+    """The index to check and its scene mapping, limited to the rows of the index's generation."""
+    paths = data_paths(args.data_dir)
+    index_path = args.index or current_index_path(args.data_dir)
+    scene_mapping = open_scene_mapping(paths["mapping_dir"], paths["legacy_mapping_path"])
+    if index_path is None or not scene_mapping.exists():
+        raise SystemExit("No index to check. Build the index first.")
+    # An explicit --index may be any generation, so only the active one's rows are known.
+    manifest = IndexGenerations(paths["generations_dir"]).current() if args.index is None else None
+    if manifest is not None:
+        scene_mapping.load(rows=manifest["scene_rows"])
+    return faiss.read_index(index_path), scene_mapping
+
+
+def check(args):
+    index, scene_mapping = _open_index(args)
+    frames = _query_frames(scene_mapping, args.samples, args.offset, args.seed, args.video_dir)
+    if not frames:
+        raise SystemExit("No scene frames could be read. Build the index first.")
+    print(f"Comparing {len(frames)} query frames against {index.ntotal} indexed scenes (k={args.k})")
+
+    reference, reference_ms = _embed(FeatureExtractor(args.model_path, backend="eager"), frames, args.batch_size)
+    _, reference_ids = index.search(reference, args.k)
+
+    rows = []
+    for backend in args.backends:
+        embeddings, ms = _embed(FeatureExtractor(args.model_path, backend=backend), frames, args.batch_size)
+        cosine = (embeddings * reference).sum(axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1))
+        relative_l2 = np.linalg.norm(embeddings - reference, axis=1) / np.linalg.norm(reference, axis=1)
+        _, ids = index.search(embeddings, args.k)
+        overlap = [len(set(f[f != -1]) & set(t[t != -1])) / args.k for f, t in zip(ids, reference_ids)]
+        rows.append({
+            "backend": backend,
+            "ms_per_image": round(ms, 2),
+            "speedup": round(reference_ms / ms, 2),
+            "cosine_mean": round(float(cosine.mean()), 6),
+            "cosine_min": round(float(cosine.min()), 6),
+            "relative_l2_mean": round(float(relative_l2.mean()), 6),
+            "top1_agreement": round(float(np.mean(ids[:, 0] == reference_ids[:, 0])), 4),
+            f"top{args.k}_overlap": round(float(np.mean(overlap)), 4),
+        })
+
+    print(f"\n{'backend':<13}{'ms/img':>8}{'speedup':>9}{'cos mean':>10}{'cos min':>10}{'top-1':>8}{'top-' + str(args.k):>8}")
+    print(f"{'eager (fp32)':<13}{reference_ms:>8.2f}{1.0:>9}{1.0:>10}{1.0:>10}{1.0:>8}{1.0:>8}")
+    for row in rows:
+        safe = row["top1_agreement"] >= args.min_agreement
+        print(f"{row['backend']:<13}{row['ms_per_image']:>8}{row['speedup']:>9}{row['cosine_mean']:>10}"
+              f"{row['cosine_min']:>10}{row['top1_agreement']:>8}{row[f'top{args.k}_overlap']:>8}  {'✅' if safe else '⚠️'}")
+    print(f"\n✅: top-1 agreement with fp32 of at least {args.min_agreement}.")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"queries": len(frames), "k": args.k, "eager_ms_per_image": round(reference_ms, 2),
+                       "results": rows}, f, indent=2)
+        print(f"Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure embedding drift and retrieval agreement of inference backends against fp32.")
+    parser.add_argument("--backends", nargs="+", default=[b for b in INFERENCE_BACKENDS if b != "eager"],
+                        choices=INFERENCE_BACKENDS, help="Backends to compare with eager fp32")
+    parser.add_argument("--data_dir", default=None, help="Where the index is kept (see video_processor.data_paths; default: backend/)")
+    parser.add_argument("--video_dir", default=VIDEO_DIR, help="Folder with the indexed videos")
+    parser.add_argument("--index", default=None, help="FAISS index to search (default: active generation in --data_dir)")
+    parser.add_argument("--model_path", default=MODEL_PATH, help="Fine-tuned ViT weights the index was built with")
+    parser.add_argument("--samples", type=int, default=200, help="Number of query frames")
+    parser.add_argument("--offset", type=float, default=0.5, help="Seconds between an indexed scene frame and its query frame")
+    parser.add_argument("--k", type=int, default=5, help="Number of neighbours compared")
+    parser.add_argument("--batch_size", type=int, default=EMBED_BATCH_SIZE, help="Frames per forward pass")
+    parser.add_argument("--min_agreement", type=float, default=0.95, help="Top-1 agreement considered safe")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for picking scenes")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the report")
+    check(parser.parse_args())
@@ -0,0 +1,96 @@
+import argparse
+import os
+import time
+import traceback
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def video_states(video_dir: str) -> dict[str, tuple[int, int]]:
+    """``(size, mtime_ns)`` of every video in the folder."""
+    states = {}
+    for entry in os.scandir(video_dir):
+        if entry.is_file() and entry.name.lower().endswith(VIDEO_EXTENSIONS):
+            stat = entry.stat()
+            states[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return states
+
+
+def watch(args):
+    """Indexes videos as they appear in the folder until interrupted.
+
+    A build runs whenever the settled videos change, or when the failed-video ledger,
+    checked every ``rescan_seconds``, has a video due for a retry. Files that changed since
+    the last poll or within ``settle_seconds`` are still being copied and wait for a later
+    build. Builds publish a checkpoint generation every ``checkpoint_seconds``, which running
+    servers pick up on their own, and a restarted daemon resumes after the last checkpoint.
+    """
+    from backend.failed_videos import FailedVideos
+    from backend.generations import BuildInProgressError
+    from backend.models import FeatureExtractor
+    from backend.shards import parse_shard
+    from backend.video_processor import build_index, data_paths
+
+    os.makedirs(args.video_dir, exist_ok=True)
+    shard = parse_shard(args.shard) if args.shard else None
+    # Loaded once; every build reuses the embedder.
+    feature_extractor = FeatureExtractor(args.model_path, backend=args.inference_backend)
+    failures = FailedVideos(data_paths(args.data_dir)["failures_path"])
+    print(f"👀 Watching '{args.video_dir}' for new videos (Ctrl+C to stop)...")
+
+    previous_states = video_states(args.video_dir)
+    built_states = None
+    last_retry_check = time.monotonic()
+    while True:
+        states = video_states(args.video_dir)
+        now_ns = time.time_ns()
+        settling = {name for name, state in states.items()
+                    if previous_states.get(name) != state or now_ns - state[1] < args.settle_seconds * 1e9}
+        previous_states = states
+        settled_states = {name: state for name, state in states.items() if name not in settling}
+
+        retry_due = False
+        if settled_states == built_states and time.monotonic() - last_retry_check >= args.rescan_seconds:
+            last_retry_check = time.monotonic()
+            retry_due = bool(failures.due(settled_states))
+        if settled_states != built_states or retry_due:
+            try:
+                build_index(feature_extractor=feature_extractor, video_dir=args.video_dir, data_dir=args.data_dir,
+                            shard=shard, index_type=args.index_type, decode_workers=args.decode_workers,
+                            batch_size=args.batch_size, dedup_threshold=args.dedup_threshold,
+                            checkpoint_seconds=args.checkpoint_seconds, checkpoint_cost_ratio=args.checkpoint_cost_ratio,
+                            skip_videos=settling)
+                built_states = settled_states
+            except BuildInProgressError as e:
+                print(f"Another build is running ({e}). Retrying shortly.")
+            except Exception as e:
+                # The next build resumes after the last checkpoint.
+                traceback.print_exc()
+                print(f"❌ Ingestion build failed: {e}")
+        time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuously index new videos of a folder, checkpointing as they finish.")
+    parser.add_argument("--video_dir", default=os.path.join("backend", "videos"), help="Folder to watch")
+    parser.add_argument("--data_dir", default=None, help="Where the index is kept (see video_processor.data_paths; default: backend/)")
+    parser.add_argument("--shard", default=None, help="Only index the videos of shard '<index>/<count>'")
+    parser.add_argument("--index_type", default="flat", choices=["flat", "ivf_flat", "ivf_pq", "hnsw"], help="FAISS index type")
+    parser.add_argument("--decode_workers", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="Decoder processes per build")
+    parser.add_argument("--batch_size", type=int, default=32, help="Scene frames per ViT forward pass")
+    parser.add_argument("--model_path", default=None, help="Fine-tuned ViT weights (must match the servers' weights)")
+    parser.add_argument("--inference_backend", default="eager", choices=["eager", "int8", "torchscript"], help="ViT inference backend")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Cosine similarity at which near-identical scenes share one vector")
+    parser.add_argument("--checkpoint_seconds", type=float, default=10.0, help="Publish finished videos at most this often during a build")
+    parser.add_argument("--checkpoint_cost_ratio", type=float, default=10.0,
+                        help="Also space checkpoints at least this many times their publish time, which grows with the "
+                             "index: new videos appear later on large indexes, but the build spends at most about 1/ratio "
+                             "of its time publishing (0: every --checkpoint_seconds)")
+    parser.add_argument("--poll_interval", type=float, default=2.0, help="Seconds between folder scans")
+    parser.add_argument("--settle_seconds", type=float, default=5.0, help="Videos modified more recently are still being copied")
+    parser.add_argument("--rescan_seconds", type=float, default=60.0, help="Seconds between checks for failed videos due for a retry")
+    args = parser.parse_args()
+    try:
+        watch(args)
+    except KeyboardInterrupt:
+        print("Ingestion stopped.")
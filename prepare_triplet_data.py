@@ -1,75 +1,321 @@
-import os
-import random
-import shutil
-
-import cv2
-from tqdm import tqdm
-
-
-def create_dataset(videos_dir="backend/videos", dataset_dir="triplet_dataset"):
-    if os.path.exists(dataset_dir):
-        shutil.rmtree(dataset_dir)
-    os.makedirs(dataset_dir, exist_ok=True)
-
-    video_files = [f for f in os.listdir(videos_dir) if f.endswith(".mp4")]
-    if len(video_files) < 2:
-        print("적어도 2개 이상의 영상이 필요합니다.")
-        return
-
-    for video_file in tqdm(video_files, desc="Processing videos"):
-        video_path = os.path.join(videos_dir, video_file)
-        cap = cv2.VideoCapture(video_path)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if frame_count < 2:
-            continue
-
-        # Anchor, Positive 프레임 추출
-        anchor_frame_idx = random.randint(0, frame_count - 2)
-        positive_frame_idx = anchor_frame_idx + 1
-
-        cap.set(cv2.CAP_PROP_POS_FRAMES, anchor_frame_idx)
-        ret, anchor_frame = cap.read()
-        if not ret:
-            continue
-
-        ret, positive_frame = cap.read()
-        if not ret:
-            continue
-
-        # Negative 프레임 추출
-        other_videos = [v for v in video_files if v != video_file]
-        negative_video_file = random.choice(other_videos)
-        negative_video_path = os.path.join(videos_dir, negative_video_file)
-        neg_cap = cv2.VideoCapture(negative_video_path)
-        neg_frame_count = int(neg_cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if neg_frame_count < 1:
-            neg_cap.release()
-            continue
-        negative_frame_idx = random.randint(0, neg_frame_count - 1)
-        neg_cap.set(cv2.CAP_PROP_POS_FRAMES, negative_frame_idx)
-        ret, negative_frame = neg_cap.read()
-        neg_cap.release()
-        if not ret:
-            continue
-
-        cap.release()
-
-        # 이미지 저장
-        base_filename = os.path.splitext(video_file)[0]
-        anchor_img_path = os.path.join(
-            dataset_dir, f"{base_filename}_anchor_{anchor_frame_idx}.png"
-        )
-        positive_img_path = os.path.join(
-            dataset_dir, f"{base_filename}_positive_{positive_frame_idx}.png"
-        )
-        negative_img_path = os.path.join(
-            dataset_dir, f"{base_filename}_negative_{negative_frame_idx}.png"
-        )
-
-        cv2.imwrite(anchor_img_path, anchor_frame)
-        cv2.imwrite(positive_img_path, positive_frame)
-        cv2.imwrite(negative_img_path, negative_frame)
-
-
-if __name__ == "__main__":
-    create_dataset()
\ No newline at end of file
+import json
+import os
+import shutil
+import zlib
+
+import cv2
+import faiss
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from transformers import ViTImageProcessor
+
+from backend.generations import IndexGenerations
+from backend.index_factory import export_vectors, search_params
+from backend.models import load_pretrained
+from backend.scene_mapping import open_scene_mapping
+from backend.video_processor import VIDEO_DIR, current_index_path, data_paths
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+FRAME_SHAPE = (3, 224, 224)
+
+
+class FrameCache:
+    """Append-only cache of training frames, resized once, in one memory-mapped uint8 array.
+
+    ``frames.u8`` holds ``(rows, 3, 224, 224)`` frames exactly as ``ViTImageProcessor``
+    resizes them, before rescaling and normalization. ``index.json`` records the committed
+    row count and, per video, its size and mtime and the ``(anchor, positive)`` row pairs
+    sampled from it, and the triplets last mined from the index (``mine_triplets``) with
+    the rows of the frames they use. Rows of removed or changed videos stay in the file
+    until ``reset``.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.frames_path = os.path.join(cache_dir, "frames.u8")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.rows = 0
+        self.videos: dict[str, dict] = {}
+        self.mined = self._empty_mined()
+
+    @staticmethod
+    def _empty_mined() -> dict:
+        return {"generation": None, "videos": {}, "frames": {}, "triplets": []}
+
+    def load(self) -> "FrameCache":
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.rows, self.videos = index["rows"], index["videos"]
+            self.mined = index.get("mined", self._empty_mined())
+        return self
+
+    def reset(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir)
+        self.rows, self.videos, self.mined = 0, {}, self._empty_mined()
+        self._write_index()
+
+    def _write_index(self):
+        with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"rows": self.rows, "videos": self.videos, "mined": self.mined}, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def frames(self) -> np.ndarray:
+        """Read-only memory map of the committed frames."""
+        return np.memmap(self.frames_path, dtype=np.uint8, mode="r", shape=(self.rows, *FRAME_SHAPE))
+
+    def pairs(self) -> np.ndarray:
+        """``(anchor_row, positive_row, video_number)`` for every cached pair."""
+        pairs = [(a, p, v) for v, video in enumerate(self.videos.values()) for a, p in video["pairs"]]
+        return np.array(pairs, dtype=np.int64).reshape(-1, 3)
+
+    def triplets(self) -> np.ndarray:
+        """``(anchor_row, positive_row, negative_row)`` of every mined triplet."""
+        return np.array(self.mined["triplets"], dtype=np.int64).reshape(-1, 3)
+
+    def _append_frames(self, frames: np.ndarray) -> int:
+        """Appends frames without committing them and returns the row of the first one."""
+        with open(self.frames_path, "ab") as f:
+            # Drop frames a crashed run appended without committing them.
+            f.truncate(self.rows * int(np.prod(FRAME_SHAPE)))
+            f.seek(0, os.SEEK_END)
+            np.ascontiguousarray(frames, dtype=np.uint8).tofile(f)
+        first_row = self.rows
+        self.rows += len(frames)
+        return first_row
+
+    def add_video(self, name: str, stat: os.stat_result, frames: np.ndarray, pairs: list[tuple[int, int]]):
+        """Appends a video's frames and makes them visible; ``pairs`` index into ``frames``."""
+        first_row = self._append_frames(frames)
+        self.videos[name] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                             "pairs": [(first_row + a, first_row + p) for a, p in pairs]}
+        self._write_index()
+
+    def add_mined_frames(self, name: str, stat: os.stat_result, frames: np.ndarray, keys: list[str]):
+        """Appends frames of one video for mined triplets, remembered by ``keys`` for later mining runs."""
+        if self.mined["videos"].get(name) != [stat.st_size, stat.st_mtime]:
+            # The video changed since its frames were cached; its old frames are not reused.
+            self.mined["frames"] = {k: row for k, row in self.mined["frames"].items() if not k.startswith(name + "@")}
+            self.mined["videos"][name] = [stat.st_size, stat.st_mtime]
+        first_row = self._append_frames(frames)
+        self.mined["frames"].update({key: first_row + i for i, key in enumerate(keys)})
+        self._write_index()
+
+    def set_mined_triplets(self, generation: int | None, triplets: list[tuple[int, int, int]]):
+        self.mined["generation"] = generation
+        self.mined["triplets"] = triplets
+        self._write_index()
+
+    def remove_video(self, name: str):
+        self.videos.pop(name, None)
+        self._write_index()
+
+
+def _read_frames(video_path: str, frame_numbers: list[int]) -> dict[int, Image.Image]:
+    """Reads the given frames in order, seeking to each one.
+
+    A frame that directly follows the previous one (an anchor's positive) is read without
+    another seek, so a pair costs one seek instead of decoding the video up to it.
+    """
+    frames = {}
+    cap = cv2.VideoCapture(video_path)
+    position = None
+    try:
+        for frame_num in sorted(set(frame_numbers)):
+            if frame_num != position:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            ret, frame = cap.read()
+            position = frame_num + 1
+            if ret:
+                frames[frame_num] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        cap.release()
+    return frames
+
+
+def _read_frames_at(video_path: str, timestamps: list[float]) -> dict[float, Image.Image]:
+    """Reads the frames at the given seconds in order, seeking to each like the indexer picks scene frames."""
+    frames = {}
+    cap = cv2.VideoCapture(video_path)
+    try:
+        for seconds in sorted(set(timestamps)):
+            cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
+            ret, frame = cap.read()
+            if ret:
+                frames[seconds] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        cap.release()
+    return frames
+
+
+def _sample_pairs(video_path: str, pairs_per_video: int, positive_gap: int, rng: np.random.Generator) -> list[tuple[int, int]]:
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frame_count <= positive_gap:
+        return []
+    anchors = np.sort(rng.choice(frame_count - positive_gap, size=min(pairs_per_video, frame_count - positive_gap), replace=False))
+    return [(int(a), int(a) + positive_gap) for a in anchors]
+
+
+def update_frame_cache(videos_dir: str = "backend/videos", cache_dir: str = "triplet_cache", pairs_per_video: int = 8,
+                       positive_gap: int = 1, seed: int = 0, rebuild: bool = False) -> FrameCache:
+    """Adds anchor/positive frame pairs of new or changed videos to the frame cache.
+
+    Videos already cached with the same size and mtime are skipped, so re-running before
+    every training only decodes what changed. Each anchor is paired with the frame
+    ``positive_gap`` frames later; negatives are drawn from other videos at training time.
+    """
+    cache = FrameCache(cache_dir)
+    if rebuild or not os.path.exists(cache.index_path):
+        cache.reset()
+    cache.load()
+
+    video_files = sorted(f for f in os.listdir(videos_dir) if f.lower().endswith(VIDEO_EXTENSIONS))
+    for name in set(cache.videos) - set(video_files):
+        cache.remove_video(name)
+    stats = {name: os.stat(os.path.join(videos_dir, name)) for name in video_files}
+    to_process = [name for name in video_files
+                  if name not in cache.videos
+                  or (cache.videos[name]["size"], cache.videos[name]["mtime"]) != (stats[name].st_size, stats[name].st_mtime)]
+    if len(video_files) < 2:
+        print("Warning: At least 2 videos are needed to draw negatives from another video.")
+    if not to_process:
+        print(f"✅ Frame cache is up-to-date: {len(cache.pairs())} pairs of {len(cache.videos)} videos.")
+        return cache
+
+    processor = load_pretrained(ViTImageProcessor)
+    for name in tqdm(to_process, desc="Caching frames"):
+        video_path = os.path.join(videos_dir, name)
+        # Seeded per video, so a video's pairs do not depend on which other videos exist.
+        rng = np.random.default_rng([seed, zlib.crc32(name.encode("utf-8"))])
+        pairs = _sample_pairs(video_path, pairs_per_video, positive_gap, rng)
+        if not pairs:
+            cache.remove_video(name)
+            continue
+        frame_numbers = sorted({n for pair in pairs for n in pair})
+        images = _read_frames(video_path, frame_numbers)
+        pairs = [(a, p) for a, p in pairs if a in images and p in images]
+        frame_numbers = [n for n in frame_numbers if n in images]
+        if not pairs:
+            cache.remove_video(name)
+            continue
+        # Resized once here; rescale and normalize are cheap and happen per batch in training.
+        frames = processor(images=[images[n] for n in frame_numbers], do_rescale=False, do_normalize=False,
+                           return_tensors="np")["pixel_values"]
+        row_of = {n: i for i, n in enumerate(frame_numbers)}
+        cache.add_video(name, stats[name], np.rint(frames).astype(np.uint8), [(row_of[a], row_of[p]) for a, p in pairs])
+
+    print(f"✅ Cached {len(cache.pairs())} pairs of {len(cache.videos)} videos in {cache_dir} ({cache.rows} frames).")
+    return cache
+
+
+def _frame_key(video: str, seconds: float) -> str:
+    return f"{video}@{seconds:.2f}"
+
+
+def mine_triplets(cache_dir: str = "triplet_cache", data_dir: str | None = None, videos_dir: str = VIDEO_DIR,
+                  anchors_per_video: int = 32, negatives_per_anchor: int = 4, positive_offset: float = 0.5,
+                  max_negative_similarity: float = 0.95, nprobe: int | None = None, batch_size: int = 1024,
+                  seed: int = 0) -> FrameCache:
+    """Mines triplets with hard negatives from the scene embeddings of the active index.
+
+    Up to ``anchors_per_video`` indexed scenes per video become anchors; the positive is the
+    frame ``positive_offset`` seconds later in the same video. The negatives are the anchor's
+    nearest indexed scenes from other videos, found with batched FAISS searches. Neighbours
+    with a cosine similarity above ``max_negative_similarity`` are skipped, since they are
+    most likely the same shot reused in another video. Only the frames of the chosen
+    triplets are read, each after a seek; frames cached by earlier runs are reused.
+    """
+    paths = data_paths(data_dir)
+    index_path = current_index_path(data_dir)
+    scene_mapping = open_scene_mapping(paths["mapping_dir"], paths["legacy_mapping_path"])
+    if index_path is None or not scene_mapping.exists():
+        raise SystemExit("No index to mine triplets from. Build the index first.")
+    manifest = IndexGenerations(paths["generations_dir"]).current()
+    if manifest is not None:
+        scene_mapping.load(rows=manifest["scene_rows"])
+    index = faiss.read_index(index_path)
+
+    ids, vectors = export_vectors(index)
+    live = ~scene_mapping.removed_mask(ids)
+    ids, vectors = ids[live], np.ascontiguousarray(vectors[live])
+    video_ids, timestamps = scene_mapping.scenes(ids)
+    normalized = vectors.copy()
+    faiss.normalize_L2(normalized)
+    position_of = {int(row): i for i, row in enumerate(ids)}
+
+    rng = np.random.default_rng(seed)
+    anchors = np.concatenate([
+        rng.permutation(np.flatnonzero(video_ids == video))[:anchors_per_video] for video in np.unique(video_ids)
+    ]) if len(ids) else np.empty(0, dtype=np.int64)
+    print(f"⛏️ Mining hard negatives for {len(anchors)} anchor scenes of {len(np.unique(video_ids))} videos...")
+
+    # Extra neighbours make up for those of the same video or too similar to the anchor.
+    k = min(index.ntotal, 4 * negatives_per_anchor + 1)
+    params = search_params(index, nprobe=nprobe)
+    planned = []
+    for start in tqdm(range(0, len(anchors), batch_size), desc="Searching neighbours"):
+        batch = anchors[start:start + batch_size]
+        _, neighbours = index.search(vectors[batch], k, params=params)
+        for anchor, row_neighbours in zip(batch, neighbours):
+            negatives = []
+            for row in row_neighbours:
+                position = position_of.get(int(row))
+                if position is None or video_ids[position] == video_ids[anchor]:
+                    continue
+                if float(normalized[position] @ normalized[anchor]) > max_negative_similarity:
+                    continue
+                negatives.append(position)
+                if len(negatives) == negatives_per_anchor:
+                    break
+            planned.extend((anchor, negative) for negative in negatives)
+
+    # Frames to decode, grouped by video: anchors, their positives and the negatives' scene frames.
+    names = scene_mapping.video_names
+    wanted: dict[str, set[float]] = {}
+    for anchor, negative in planned:
+        anchor_video, negative_video = names[video_ids[anchor]], names[video_ids[negative]]
+        wanted.setdefault(anchor_video, set()).update({float(timestamps[anchor]), float(timestamps[anchor]) + positive_offset})
+        wanted.setdefault(negative_video, set()).add(float(timestamps[negative]))
+
+    cache = FrameCache(cache_dir)
+    if not os.path.exists(cache.index_path):
+        cache.reset()
+    cache.load()
+    processor = load_pretrained(ViTImageProcessor)
+    for name in tqdm(sorted(wanted), desc="Caching mined frames"):
+        video_path = os.path.join(videos_dir, name)
+        if not os.path.exists(video_path):
+            continue
+        stat = os.stat(video_path)
+        reusable = cache.mined["videos"].get(name) == [stat.st_size, stat.st_mtime]
+        missing = sorted(t for t in wanted[name] if not (reusable and _frame_key(name, t) in cache.mined["frames"]))
+        if not missing:
+            continue
+        images = _read_frames_at(video_path, missing)
+        decoded = [t for t in missing if t in images]
+        if not decoded:
+            continue
+        frames = processor(images=[images[t] for t in decoded], do_rescale=False, do_normalize=False,
+                           return_tensors="np")["pixel_values"]
+        cache.add_mined_frames(name, stat, np.rint(frames).astype(np.uint8), [_frame_key(name, t) for t in decoded])
+
+    frame_rows = cache.mined["frames"]
+    triplets = []
+    for anchor, negative in planned:
+        anchor_video, negative_video = names[video_ids[anchor]], names[video_ids[negative]]
+        keys = (_frame_key(anchor_video, float(timestamps[anchor])),
+                _frame_key(anchor_video, float(timestamps[anchor]) + positive_offset),
+                _frame_key(negative_video, float(timestamps[negative])))
+        if all(key in frame_rows for key in keys):
+            triplets.append(tuple(frame_rows[key] for key in keys))
+    cache.set_mined_triplets(manifest["generation"] if manifest is not None else None, triplets)
+    print(f"✅ Mined {len(triplets)} triplets into {cache_dir} ({cache.rows} cached frames).")
+    return cache
+
+
+if __name__ == "__main__":
+    update_frame_cache()
@@ -0,0 +1,42 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+
+if __name__ == "__main__":
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Run the search API with several worker processes sharing one memory-mapped index.")
+    parser.add_argument("--workers", type=int, default=max(1, cpu_count // 4), help="Number of uvicorn worker processes")
+    parser.add_argument("--host", default="0.0.0.0", help="Bind address")
+    parser.add_argument("--port", type=int, default=8000, help="Bind port")
+    parser.add_argument("--torch_threads", type=int, default=None, help="Torch threads per worker (default: cores / workers)")
+    parser.add_argument("--model_path", default=None, help="Fine-tuned ViT weights (must match the indexed embeddings)")
+    parser.add_argument("--inference_backend", default="eager", choices=["eager", "int8", "torchscript"], help="ViT inference backend")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Index builds: cosine similarity at which near-identical scenes share one vector")
+    parser.add_argument("--data_dir", default=None, help="Serve the index kept in this directory (default: backend/)")
+    parser.add_argument("--shard", default=None, help="Serve one shard '<index>/<count>'; builds only index that shard's videos")
+    args = parser.parse_args()
+
+    # Workers read these in backend.main at startup.
+    os.environ["VIDEOARCHIVE_MMAP_INDEX"] = "1"
+    os.environ["VIDEOARCHIVE_TORCH_THREADS"] = str(args.torch_threads or max(1, cpu_count // args.workers))
+    os.environ["VIDEOARCHIVE_INFERENCE_BACKEND"] = args.inference_backend
+    # Workers sum their metrics through this directory, fresh for every start so counters begin at zero.
+    metrics_dir = tempfile.mkdtemp(prefix="videoarchive-metrics-")
+    os.environ["VIDEOARCHIVE_METRICS_DIR"] = metrics_dir
+    if args.model_path:
+        os.environ["VIDEOARCHIVE_MODEL_PATH"] = os.path.abspath(args.model_path)
+    if args.dedup_threshold is not None:
+        os.environ["VIDEOARCHIVE_DEDUP_THRESHOLD"] = str(args.dedup_threshold)
+    if args.data_dir:
+        os.environ["VIDEOARCHIVE_DATA_DIR"] = os.path.abspath(args.data_dir)
+    if args.shard:
+        os.environ["VIDEOARCHIVE_SHARD"] = args.shard
+
+    try:
+        uvicorn.run("backend.main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
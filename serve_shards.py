@@ -0,0 +1,80 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import uvicorn
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def shard_data_dir(data_root: str, shard: int) -> str:
+    return os.path.join(data_root, f"shard-{shard:02d}")
+
+
+def build_shards(args):
+    """Builds every shard in this process, loading the embedder once."""
+    from backend.models import FeatureExtractor
+    from backend.video_processor import build_index
+
+    feature_extractor = FeatureExtractor(args.model_path, backend=args.inference_backend)
+    for shard in range(args.shards):
+        print(f"🧩 Building shard {shard}/{args.shards} ...")
+        build_index(feature_extractor=feature_extractor, data_dir=shard_data_dir(args.data_root, shard),
+                    shard=(shard, args.shards), dedup_threshold=args.dedup_threshold)
+
+
+def start_shard_servers(args) -> tuple[list[subprocess.Popen], list[str]]:
+    """Starts one ``serve.py`` process per shard on consecutive ports after the coordinator's."""
+    processes, urls = [], []
+    for shard in range(args.shards):
+        port = args.port + 1 + shard
+        command = [sys.executable, os.path.join(REPO_DIR, "serve.py"), "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(args.workers_per_shard), "--data_dir", shard_data_dir(args.data_root, shard),
+                   "--shard", f"{shard}/{args.shards}", "--inference_backend", args.inference_backend]
+        if args.torch_threads:
+            command += ["--torch_threads", str(args.torch_threads)]
+        if args.model_path:
+            command += ["--model_path", args.model_path]
+        if args.dedup_threshold is not None:
+            command += ["--dedup_threshold", str(args.dedup_threshold)]
+        processes.append(subprocess.Popen(command, cwd=REPO_DIR))
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a sharded index: shard servers plus a coordinator that fans out queries and merges their top-k.")
+    parser.add_argument("--shards", type=int, default=2, help="Number of local shard servers, one process each")
+    parser.add_argument("--shard_urls", default=None, help="Comma-separated URLs of remote shard servers (serve.py --shard); starts only the coordinator")
+    parser.add_argument("--data_root", default=os.path.join("backend", "shard_data"), help="Local shards keep their indexes in <data_root>/shard-NN")
+    parser.add_argument("--build", action="store_true", help="Build or update every local shard before serving")
+    parser.add_argument("--host", default="0.0.0.0", help="Coordinator bind address")
+    parser.add_argument("--port", type=int, default=8000, help="Coordinator port; local shards use the following ports")
+    parser.add_argument("--workers_per_shard", type=int, default=1, help="uvicorn worker processes per local shard")
+    parser.add_argument("--torch_threads", type=int, default=None, help="Torch threads per shard worker")
+    parser.add_argument("--model_path", default=None, help="Fine-tuned ViT weights (must match the indexed embeddings)")
+    parser.add_argument("--inference_backend", default="eager", choices=["eager", "int8", "torchscript"], help="ViT inference backend")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Index builds: cosine similarity at which near-identical scenes share one vector")
+    parser.add_argument("--shard_timeout", type=float, default=30.0, help="Seconds the coordinator waits for a shard")
+    args = parser.parse_args()
+    args.data_root = os.path.abspath(args.data_root)
+
+    processes = []
+    if args.shard_urls:
+        shard_urls = [url.strip() for url in args.shard_urls.split(",") if url.strip()]
+    else:
+        if args.build:
+            build_shards(args)
+        processes, shard_urls = start_shard_servers(args)
+
+    # The coordinator reads these in backend.coordinator at import.
+    os.environ["VIDEOARCHIVE_SHARDS"] = ",".join(shard_urls)
+    os.environ["VIDEOARCHIVE_SHARD_TIMEOUT"] = str(args.shard_timeout)
+    try:
+        uvicorn.run("backend.coordinator:app", host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -1,99 +1,104 @@
 import argparse
 import os
-from glob import glob
 
+import numpy as np
 import torch
 import torch.optim as optim
-from PIL import Image
 from torch.utils.data import DataLoader, Dataset
 from transformers import ViTImageProcessor, ViTModel
 
-from prepare_triplet_data import create_dataset
+from backend.models import load_pretrained
+from prepare_triplet_data import FrameCache, mine_triplets, update_frame_cache
 
 
 class TripletDataset(Dataset):
-    def __init__(self, root_dir, processor):
-        self.root_dir = root_dir
-        self.processor = processor
-        self.anchor_paths = sorted(glob(os.path.join(root_dir, "*_anchor_*.png")))
-        self.triplets = self._create_triplets()
-
-    def _create_triplets(self):
-        triplets = []
-        for anchor_path in self.anchor_paths:
-            base_name = "_".join(anchor_path.split("_")[:-2])
-            positive_path = anchor_path.replace("anchor", "positive")
-            negative_paths = glob(
-                os.path.join(
-                    self.root_dir, f"*_negative_*.png"
-                )
-            )
-            # Ensure negative is not from the same video
-            anchor_video_name = os.path.basename(base_name).split('_')[0]
-            valid_negative_paths = [p for p in negative_paths if not os.path.basename(p).startswith(anchor_video_name)]
-
-            if os.path.exists(positive_path) and valid_negative_paths:
-                negative_path = valid_negative_paths[0] # Simplified selection
-                triplets.append((anchor_path, positive_path, negative_path))
-        return triplets
+    """``(anchor, positive, negative)`` uint8 frames from a ``FrameCache``.
+
+    With ``mined=True`` the items are the triplets mined from the index. Otherwise they are
+    the cached pairs with a random frame of another video as the negative, drawn anew every
+    epoch (``set_epoch``). The memory map is opened lazily in each loader worker instead of
+    being pickled.
+    """
+
+    def __init__(self, cache_dir: str, seed: int = 0, mined: bool = False):
+        self.cache = FrameCache(cache_dir).load()
+        self.mined = mined
+        self.pairs = self.cache.pairs()
+        self.triplets = self.cache.triplets() if mined else None
+        self.seed = seed
+        self.epoch = 0
+        self._frames = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
 
     def __len__(self):
-        return len(self.triplets)
+        return len(self.triplets) if self.mined else len(self.pairs)
 
-    def __getitem__(self, idx):
-        anchor_path, positive_path, negative_path = self.triplets[idx]
-
-        anchor_img = Image.open(anchor_path).convert("RGB")
-        positive_img = Image.open(positive_path).convert("RGB")
-        negative_img = Image.open(negative_path).convert("RGB")
+    def _negative_row(self, idx: int) -> int:
+        rng = np.random.default_rng([self.seed, self.epoch, idx])
+        video = self.pairs[idx, 2]
+        while True:
+            candidate = self.pairs[rng.integers(len(self.pairs))]
+            if candidate[2] != video:
+                return int(candidate[rng.integers(2)])
 
-        anchor_processed = self.processor(
-            images=anchor_img, return_tensors="pt"
-        ).pixel_values.squeeze(0)
-        positive_processed = self.processor(
-            images=positive_img, return_tensors="pt"
-        ).pixel_values.squeeze(0)
-        negative_processed = self.processor(
-            images=negative_img, return_tensors="pt"
-        ).pixel_values.squeeze(0)
-
-        return anchor_processed, positive_processed, negative_processed
+    def __getitem__(self, idx):
+        if self._frames is None:
+            self._frames = self.cache.frames()
+        if self.mined:
+            rows = self.triplets[idx]
+        else:
+            anchor_row, positive_row, _ = self.pairs[idx]
+            rows = (anchor_row, positive_row, self._negative_row(idx))
+        return tuple(torch.from_numpy(np.array(self._frames[row])) for row in rows)
 
 
 def train(args):
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+
+    # Only new or changed videos are decoded; everything else comes from the cache.
+    if args.mine:
+        if args.rebuild_cache:
+            FrameCache(args.cache_dir).reset()
+        mine_triplets(args.cache_dir, args.data_dir, args.videos_dir, args.anchors_per_video, args.negatives_per_anchor,
+                      seed=args.seed)
+        dataset = TripletDataset(args.cache_dir, mined=True)
+        if not len(dataset):
+            raise SystemExit("No triplets could be mined. Index at least 2 videos first.")
+    else:
+        update_frame_cache(args.videos_dir, args.cache_dir, args.pairs_per_video, seed=args.seed, rebuild=args.rebuild_cache)
+        dataset = TripletDataset(args.cache_dir, seed=args.seed)
+        if len({video for _, _, video in dataset.pairs}) < 2:
+            raise SystemExit("At least 2 cached videos are needed for negatives.")
+
+    processor = load_pretrained(ViTImageProcessor)
+    model = load_pretrained(ViTModel).to(device)
+    # Rescale and normalize like ViTImageProcessor, once per batch on the cached uint8 frames.
+    mean = torch.tensor(processor.image_mean, device=device).view(1, 3, 1, 1) * 255
+    std = torch.tensor(processor.image_std, device=device).view(1, 3, 1, 1) * 255
+
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
+                            pin_memory=device == "cuda")
 
-    # 데이터 준비
-    create_dataset()
-
-    # 모델 및 프로세서 로드
-    processor = ViTImageProcessor.from_pretrained("google/vit-base-patch16-224")
-    model = ViTModel.from_pretrained("google/vit-base-patch16-224").to(device)
-
-    # 데이터셋 및 데이터로더
-    dataset = TripletDataset(root_dir="triplet_dataset", processor=processor)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
-
-    # 손실 함수 및 옵티마이저
     criterion = torch.nn.TripletMarginLoss(margin=1.0, p=2)
     optimizer = optim.AdamW(model.parameters(), lr=args.learning_rate)
 
-    # 학습 루프
     model.train()
     for epoch in range(args.epochs):
+        dataset.set_epoch(epoch)
         running_loss = 0.0
         for anchor, positive, negative in dataloader:
-            anchor, positive, negative = (
-                anchor.to(device),
-                positive.to(device),
-                negative.to(device),
-            )
+            # One forward pass over the concatenated triplet instead of three.
+            pixels = torch.cat([anchor, positive, negative]).to(device, non_blocking=True).float()
+            pixels = (pixels - mean) / std
 
             optimizer.zero_grad()
-
-            anchor_output = model(pixel_values=anchor).last_hidden_state.mean(dim=1)
-            positive_output = model(pixel_values=positive).last_hidden_state.mean(dim=1)
-            negative_output = model(pixel_values=negative).last_hidden_state.mean(dim=1)
+            with torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=args.bf16):
+                embeddings = model(pixel_values=pixels).last_hidden_state.mean(dim=1)
+            anchor_output, positive_output, negative_output = embeddings.float().chunk(3)
 
             loss = criterion(anchor_output, positive_output, negative_output)
             loss.backward()
@@ -105,9 +110,8 @@ def train(args):
             f"Epoch {epoch + 1}/{args.epochs}, Loss: {running_loss / len(dataloader)}"
         )
 
-    # 모델 저장
-    torch.save(model.state_dict(), "finetuned_vit.pth")
-    print("Fine-tuned model saved as finetuned_vit.pth")
+    torch.save(model.state_dict(), args.output)
+    print(f"Fine-tuned model saved as {args.output}")
 
 
 if __name__ == "__main__":
@@ -115,5 +119,18 @@ if __name__ == "__main__":
     parser.add_argument("--epochs", type=int, default=10, help="Number of training epochs")
     parser.add_argument("--batch_size", type=int, default=4, help="Batch size for training")
     parser.add_argument("--learning_rate", type=float, default=1e-5, help="Learning rate for optimizer")
+    parser.add_argument("--num_workers", type=int, default=min(4, max(1, (os.cpu_count() or 1) // 2)), help="DataLoader worker processes")
+    parser.add_argument("--torch_threads", type=int, default=0, help="Intra-op threads for training (0 keeps torch's default)")
+    parser.add_argument("--bf16", action="store_true", help="Run forward passes under bfloat16 autocast (CPU or GPU)")
+    parser.add_argument("--videos_dir", default="backend/videos", help="Videos to sample training frames from")
+    parser.add_argument("--cache_dir", default="triplet_cache", help="Memory-mapped frame cache, updated incrementally")
+    parser.add_argument("--pairs_per_video", type=int, default=8, help="Anchor/positive pairs sampled per video")
+    parser.add_argument("--mine", action="store_true", help="Train on triplets with hard negatives mined from the index")
+    parser.add_argument("--data_dir", default=None, help="--mine: index to mine (see video_processor.data_paths; default: backend/)")
+    parser.add_argument("--anchors_per_video", type=int, default=32, help="--mine: indexed scenes per video used as anchors")
+    parser.add_argument("--negatives_per_anchor", type=int, default=4, help="--mine: hard negatives (one triplet each) per anchor")
+    parser.add_argument("--rebuild_cache", action="store_true", help="Discard the frame cache and sample every video again")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the frame pairs and negatives")
+    parser.add_argument("--output", default="finetuned_vit.pth", help="Where to save the fine-tuned weights")
     args = parser.parse_args()
-    train(args)
\ No newline at end of file
+    train(args)